@@ -1,3 +1,6 @@
+import itertools
+import collections
+
 # lmap :: (a -> b) -> List[a] -> List[b]
 def lmap(fn):
     def inner(lst):
@@ -12,41 +15,37 @@ def lfilter(fn):
 
 # ljoin :: List[List[a]] -> List[a]
 def ljoin(lst):
-    return sum(lst, [])
-
-# lmap :: (a -> b) -> List[a] -> Iterator[List[b]]
-def imap(fn):
-    def inner(lst):
-        return map(fn, lst)
-    return inner
+    """
+    linear in the total length, sum(lst, []) copied the whole prefix for every sublist
 
-#  # lfilter :: (a -> bool) -> List[a] -> Iterator[List[a]]
-#  def ifilter(fn):
-#      def inner(lst):
-#          return filter(fn, lst)
-#      return inner
-#  
-#  # ljoin ::  List[List[a]] -> List[a]
-#  def ijoin(lst):
-#      yield sum(lst, [])
+    >>> ljoin([[1, 2], [], [3]])
+    [1, 2, 3]
+    """
+    return list(itertools.chain.from_iterable(lst))
 
 # iunit :: a -> Iterator[a]
 def iunit(*args):
-    for i in args:
-        yield i
+    return iter(args)
 
-# imap :: (a -> b) -> Iterator[a] -> Iterable[b]
+# imap :: (a -> b) -> Iterable[a] -> Iterator[b]
 def imap(fn):
     def inner(iter):
-        for it in iter:
-            yield fn(it)
+        return map(fn, iter)
+    return inner
+
+# ifilter :: (a -> bool) -> Iterable[a] -> Iterator[a]
+def ifilter(fn):
+    def inner(iter):
+        return filter(fn, iter)
     return inner
 
 # ijoin :: Iterable[Iterable[a]] -> Iterator[a]
 def ijoin(iter_iter):
-    for it0 in iter_iter:
-        for it1 in it0:
-            yield it1
+    """
+    >>> list(ijoin(iunit(iunit(1, 2), [], range(3, 5))))
+    [1, 2, 3, 4]
+    """
+    return itertools.chain.from_iterable(iter_iter)
 
 # ibind :: Iterator[a] -> (a -> Iterator[b]) -> Iterator[b]
 def ibind(iter):
@@ -62,19 +61,86 @@ def concat(a):
 
 # ap :: Iterator[Callable[[a], b]] -> Iterator[a] -> Iterator[b]
 def ap(mf):
+    """
+    every function applied to every value, mx is read once while the first function
+    runs and its values are kept for the others, so it may be a one-shot iterator
+
+    >>> list(ap(iunit(lambda x : x + 1, lambda x : x * 10))(iunit(1, 2)))
+    [2, 3, 10, 20]
+    """
     def inner(mx):
+        seen, rest = [], iter(mx)
         for f in mf:
-            for x in mx:
+            yield from map(f, seen)
+            for x in rest:
+                seen.append(x)
                 yield f(x)
     return inner
 
+# chunk :: int -> Iterable[a] -> Iterator[List[a]]
+def chunk(size):
+    """
+    batches of size values, for requests taking many keys at once
+
+    >>> list(chunk(2)(range(5)))
+    [[0, 1], [2, 3], [4]]
+    """
+    if size < 1:
+        raise ValueError('chunk size must be at least one')
+    def inner(iter_):
+        it = iter(iter_)
+        return iter(lambda : list(itertools.islice(it, size)), [])
+    return inner
+
+# window :: int -> Iterable[a] -> Iterator[Tuple[a, ...]]
+def window(size):
+    """
+    every run of size consecutive values, nothing if there are fewer
+
+    >>> list(window(3)(range(5))), list(window(3)(range(2)))
+    ([(0, 1, 2), (1, 2, 3), (2, 3, 4)], [])
+    """
+    if size < 1:
+        raise ValueError('window size must be at least one')
+    def inner(iter_):
+        it   = iter(iter_)
+        last = collections.deque(itertools.islice(it, size - 1), maxlen=size)
+        for x in it:
+            last.append(x)
+            yield tuple(last)
+    return inner
+
+# interleave :: *Iterable[a] -> Iterator[a]
+def interleave(*iters):
+    """
+    one value from each iterable in turn until all are exhausted, e.g. to spread
+    consecutive requests over several prefixes
+
+    >>> list(interleave('ab', 'cdef', ''))
+    ['a', 'c', 'b', 'd', 'e', 'f']
+    """
+    nexts = collections.deque(iter(it).__next__ for it in iters)
+    while nexts:
+        try:
+            while True:
+                yield nexts[0]()
+                nexts.rotate(-1)
+        except StopIteration:
+            nexts.popleft()
 
 def laws():
+    """
+    the monad laws of iunit and ibind
+
+    >>> laws()
+    """
     def f(n):
         yield n
         yield n + 1
         yield n + 2
     def g(n):
+        return iunit(n, -n)
+    def empty(n):
         return
         yield
 
@@ -90,6 +156,37 @@ def laws():
     assert list(left) == list(right)
 
     # Associative law
-    left  = ibind(ibind(iunit(10))(f))(g)
-    right = ibind(iunit(10))(lambda x : ibind(ibind(x)(f))(g))
-    assert list(left) == list(right)
+    for h in (g, empty):
+        left  = ibind(ibind(iunit(10, 20))(f))(h)
+        right = ibind(iunit(10, 20))(lambda x : ibind(f(x))(h))
+        assert list(left) == list(right)
+
+def bench(sizes=(1000, 10000)):
+    """
+    time the combinators on n sublists of 10 values, against the quadratic
+    sum(lst, []) and the nested generators they replaced
+    """
+    import timeit
+    def nested(iter_iter):
+        for it0 in iter_iter:
+            for it1 in it0:
+                yield it1
+    for n in sizes:
+        lists = [list(range(10)) for _ in range(n)]
+        cases = {
+            'sum(lst, [])' : lambda : sum(lists, []),
+            'ljoin'        : lambda : ljoin(lists),
+            'nested ijoin' : lambda : collections.deque(nested(lists), maxlen=0),
+            'ijoin'        : lambda : collections.deque(ijoin(lists), maxlen=0),
+            'chunk(100)'   : lambda : collections.deque(chunk(100)(ijoin(lists)), maxlen=0),
+            'window(4)'    : lambda : collections.deque(window(4)(ijoin(lists)), maxlen=0),
+            'interleave'   : lambda : collections.deque(interleave(*lists[:100]), maxlen=0),
+            'ap'           : lambda : collections.deque(ap(iunit(abs, str))(ijoin(lists)), maxlen=0),
+        }
+        for name, case in cases.items():
+            seconds = min(timeit.repeat(case, number=3, repeat=3)) / 3
+            print(f'{n:>8} {name:<14} {seconds * 1000:10.3f} ms')
+
+if __name__ == '__main__':
+    laws()
+    bench()
@@ -0,0 +1,319 @@
+import ssl
+import time
+import asyncio
+import contextlib
+import collections
+import xml.etree.ElementTree as ElementTree
+from   urllib.parse import urlsplit, urlencode, unquote
+
+import oss2
+from   oss2.exceptions     import make_exception
+from   oss2.utils          import iso8601_to_unixtime, Crc64, check_crc
+from   requests.structures import CaseInsensitiveDict
+
+from   metrics             import REGISTRY
+from   congestion          import SHAPER, SLICE
+
+class ErrorResponse:
+    """
+    the synchronous response oss2.exceptions.make_exception expects
+    """
+    def __init__(self, status, headers, body):
+        self.status  = status
+        self.headers = headers
+        self.body    = body
+
+    def read(self, amt=None):
+        return self.body if amt is None else self.body[:amt]
+
+class Connection:
+    """
+    every read and drain gives up after `timeout` seconds, as oss2 does with its requests
+    """
+    def __init__(self, reader, writer, timeout):
+        self.reader  = reader
+        self.writer  = writer
+        self.timeout = timeout
+
+    def readline(self):
+        return asyncio.wait_for(self.reader.readline(), self.timeout)
+
+    def readexactly(self, size):
+        return asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+
+    def read(self, size):
+        return asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    def drain(self):
+        return asyncio.wait_for(self.writer.drain(), self.timeout)
+
+    def close(self):
+        self.writer.close()
+
+class Response:
+    """
+    status and headers of a response, the body is read on demand from the connection
+    """
+    def __init__(self, connection, status, headers, method):
+        self.connection = connection
+        self.status     = status
+        self.headers    = headers
+        self.chunked    = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        self.reusable   = headers.get('Connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304):
+            self.remaining = 0
+        elif 'Content-Length' in headers and not self.chunked:
+            self.remaining = int(headers['Content-Length'])
+        else:
+            # chunked bodies count the rest of the current chunk, None is read until eof
+            self.remaining = None if not self.chunked else 0
+            self.reusable  = self.reusable and self.chunked
+        self.finished = self.remaining == 0 and not self.chunked
+        self.crc      = None
+
+    # expect_crc :: int -> None
+    def expect_crc(self, crc):
+        """
+        check the whole body against the CRC64 oss reported, once it has been read
+        """
+        self.crc, self.expected_crc = Crc64(0), crc
+
+    def check_crc(self, data):
+        self.crc.update(data)
+        if self.finished:
+            crc, self.crc = self.crc, None
+            check_crc('get', crc.crc, self.expected_crc, self.headers.get('x-oss-request-id'))
+
+    async def read_chunk_size(self):
+        line = await self.connection.readline()
+        size = int(line.split(b';')[0], 16)
+        if size == 0:
+            while await self.connection.readline() not in (b'\r\n', b''):
+                pass
+            self.finished = True
+        return size
+
+    # read :: Optional[int] -> Awaitable[bytes]
+    async def read(self, amt=None):
+        """
+        up to amt bytes of the body, everything left when amt is None, b'' at the end
+        """
+        if amt is None:
+            pieces = []
+            while piece := await self.read(1024 * 1024):
+                pieces.append(piece)
+            return b''.join(pieces)
+        data = await self.read_some(amt)
+        if self.crc is not None:
+            self.check_crc(data)
+        if SHAPER.rate is not None and data:
+            await SHAPER.rate.consume_async(len(data))
+        return data
+
+    # read_some :: int -> Awaitable[bytes]
+    async def read_some(self, amt):
+        connection = self.connection
+        if self.finished:
+            return b''
+        if self.remaining is None:
+            data = await connection.read(amt)
+            self.finished = not data
+            return data
+        if self.chunked and self.remaining == 0:
+            self.remaining = await self.read_chunk_size()
+            if self.finished:
+                return b''
+        data = await connection.readexactly(min(amt, self.remaining))
+        self.remaining -= len(data)
+        if self.chunked and self.remaining == 0:
+            await connection.readexactly(2)
+        elif not self.chunked and self.remaining == 0:
+            self.finished = True
+        return data
+
+    # iter_chunks :: int -> AsyncIterator[bytes]
+    async def iter_chunks(self, chunk_size=1024 * 1024):
+        while data := await self.read(chunk_size):
+            yield data
+
+class ByteBudget:
+    """
+    bytes of request bodies held in memory at once, a body waits until it fits under
+    `limit`, one larger than the limit waits until it is alone
+    """
+    def __init__(self, limit):
+        self.limit   = limit
+        self.used    = 0
+        self.changed = asyncio.Condition()
+
+    # hold :: int -> AsyncContextManager[None]
+    @contextlib.asynccontextmanager
+    async def hold(self, size):
+        size = min(size, self.limit)
+        async with self.changed:
+            await self.changed.wait_for(lambda : self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self.changed:
+                self.used -= size
+                self.changed.notify_all()
+
+class AsyncBucket:
+    """
+    the part of oss2.Bucket the asyncio engine needs, on an event loop instead of threads,
+    requests are built and signed by the wrapped oss2.Bucket and sent over a shared pool
+    of at most `connections` keep-alive connections, so thousands of pending requests
+    cost a coroutine each rather than an OS thread each
+    """
+    def __init__(self, bucket, connections=64, buffer_limit=256 * 1024 * 1024):
+        self.bucket      = bucket
+        self.bucket_name = bucket.bucket_name
+        self.slots       = asyncio.Semaphore(connections)
+        self.buffered    = ByteBudget(buffer_limit)
+        self.idle        = collections.defaultdict(list)
+        self.ssl         = ssl.create_default_context()
+        # the timeout oss2 gives requests for both connecting and reading
+        self.timeout     = bucket.timeout
+
+    async def connect(self, scheme, netloc):
+        if self.idle[netloc]:
+            return self.idle[netloc].pop(), True
+        host, _, port = netloc.partition(':')
+        secure        = scheme == 'https'
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            host, int(port or (443 if secure else 80)), ssl=self.ssl if secure else None
+        ), self.timeout)
+        return Connection(reader, writer, self.timeout), False
+
+    async def send(self, connection, method, netloc, path, headers, data):
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {netloc}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items() if value is not None)
+        if data or method in ('PUT', 'POST'):
+            lines.append(f'Content-Length: {len(data)}')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+        if SHAPER.rate is None:
+            connection.writer.write(head + data)
+        else:
+            connection.writer.write(head)
+            for offset in range(0, len(data), SLICE):
+                await SHAPER.rate.consume_async(len(data[offset:offset + SLICE]))
+                connection.writer.write(data[offset:offset + SLICE])
+                await connection.drain()
+        await connection.drain()
+        status = await connection.readline()
+        if not status:
+            raise ConnectionResetError('connection closed by oss')
+        response_headers = CaseInsensitiveDict()
+        while (line := await connection.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip()] = value.strip()
+        return Response(connection, int(status.split()[1]), response_headers, method)
+
+    @contextlib.asynccontextmanager
+    async def request(self, method, key, data=b'', params=None, headers=None):
+        """
+        signed request on a pooled connection, non 2xx responses raise the same
+        exceptions as oss2, the connection is reused once the body is consumed;
+        the request is only signed once it may be sent, a Date signed before waiting
+        for a connection and the shaper could be rejected as RequestTimeTooSkewed
+        """
+        async with self.slots:
+            started = await SHAPER.acquire_async()
+            status  = 'error'
+            start   = time.perf_counter()
+            try:
+                req = oss2.http.Request(method, self.bucket._make_url(self.bucket_name, key), params=params, headers=headers)
+                self.bucket.auth._sign_request(req, self.bucket_name, key)
+                url  = urlsplit(req.url)
+                path = (url.path or '/') + ('?' + urlencode(req.params) if req.params else '')
+                connection, reused = await self.connect(url.scheme, url.netloc)
+                try:
+                    response = await self.send(connection, method, url.netloc, path, req.headers, data)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    if not reused:
+                        REGISTRY.inc('soss_requests_total', method=method, status='error')
+                        raise
+                    # a pooled connection closed by oss while idle, retry once on a new one
+                    REGISTRY.inc('soss_retries_total', method=method)
+                    connection, _ = await self.connect(url.scheme, url.netloc)
+                    response      = await self.send(connection, method, url.netloc, path, req.headers, data)
+                status = response.status
+            finally:
+                SHAPER.release(started, method, len(data), status)
+            REGISTRY.observe('soss_request_seconds', time.perf_counter() - start, method=method)
+            REGISTRY.inc('soss_requests_total', method=method, status=response.status)
+            REGISTRY.inc('soss_bytes_total', len(data), direction='up')
+            if method != 'HEAD':
+                REGISTRY.inc('soss_bytes_total', int(response.headers.get('Content-Length', 0)), direction='down')
+            try:
+                if response.status // 100 != 2:
+                    raise make_exception(ErrorResponse(response.status, response.headers, await response.read()))
+                # a 200 to a GET of an object is the whole of it, as checked by oss2
+                if method == 'GET' and key and response.status == 200 and self.bucket.enable_crc and 'x-oss-hash-crc64ecma' in response.headers:
+                    response.expect_crc(int(response.headers['x-oss-hash-crc64ecma']))
+                yield response
+                await response.read()
+            except BaseException:
+                connection.close()
+                raise
+            if response.reusable:
+                self.idle[url.netloc].append(connection)
+            else:
+                connection.close()
+
+    # object_exists :: str -> Awaitable[bool]
+    async def object_exists(self, key):
+        try:
+            async with self.request('HEAD', key):
+                return True
+        except oss2.exceptions.ServerError as err:
+            if err.status == 404:
+                return False
+            raise
+
+    # head_object :: str -> Awaitable[CaseInsensitiveDict]
+    async def head_object(self, key):
+        async with self.request('HEAD', key) as response:
+            return response.headers
+
+    # put_object :: (str, bytes, Optional[dict]) -> Awaitable[CaseInsensitiveDict]
+    async def put_object(self, key, data, headers=None):
+        async with self.request('PUT', key, data, headers=headers) as response:
+            return response.headers
+
+    # get_object :: (str, Optional[Tuple[int, int]]) -> AsyncContextManager[Response]
+    def get_object(self, key, byte_range=None):
+        headers = None if byte_range is None else {'Range' : 'bytes={0}-{1}'.format(*byte_range)}
+        return self.request('GET', key, headers=headers)
+
+    # list_objects :: (str, str, str, int) -> Awaitable[Tuple[List[SimplifiedObjectInfo], List[str], Optional[str]]]
+    async def list_objects(self, prefix='', delimiter='', marker='', max_keys=1000):
+        """
+        one page of the listing, objects, common prefixes and the marker of the next page
+        """
+        params = {'prefix' : prefix, 'delimiter' : delimiter, 'marker' : marker,
+                  'max-keys' : str(max_keys), 'encoding-type' : 'url'}
+        async with self.request('GET', '', params=params) as response:
+            root = ElementTree.fromstring(await response.read())
+        text    = lambda node, tag : unquote(node.findtext(tag, ''))
+        objects = [
+            oss2.models.SimplifiedObjectInfo(
+                text(node, 'Key'), iso8601_to_unixtime(node.findtext('LastModified')), node.findtext('ETag', '').strip('"'),
+                node.findtext('Type'), int(node.findtext('Size', '0')), node.findtext('StorageClass')
+            )
+            for node in root.iter('Contents')
+        ]
+        prefixes = [text(node, 'Prefix') for node in root.iter('CommonPrefixes')]
+        truncated = root.findtext('IsTruncated') == 'true'
+        return objects, prefixes, text(root, 'NextMarker') if truncated else None
+
+    # iterate :: str -> AsyncIterator[SimplifiedObjectInfo]
+    async def iterate(self, prefix='', max_keys=1000):
+        marker = ''
+        while marker is not None:
+            objects, _, marker = await self.list_objects(prefix, marker=marker, max_keys=max_keys)
+            for obj in objects:
+                yield obj
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+end to end benchmarks of the upload, download and list paths against a local
+fake oss (fake_oss.py) with configurable latency and bandwidth, the clients run
+as subprocesses exactly as from the command line, results are printed as json
+so that runs can be compared:
+
+    python benchmark.py --latency 0.01 --bandwidth 100M --output before.json
+
+with --startup it times short invocations instead, dominated by the interpreter
+and imports, and fails when they got slower than a saved run:
+
+    python benchmark.py --startup --output startup.json
+    python benchmark.py --startup --baseline startup.json
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import argparse
+import platform
+import collections
+import tempfile
+import subprocess
+
+from fake_oss  import FakeOss
+from multipart import KB, MB, parse_size
+
+HERE        = os.path.dirname(os.path.abspath(__file__))
+BUCKET      = 'bucket'
+ENCRYPT_KEY = 'benchmark'
+
+# write_file :: (str, int, random.Random) -> int
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            left -= f.write(rng.randbytes(min(left, MB)))
+    return size
+
+# tiny_tree :: (str, argparse.Namespace, random.Random) -> Tuple[int, int]
+def tiny_tree(root, args, rng):
+    """
+    many small files, a hundred per directory
+    """
+    sizes = [rng.randint(1, args.tiny_size) for _ in range(args.tiny)]
+    return len(sizes), sum(
+        write_file(os.path.join(root, f'd{n // 100}', f'f{n}'), size, rng) for n, size in enumerate(sizes)
+    )
+
+# huge_tree :: (str, argparse.Namespace, random.Random) -> Tuple[int, int]
+def huge_tree(root, args, rng):
+    return args.huge, sum(write_file(os.path.join(root, f'huge{n}'), args.huge_size, rng) for n in range(args.huge))
+
+# deep_tree :: (str, argparse.Namespace, random.Random) -> Tuple[int, int]
+def deep_tree(root, args, rng):
+    """
+    a chain of args.depth nested directories with a few files at every level
+    """
+    size = 0
+    for level in range(args.depth):
+        root  = os.path.join(root, f'level{level}')
+        size += sum(write_file(os.path.join(root, f'f{n}'), rng.randint(1, args.tiny_size), rng) for n in range(3))
+    return args.depth * 3, size
+
+TREES = {'tiny' : tiny_tree, 'huge' : huge_tree, 'deep' : deep_tree}
+
+# high_water_mark :: int -> Optional[float]
+def high_water_mark(pid):
+    """
+    peak rss of a running process in MB, None where /proc is not available
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / KB
+    except OSError:
+        pass
+    return None
+
+# client_env :: () -> Dict[str, str]
+def client_env():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [HERE, os.environ.get('PYTHONPATH')])))
+    env.setdefault('OSS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('OSS_ACCESS_KEY_SECRET', 'benchmark')
+    return env
+
+# run :: (List[str], str) -> Tuple[float, float, int, str]
+def run(command, cwd):
+    """
+    run a client, returns its wall time, peak rss in MB, exit code and the tail of stderr,
+    the peak rss is sampled from /proc while it runs, the ru_maxrss of a child
+    also counts the memory of this process, which it was forked from
+    """
+    env = client_env()
+    with tempfile.TemporaryFile() as stderr:
+        start   = time.monotonic()
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+        peak    = None
+        while True:
+            rss  = high_water_mark(process.pid)
+            peak = rss if peak is None else max(peak, rss or 0)
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        stderr.seek(0)
+        error = stderr.read().decode(errors='replace')[-2000:]
+    return elapsed, peak if peak is not None else usage.ru_maxrss / KB, os.waitstatus_to_exitcode(status), error
+
+# scenarios :: (str, str, str, str, argparse.Namespace) -> List[Tuple[str, List[str]]]
+def scenarios(name, root, endpoint, work, args):
+    python   = sys.executable
+    fp       = [python, os.path.join(HERE, 'soss_fp.py')]
+    tiantian = [python, os.path.join(HERE, 'soss_by_tiantian.py')]
+    remote   = ['--endpoint', endpoint, '--bucket', BUCKET]
+    prefix   = f'tiantian/{name}/'
+    fp_args  = shlex.split(args.fp_args)
+    return [
+        ('soss_fp upload',           fp + ['upload', root, '-c', os.path.join(work, 'config.json')] + fp_args),
+        ('soss_fp upload unchanged', fp + ['upload', root, '-c', os.path.join(work, 'config.json')] + fp_args),
+        ('tiantian upload',          tiantian + ['upload', root, '--prefix', prefix, '-k', ENCRYPT_KEY] + remote),
+        ('tiantian list',            tiantian + ['list', '--prefix', prefix] + remote),
+        ('tiantian download',        tiantian + ['download', prefix, '--output_dir', os.path.join(work, 'downloads', name),
+                                                 '-k', ENCRYPT_KEY] + remote + shlex.split(args.download_args)),
+    ]
+
+# benchmark :: argparse.Namespace -> dict
+def benchmark(args):
+    oss              = FakeOss(args.latency, args.bandwidth, args.capacity, args.failure_rate)
+    server, endpoint = oss.serve()
+    results          = []
+    rng              = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix='soss-benchmark-') as work:
+        with open(os.path.join(work, 'config.json'), 'w') as f:
+            json.dump({'endpoint' : endpoint, 'bucket' : BUCKET}, f)
+        for name in args.trees:
+            root         = os.path.join(work, 'trees', name)
+            files, size  = TREES[name](root, args, rng)
+            print(f'{name}: {files} files, {size / MB:.1f} MB', file=sys.stderr)
+            for scenario, command in scenarios(name, root, endpoint, work, args):
+                oss.stats()
+                elapsed, rss, code, error = run(command, work)
+                stats = oss.stats()
+                results.append({
+                    'tree'           : name,
+                    'scenario'       : scenario,
+                    'files'          : files,
+                    'bytes'          : size,
+                    'seconds'        : round(elapsed, 3),
+                    'files_per_s'    : round(files / elapsed, 1),
+                    'mb_per_s'       : round(size / MB / elapsed, 2),
+                    'peak_rss_mb'    : round(rss, 1),
+                    'requests'       : stats['requests'],
+                    'peak_in_flight' : stats['peak_in_flight'],
+                    'returncode'     : code,
+                })
+                print(f'  {scenario:<26} {elapsed:8.2f}s {files / elapsed:10.1f} files/s {size / MB / elapsed:8.2f} MB/s'
+                      f' {rss:8.1f} MB rss  {sum(stats["requests"].values())} requests', file=sys.stderr)
+                if code != 0:
+                    print(error, file=sys.stderr)
+    server.shutdown()
+    return {
+        'settings' : {
+            'latency'       : args.latency,
+            'bandwidth'     : args.bandwidth,
+            'capacity'      : args.capacity,
+            'failure_rate'  : args.failure_rate,
+            'fp_args'       : args.fp_args,
+            'download_args' : args.download_args,
+            'python'        : platform.python_version(),
+            'platform'      : platform.platform(),
+        },
+        'results' : results,
+    }
+
+# import_times :: str -> Tuple[float, List[Tuple[str, float]]]
+def import_times(stderr):
+    """
+    the total import time in ms of the output of `python -X importtime` and the
+    cumulative time of its top level imports, slowest first, site is left out as
+    it is paid by every python process
+
+    >>> import_times('''import time: self [us] | cumulative | imported package
+    ... import time:       120 |        120 |   _io
+    ... import time:      2000 |       5000 | site
+    ... import time:       300 |      40000 | oss2
+    ... import time:       200 |        500 |   oss2.utils
+    ... import time:       100 |       1000 | argparse
+    ... ''')
+    (41.0, [('oss2', 40.0), ('argparse', 1.0)])
+    """
+    top = collections.Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith('  ') or name.strip() == 'site':
+            continue
+        top[name.strip()] += int(cumulative) / 1000
+    return round(sum(top.values()), 1), [(name, round(ms, 1)) for name, ms in top.most_common()]
+
+# startup_scenarios :: (str, str, str) -> List[Tuple[str, List[str]]]
+def startup_scenarios(endpoint, work, root):
+    python   = sys.executable
+    fp       = [python, os.path.join(HERE, 'soss_fp.py')]
+    tiantian = [python, os.path.join(HERE, 'soss_by_tiantian.py')]
+    remote   = ['--endpoint', endpoint, '--bucket', BUCKET]
+    cache    = ['--cache', os.path.join(work, 'listing.db')]
+    file     = os.path.join(root, 'one')
+    return [
+        ('soss_fp --help',               fp + ['--help']),
+        ('tiantian --help',              tiantian + ['--help']),
+        ('tiantian list',                tiantian + ['list', '--prefix', 'startup/'] + remote),
+        ('tiantian list cached',         tiantian + ['list', '--prefix', 'startup/', '--refresh', 'none'] + cache + remote),
+        ('tiantian upload one file',     tiantian + ['upload', file, '--prefix', 'startup/', '-k', ENCRYPT_KEY] + remote),
+        ('soss_fp upload one file',      fp + ['upload', root, '-c', os.path.join(work, 'config.json')]),
+    ]
+
+# startup :: argparse.Namespace -> dict
+def startup(args):
+    """
+    the best wall time of args.runs runs of every scenario, and the imports of one
+    more run under -X importtime, which slows the imports down, so it is not timed
+    """
+    oss              = FakeOss(args.latency)
+    server, endpoint = oss.serve()
+    results          = []
+    env              = client_env()
+    with tempfile.TemporaryDirectory(prefix='soss-startup-') as work:
+        with open(os.path.join(work, 'config.json'), 'w') as f:
+            json.dump({'endpoint' : endpoint, 'bucket' : BUCKET}, f)
+        root = os.path.join(work, 'trees', 'startup')
+        os.makedirs(root)
+        write_file(os.path.join(root, 'one'), 4 * KB, random.Random(args.seed))
+        commands = startup_scenarios(endpoint, work, root)
+        named    = dict(commands)
+        # something to list, and the listing cache the cached scenario reads
+        refresh  = named['tiantian list cached'].index('--refresh')
+        for command in (named['tiantian upload one file'], named['tiantian list cached'][:refresh] + named['tiantian list cached'][refresh + 2:]):
+            subprocess.run(command, cwd=work, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        for scenario, command in commands:
+            times = []
+            # every run uploads, tiantian would otherwise ask whether to overwrite
+            uploads = 'upload' in scenario
+            for _ in range(args.runs):
+                if uploads:
+                    oss.objects.clear()
+                elapsed, _, code, error = run(command, work)
+                times.append(elapsed)
+            if uploads:
+                oss.objects.clear()
+            traced  = subprocess.run([command[0], '-X', 'importtime'] + command[1:], cwd=work, env=env, stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            total, top = import_times(traced.stderr)
+            results.append({
+                'scenario'    : scenario,
+                'seconds'     : round(min(times), 3),
+                'import_ms'   : total,
+                'top_imports' : dict(top[:args.top]),
+                'returncode'  : code,
+            })
+            print(f'  {scenario:<26} {min(times) * 1000:8.1f} ms {total:8.1f} ms imports  '
+                  + ', '.join(f'{name} {ms:.0f}' for name, ms in top[:3]), file=sys.stderr)
+            if code != 0:
+                print(error, file=sys.stderr)
+    server.shutdown()
+    return {
+        'settings' : {
+            'startup'  : True,
+            'runs'     : args.runs,
+            'latency'  : args.latency,
+            'python'   : platform.python_version(),
+            'platform' : platform.platform(),
+        },
+        'results' : results,
+    }
+
+# regressions :: (dict, dict, float) -> List[str]
+def regressions(results, baseline, tolerance):
+    """
+    the scenarios more than tolerance slower than in baseline, in wall time or in imports
+
+    >>> old = {'results' : [{'scenario' : 'list', 'seconds' : 0.2, 'import_ms' : 100.0}]}
+    >>> new = {'results' : [{'scenario' : 'list', 'seconds' : 0.21, 'import_ms' : 150.0}]}
+    >>> regressions(new, old, 0.2)
+    ['list: import_ms 100.0 -> 150.0']
+    """
+    before = {result['scenario'] : result for result in baseline['results']}
+    slower = []
+    for result in results['results']:
+        old = before.get(result['scenario'])
+        for field in ('seconds', 'import_ms'):
+            if old is not None and field in old and result[field] > old[field] * (1 + tolerance):
+                slower.append(f'{result["scenario"]}: {field} {old[field]} -> {result[field]}')
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark soss against a local fake oss')
+    parser.add_argument('--latency',       help='seconds added to every request', type=float, default=0.005)
+    parser.add_argument('--bandwidth',     help='bytes/s shared by all transfers, e.g. 100M, unlimited by default', type=parse_size, default=None)
+    parser.add_argument('--capacity',      help='requests the fake oss serves at once, more are throttled with 503', type=int, default=None)
+    parser.add_argument('--failure-rate',  help='share of requests the fake oss fails with 500', type=float, default=0.0)
+    parser.add_argument('--trees',         help='synthetic trees to run', nargs='+', choices=sorted(TREES), default=sorted(TREES))
+    parser.add_argument('--tiny',          help='number of files of the tiny tree', type=int, default=2000)
+    parser.add_argument('--tiny-size',     help='maximum size of a tiny file', type=parse_size, default=4 * KB)
+    parser.add_argument('--huge',          help='number of files of the huge tree', type=int, default=2)
+    parser.add_argument('--huge-size',     help='size of every huge file', type=parse_size, default=128 * MB)
+    parser.add_argument('--depth',         help='nesting depth of the deep tree', type=int, default=50)
+    parser.add_argument('--seed',          help='seed of the synthetic data', type=int, default=0)
+    parser.add_argument('--fp-args',       help='extra arguments of soss_fp upload, e.g. "-w 64 --prefetch"', default='')
+    parser.add_argument('--download-args', help='extra arguments of soss_by_tiantian download', default='')
+    parser.add_argument('--output', '-o',  help='write the json results here instead of stdout', default=None)
+    parser.add_argument('--startup',       help='time short invocations and their imports instead of the trees', action='store_true')
+    parser.add_argument('--runs',          help='with --startup, runs of every invocation, the fastest counts', type=int, default=5)
+    parser.add_argument('--top',           help='with --startup, slowest top level imports reported', type=int, default=10)
+    parser.add_argument('--baseline',      help='with --startup, json of an earlier run, exit 1 if slower than it', default=None)
+    parser.add_argument('--tolerance',     help='share by which --baseline may be exceeded', type=float, default=0.2)
+    args    = parser.parse_args()
+    report  = startup(args) if args.startup else benchmark(args)
+    results = json.dumps(report, indent=2)
+    if args.output is None:
+        print(results)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print(f'regression: {line}', file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+import queue
+import struct
+import threading
+import functools
+import collections
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from compression   import stored_codec
+from dedup         import is_recipe
+
+NONCE_SIZE   = 8
+CHUNK_SIZE   = 1024 * 1024
+META_CIPHER  = 'x-oss-meta-soss-cipher'
+SEGMENT_SIZE = 1024 * 1024
+TAG_SIZE     = 16
+# magic, segment size, nonce prefix of the segments
+HEADER       = struct.Struct('>8sI8s')
+MAGIC        = b'SOSSGCM1'
+
+class EncryptingReader:
+    """
+    file-like view of an object in the soss format: an 8 byte nonce followed by
+    the AES-CTR ciphertext of fileobj, encrypted as it is read, so only the chunk
+    being read is held in memory no matter how large the file is
+
+    >>> import io
+    >>> from Crypto.Cipher import AES
+    >>> key    = bytes(32)
+    >>> stream = EncryptingReader(io.BytesIO(b'hello world'), key, 11)
+    >>> data   = stream.read(4) + stream.read(4) + stream.read()
+    >>> stream.len, len(data)
+    (19, 19)
+    >>> AES.new(key, AES.MODE_CTR, nonce=data[:8]).decrypt(data[8:])
+    b'hello world'
+    """
+    def __init__(self, fileobj, encrypt_key, size):
+        self.fileobj = fileobj
+        self.header  = get_random_bytes(NONCE_SIZE)
+        self.cipher  = AES.new(encrypt_key, AES.MODE_CTR, nonce=self.header)
+        self.len     = None if size is None else NONCE_SIZE + size
+
+    def read(self, amt=-1):
+        header, self.header = self.header, b''
+        if amt is not None and amt >= 0:
+            amt = max(amt - len(header), 0)
+        return header + self.cipher.encrypt(self.fileobj.read(amt))
+
+class Decryptor:
+    """
+    incremental decryption of an object in the soss format, fed the object
+    piece by piece as it arrives, the nonce may be split across pieces
+
+    >>> import io
+    >>> key       = bytes(32)
+    >>> data      = EncryptingReader(io.BytesIO(b'hello world'), key, 11).read()
+    >>> decryptor = Decryptor(key)
+    >>> b''.join(decryptor.update(data[i:i + 3]) for i in range(0, len(data), 3))
+    b'hello world'
+    """
+    def __init__(self, encrypt_key):
+        self.encrypt_key = encrypt_key
+        self.header      = b''
+        self.cipher      = None
+
+    # flush :: () -> bytes
+    def flush(self):
+        return b''
+
+    # update :: bytes -> bytes
+    def update(self, data):
+        if self.cipher is None:
+            self.header += data
+            if len(self.header) < NONCE_SIZE:
+                return b''
+            nonce, data = self.header[:NONCE_SIZE], self.header[NONCE_SIZE:]
+            self.cipher = AES.new(self.encrypt_key, AES.MODE_CTR, nonce=nonce)
+        return self.cipher.decrypt(data)
+
+# cipher_headers :: str -> dict
+def cipher_headers(cipher):
+    """
+    objects in the ctr format carry no header, as they did before there was a choice
+    """
+    return {} if cipher == 'ctr' else {META_CIPHER : cipher}
+
+# stored_cipher :: Mapping[str, str] -> str
+def stored_cipher(headers):
+    return 'gcm' if headers.get(META_CIPHER) == 'gcm' else 'ctr'
+
+# make_decryptor :: (bytes, str) -> Union[Decryptor, SegmentDecryptor]
+def make_decryptor(encrypt_key, cipher):
+    return SegmentDecryptor(encrypt_key) if cipher == 'gcm' else Decryptor(encrypt_key)
+
+# sealed_size :: (int, int) -> int
+def sealed_size(size, segment_size=SEGMENT_SIZE):
+    """
+    the size of an object in the gcm format holding size bytes, an empty file still
+    has one empty segment, so that an object cut after its header does not pass for it
+
+    >>> sealed_size(0), sealed_size(10, 4), sealed_size(8, 4)
+    (36, 78, 60)
+    """
+    return HEADER.size + size + TAG_SIZE * max(1, -(-size // segment_size))
+
+# seal_segment :: (bytes, bytes, int, bool, bytes) -> bytes
+def seal_segment(encrypt_key, header, index, last, data):
+    """
+    the ciphertext and tag of one segment, its nonce is the nonce prefix of the object
+    and its index, the header and whether it is the last segment are authenticated
+    with it, so segments can not be reordered, moved to another object, or dropped
+    from the end
+    """
+    cipher = AES.new(encrypt_key, AES.MODE_GCM, nonce=header[-NONCE_SIZE:] + index.to_bytes(4, 'big'))
+    cipher.update(header + bytes([last]))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return ciphertext + tag
+
+# open_segment :: (bytes, bytes, int, bool, bytes) -> bytes
+def open_segment(encrypt_key, header, index, last, data):
+    if len(data) < TAG_SIZE:
+        raise ValueError(f'segment {index} is truncated')
+    cipher = AES.new(encrypt_key, AES.MODE_GCM, nonce=header[-NONCE_SIZE:] + index.to_bytes(4, 'big'))
+    cipher.update(header + bytes([last]))
+    try:
+        return cipher.decrypt_and_verify(data[:-TAG_SIZE], data[-TAG_SIZE:])
+    except ValueError:
+        raise ValueError(f'segment {index} failed authentication, wrong key or corrupted object') from None
+
+# parse_header :: bytes -> int
+def parse_header(header):
+    """
+    the segment size of an object in the gcm format
+    """
+    magic, segment_size, _ = HEADER.unpack(header)
+    if magic != MAGIC or segment_size == 0:
+        raise ValueError('not an object in the gcm format')
+    return segment_size
+
+# read_full :: (file-like, int) -> bytes
+def read_full(stream, size):
+    """
+    size bytes of stream, fewer only at its end
+    """
+    data = stream.read(size)
+    while 0 < len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+# segments :: (file-like, int) -> Iterator[Tuple[int, bool, bytes]]
+def segments(stream, size):
+    """
+    stream in numbered pieces of size bytes, the last one flagged, read one piece ahead
+    to know which one is the last, an empty stream is a single empty piece
+
+    >>> import io
+    >>> list(segments(io.BytesIO(b'abcdefgh'), 4)), list(segments(io.BytesIO(b''), 4))
+    ([(0, False, b'abcd'), (1, True, b'efgh')], [(0, True, b'')])
+    """
+    index, current = 0, read_full(stream, size)
+    while True:
+        following = read_full(stream, size) if len(current) == size else b''
+        yield index, not following, current
+        if not following:
+            return
+        index, current = index + 1, following
+
+# ordered_map :: (Callable[..., b], Iterable[tuple], Optional[Executor], int) -> Iterator[b]
+def ordered_map(function, arguments, pool, in_flight):
+    """
+    function applied to every tuple of arguments on pool, at most in_flight calls ahead
+    of the one consumed, in order, inline without a pool, AES releases the GIL so
+    threads spread the segments of one object over the cores; MIterator.par_map would
+    bring the returns library into soss_by_tiantian
+    """
+    if pool is None:
+        yield from (function(*args) for args in arguments)
+        return
+    pending = collections.deque()
+    try:
+        for args in arguments:
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+class SegmentEncryptingReader:
+    """
+    file-like view of an object in the gcm format: a header with the segment size and
+    a random nonce prefix, then every segment_size bytes of fileobj encrypted and
+    authenticated with AES-GCM on its own, so segments are sealed in parallel on pool,
+    read as parts by upload_multipart, and checked as they are downloaded
+
+    >>> import io
+    >>> key    = bytes(32)
+    >>> stream = SegmentEncryptingReader(io.BytesIO(b'hello world'), key, 11, segment_size=4)
+    >>> data   = stream.read(5) + stream.read(30) + stream.read()
+    >>> stream.len, len(data)
+    (79, 79)
+    >>> out = io.BytesIO()
+    >>> decrypt_segments(io.BytesIO(data), key, out), out.getvalue()
+    (11, b'hello world')
+    """
+    def __init__(self, fileobj, encrypt_key, size, segment_size=SEGMENT_SIZE, pool=None, in_flight=8):
+        header       = HEADER.pack(MAGIC, segment_size, get_random_bytes(NONCE_SIZE))
+        seal         = functools.partial(seal_segment, encrypt_key, header)
+        self.sealed  = ordered_map(seal, segments(fileobj, segment_size), pool, in_flight)
+        self.buffer  = header
+        self.len     = None if size is None else sealed_size(size, segment_size)
+
+    def read(self, amt=-1):
+        pieces, length = [self.buffer], len(self.buffer)
+        while amt is None or amt < 0 or length < amt:
+            sealed = next(self.sealed, None)
+            if sealed is None:
+                break
+            pieces.append(sealed)
+            length += len(sealed)
+        data = b''.join(pieces)
+        if amt is None or amt < 0:
+            self.buffer = b''
+        else:
+            data, self.buffer = data[:amt], data[amt:]
+        return data
+
+class SegmentDecryptor:
+    """
+    incremental decryption of an object in the gcm format, fed the object piece by
+    piece as it arrives, a segment is only known to be the last one at the end, which
+    flush() decrypts, every segment is authenticated before it is returned
+
+    >>> import io
+    >>> key       = bytes(32)
+    >>> data      = SegmentEncryptingReader(io.BytesIO(b'hello world'), key, 11, segment_size=4).read()
+    >>> decryptor = SegmentDecryptor(key)
+    >>> b''.join(decryptor.update(data[i:i + 7]) for i in range(0, len(data), 7)) + decryptor.flush()
+    b'hello world'
+    >>> decryptor = SegmentDecryptor(key)
+    >>> decryptor.update(data[:-20]) + decryptor.flush()
+    Traceback (most recent call last):
+        ...
+    ValueError: segment 1 failed authentication, wrong key or corrupted object
+    """
+    def __init__(self, encrypt_key):
+        self.encrypt_key = encrypt_key
+        self.buffer      = bytearray()
+        self.header      = None
+        self.record      = None
+        self.index       = 0
+
+    # update :: bytes -> bytes
+    def update(self, data):
+        self.buffer += data
+        if self.header is None:
+            if len(self.buffer) < HEADER.size:
+                return b''
+            self.header = bytes(self.buffer[:HEADER.size])
+            self.record = parse_header(self.header) + TAG_SIZE
+            del self.buffer[:HEADER.size]
+        plain = []
+        # a full segment followed by more data is not the last one
+        while len(self.buffer) > self.record:
+            plain.append(open_segment(self.encrypt_key, self.header, self.index, False, bytes(self.buffer[:self.record])))
+            del self.buffer[:self.record]
+            self.index += 1
+        return b''.join(plain)
+
+    # flush :: () -> bytes
+    def flush(self):
+        if self.header is None:
+            raise ValueError('object in the gcm format is truncated')
+        return open_segment(self.encrypt_key, self.header, self.index, True, bytes(self.buffer))
+
+# decrypt_segments :: (file-like, bytes, file-like, Optional[Executor], int) -> int
+def decrypt_segments(stream, encrypt_key, out, pool=None, in_flight=8):
+    """
+    decrypt an object in the gcm format from stream into out, the segments are
+    authenticated and decrypted on pool while the next ones are received, returns the
+    plaintext size, raises ValueError on the first segment failing authentication
+    """
+    header = read_exact(stream, HEADER.size)
+    record = parse_header(header) + TAG_SIZE
+    opened = ordered_map(functools.partial(open_segment, encrypt_key, header), segments(stream, record), pool, in_flight)
+    size   = 0
+    for plain in opened:
+        out.write(plain)
+        size += len(plain)
+    return size
+
+# clamp_range :: (int, Optional[int], int) -> Tuple[int, int]
+def clamp_range(start, end, size):
+    """
+    the range within a file of size bytes, as a server answers a range request
+
+    >>> clamp_range(5, None, 10), clamp_range(5, 100, 10)
+    ((5, 9), (5, 9))
+    """
+    if start >= size:
+        raise ValueError(f'range starts at {start}, after the end of the {size} byte file')
+    return start, size - 1 if end is None else min(end, size - 1)
+
+# download_range :: (oss2.Bucket, str, bytes, int, Optional[int], file-like, Optional[Executor], int) -> int
+def download_range(bucket, key, encrypt_key, start, end, out, pool=None, in_flight=8):
+    """
+    bytes start to end (inclusive, None for the rest) of the plaintext of an encrypted
+    object into out, with two ranged gets: the header, which also brings the meta and
+    the object size, then only the ciphertext covering the range; a ctr counter starts
+    at the block of start, gcm decrypts and authenticates just the segments covering
+    it, returns the number of bytes written
+
+    >>> import io, oss2
+    >>> from fake_oss import FakeOss
+    >>> oss              = FakeOss()
+    >>> server, endpoint = oss.serve()
+    >>> bucket           = oss2.Bucket(oss2.Auth('id', 'secret'), endpoint, 'bucket')
+    >>> key, data        = bytes(32), bytes(range(256)) * 40
+    >>> _ = bucket.put_object('ctr', EncryptingReader(io.BytesIO(data), key, len(data)).read())
+    >>> _ = bucket.put_object('gcm', SegmentEncryptingReader(io.BytesIO(data), key, len(data), 1000).read(), headers=cipher_headers('gcm'))
+    >>> for name, start, end in (('ctr', 1000, 1999), ('ctr', 17, None), ('gcm', 999, 3000), ('gcm', 10000, 99999)):
+    ...     out = io.BytesIO()
+    ...     n   = download_range(bucket, name, key, start, end, out)
+    ...     print(name, n, out.getvalue() == data[start:None if end is None else end + 1])
+    ctr 1000 True
+    ctr 10223 True
+    gcm 2002 True
+    gcm 240 True
+    >>> server.shutdown()
+    """
+    return open_range(bucket, key, encrypt_key, start, end)(out, pool, in_flight)
+
+# open_range :: (oss2.Bucket, str, bytes, int, Optional[int]) -> Callable[[file-like, Optional[Executor], int], int]
+def open_range(bucket, key, encrypt_key, start, end):
+    """
+    the first half of download_range: fetch the header and meta of the object and check
+    the range, so that a caller can fail before creating any output, then return the
+    function writing the range into out
+    """
+    first   = bucket.get_object(key, byte_range=(0, HEADER.size - 1))
+    header  = read_full(first, HEADER.size)
+    headers = first.headers
+    total   = int(headers['Content-Range'].rpartition('/')[2])
+    if stored_codec(headers) is not None or is_recipe(headers):
+        raise ValueError(f'{key} is compressed or deduplicated, ranges of it can not be read')
+    if stored_cipher(headers) == 'ctr':
+        start, end = clamp_range(start, end, total - NONCE_SIZE)
+        # write_ctr :: (file-like, Optional[Executor], int) -> int
+        def write_ctr(out, pool=None, in_flight=8):
+            cipher  = AES.new(encrypt_key, AES.MODE_CTR, nonce=header[:NONCE_SIZE], initial_value=start // AES.block_size)
+            cipher.decrypt(bytes(start % AES.block_size))
+            data    = bucket.get_object(key, byte_range=(NONCE_SIZE + start, NONCE_SIZE + end))
+            written = 0
+            while True:
+                chunk = data.read(CHUNK_SIZE)
+                if not chunk:
+                    return written
+                written += out.write(cipher.decrypt(chunk))
+        return write_ctr
+    segment_size = parse_header(header)
+    record       = segment_size + TAG_SIZE
+    count        = -(-(total - HEADER.size) // record)
+    start, end   = clamp_range(start, end, total - HEADER.size - TAG_SIZE * count)
+    first, last  = start // segment_size, end // segment_size
+    # write_gcm :: (file-like, Optional[Executor], int) -> int
+    def write_gcm(out, pool=None, in_flight=8):
+        data     = bucket.get_object(key, byte_range=(HEADER.size + first * record, min(HEADER.size + (last + 1) * record, total) - 1))
+        records  = ((index, index == count - 1, read_full(data, record)) for index in range(first, last + 1))
+        opened   = ordered_map(functools.partial(open_segment, encrypt_key, header), records, pool, in_flight)
+        position = first * segment_size
+        written  = 0
+        for plain in opened:
+            written  += out.write(plain[max(start - position, 0):end + 1 - position])
+            position += len(plain)
+        return written
+    return write_gcm
+
+# read_exact :: (file-like, int) -> bytes
+def read_exact(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError(f'expected {size} bytes, got {len(data)}')
+        data += chunk
+    return data
+
+# decrypt_stream :: (file-like, bytes, file-like, int, int) -> int
+def decrypt_stream(stream, encrypt_key, out, chunk_size=CHUNK_SIZE, prefetch=4):
+    """
+    decrypt an object in the soss format from stream into out chunk by chunk,
+    a receiver thread keeps up to `prefetch` chunks in flight so receiving the next
+    chunk overlaps with decrypting and writing the current one, returns the plaintext size
+
+    >>> import io
+    >>> key  = bytes(32)
+    >>> data = EncryptingReader(io.BytesIO(b'hello world' * 1000), key, 11000).read()
+    >>> out  = io.BytesIO()
+    >>> decrypt_stream(io.BytesIO(data), key, out, chunk_size=1000)
+    11000
+    >>> out.getvalue() == b'hello world' * 1000
+    True
+    """
+    cipher = AES.new(encrypt_key, AES.MODE_CTR, nonce=read_exact(stream, NONCE_SIZE))
+    chunks = queue.Queue(prefetch)
+    stop   = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                return chunks.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def receive():
+        try:
+            while not stop.is_set():
+                chunk = stream.read(chunk_size)
+                put(chunk)
+                if not chunk:
+                    return
+        except BaseException as err:
+            put(err)
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    size = 0
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                return size
+            out.write(cipher.decrypt(chunk))
+            size += len(chunk)
+    finally:
+        stop.set()
+        receiver.join()
@@ -0,0 +1,166 @@
+import lzma
+import math
+import zlib
+import collections
+
+META_COMPRESSION = 'x-oss-meta-soss-compression'
+SAMPLE_SIZE      = 64 * 1024
+MAX_ENTROPY      = 7.5
+CHUNK_SIZE       = 1024 * 1024
+
+CODECS = {
+    'zlib' : (lambda : zlib.compressobj(6), zlib.decompressobj),
+    'lzma' : (lzma.LZMACompressor,          lzma.LZMADecompressor),
+}
+
+# entropy :: bytes -> float
+def entropy(sample):
+    """
+    shannon entropy of the bytes of sample in bits per byte, 8 for random data
+
+    >>> entropy(b'aaaa'), entropy(bytes(range(256)))
+    (0.0, 8.0)
+    """
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in collections.Counter(sample).values()) + 0.0
+
+# compressible :: bytes -> bool
+def compressible(sample):
+    """
+    data that is already compressed or encrypted looks random and is sent as it is
+
+    >>> import os
+    >>> compressible(b'time,level,message\\n' * 1000), compressible(os.urandom(SAMPLE_SIZE))
+    (True, False)
+    """
+    return len(sample) > 0 and entropy(sample[:SAMPLE_SIZE]) < MAX_ENTROPY
+
+# choose_codec :: (Optional[str], file-like) -> Optional[str]
+def choose_codec(codec, f):
+    """
+    the codec to compress a seekable file with, None when it does not look compressible,
+    the file is left at its start
+    """
+    if codec is None:
+        return None
+    sample = f.read(SAMPLE_SIZE)
+    f.seek(0)
+    return codec if compressible(sample) else None
+
+# compress :: (bytes, str) -> bytes
+def compress(data, codec):
+    """
+    >>> decompress(compress(b'hello world' * 100, 'lzma'), 'lzma') == b'hello world' * 100
+    True
+    """
+    compressor = CODECS[codec][0]()
+    return compressor.compress(data) + compressor.flush()
+
+# decompress :: (bytes, str) -> bytes
+def decompress(data, codec):
+    decompressor = Decompressor(codec)
+    return decompressor.update(data) + decompressor.flush()
+
+class CompressingReader:
+    """
+    file-like view of fileobj compressed with codec as it is read, for uploads too
+    large to compress in memory, the compressed size is not known in advance
+
+    >>> import io
+    >>> stream = CompressingReader(io.BytesIO(b'hello world' * 1000), 'zlib')
+    >>> data   = stream.read(10) + stream.read()
+    >>> len(data) < 1000, decompress(data, 'zlib') == b'hello world' * 1000
+    (True, True)
+    """
+    def __init__(self, fileobj, codec, chunk_size=CHUNK_SIZE):
+        self.fileobj    = fileobj
+        self.compressor = CODECS[codec][0]()
+        self.chunk_size = chunk_size
+        self.buffer     = b''
+        self.finished   = False
+
+    def read(self, amt=-1):
+        while not self.finished and (amt is None or amt < 0 or len(self.buffer) < amt):
+            chunk = self.fileobj.read(self.chunk_size)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer  += self.compressor.flush()
+                self.finished = True
+        if amt is None or amt < 0:
+            data, self.buffer = self.buffer, b''
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+class Decompressor:
+    """
+    incremental decompression, fed the object piece by piece as it arrives
+    """
+    def __init__(self, codec):
+        self.decompressor = CODECS[codec][1]()
+
+    # update :: bytes -> bytes
+    def update(self, data):
+        return self.decompressor.decompress(data)
+
+    # flush :: () -> bytes
+    def flush(self):
+        return self.decompressor.flush() if hasattr(self.decompressor, 'flush') else b''
+
+class DecompressingWriter:
+    """
+    file-like wrapper decompressing what is written to it into out, flush() at the end
+
+    >>> import io
+    >>> out    = io.BytesIO()
+    >>> writer = DecompressingWriter(out, 'zlib')
+    >>> data   = compress(b'hello world', 'zlib')
+    >>> _ = writer.write(data[:5]), writer.write(data[5:]), writer.flush()
+    >>> out.getvalue()
+    b'hello world'
+    """
+    def __init__(self, out, codec):
+        self.out          = out
+        self.decompressor = Decompressor(codec)
+
+    def write(self, data):
+        return self.out.write(self.decompressor.update(data))
+
+    def flush(self):
+        self.out.write(self.decompressor.flush())
+
+# compression_headers :: Optional[str] -> dict
+def compression_headers(codec):
+    return {} if codec is None else {META_COMPRESSION : codec}
+
+# compress_body :: (bytes, Optional[str]) -> Tuple[bytes, dict]
+def compress_body(data, codec):
+    """
+    the body to upload for data and its headers, a compressed body carries the codec
+    and the md5 of the original data in its meta, its ETag is the md5 of the body,
+    data the codec does not shrink (the entropy of a few bytes says little) is sent as it is
+
+    >>> body, headers = compress_body(b'a,b,c\\n' * 1000, 'zlib')
+    >>> len(body) < 100, headers
+    (True, {'x-oss-meta-soss-compression': 'zlib', 'x-oss-meta-content-md5': 'BcA3d6Bp9NL0BTV3UJYZwA=='})
+    >>> compress_body(b'', 'zlib'), compress_body(b'abc', 'zlib')
+    ((b'', {}), (b'abc', {}))
+    """
+    from oss2.utils import content_md5
+    if codec is None or not compressible(data):
+        return data, {}
+    body = compress(data, codec)
+    if len(body) >= len(data):
+        return data, {}
+    return body, dict(compression_headers(codec), **{'x-oss-meta-content-md5' : content_md5(data)})
+
+# stored_codec :: Mapping[str, str] -> Optional[str]
+def stored_codec(headers):
+    """
+    the codec an object was compressed with, from its headers, None if it was not
+    """
+    codec = headers.get(META_COMPRESSION)
+    return codec if codec in CODECS else None
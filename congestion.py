@@ -0,0 +1,226 @@
+import time
+import threading
+import collections
+
+from metrics   import REGISTRY, body_size
+from multipart import KB, parse_size
+
+TOLERANCE     = 2.0
+SMALL_REQUEST = 64 * KB
+QUEUEING      = 0.02
+SLICE         = 64 * KB
+
+# congested :: Union[int, str] -> bool
+def congested(status):
+    """
+    oss answers 503 (or 429) when it throttles, any 5xx or a failed connection
+    also means it is overloaded
+
+    >>> congested(200), congested(404), congested(503), congested('error')
+    (False, False, True, True)
+    """
+    return status == 'error' or status == 429 or status >= 500
+
+class AdaptiveLimit:
+    """
+    AIMD limit on the requests waiting for a response: the limit grows by one per
+    request (slow start) until the first congestion, then by one per round of
+    `limit` requests, and is cut by `backoff` on throttling, 5xx and failed
+    connections, or when the latency of small requests rises above `tolerance`
+    times its baseline, at most once per round
+
+    >>> limit = AdaptiveLimit(2, maximum=8)
+    >>> for _ in range(10):
+    ...     limit.release(limit.acquire(), 'HEAD', 0, 200)
+    >>> limit.limit
+    8.0
+    >>> limit.release(limit.acquire(), 'PUT', 0, 503)
+    >>> limit.limit
+    4.0
+    >>> for _ in range(4):
+    ...     limit.release(limit.acquire(), 'HEAD', 0, 200)
+    >>> round(limit.limit, 2)
+    4.92
+    """
+    def __init__(self, initial=4, minimum=1, maximum=256, tolerance=TOLERANCE, backoff=0.5):
+        self.limit      = float(max(minimum, min(initial, maximum)))
+        self.minimum    = minimum
+        self.maximum    = maximum
+        self.tolerance  = tolerance
+        self.backoff    = backoff
+        self.in_flight  = 0
+        self.slow_start = True
+        self.decreased  = time.monotonic()
+        self.baseline   = {}
+        self.recent     = {}
+        self.condition  = threading.Condition()
+        self.waiters    = collections.deque()
+
+    # acquire :: () -> float
+    def acquire(self):
+        """
+        wait for a free slot, returns the time the request starts
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    # acquire_async :: () -> Awaitable[float]
+    async def acquire_async(self):
+        """
+        acquire for coroutines, slots are shared with the threads calling acquire
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return time.monotonic()
+                waiter = (loop, asyncio.Event())
+                self.waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            except asyncio.CancelledError:
+                with self.condition:
+                    woken = waiter not in self.waiters
+                    if not woken:
+                        self.waiters.remove(waiter)
+                # pass the wake up on to another waiter
+                if woken:
+                    self.wake(1)
+                raise
+
+    def wake(self, count):
+        with self.condition:
+            self.condition.notify(count)
+            woken = [self.waiters.popleft() for _ in range(min(count, len(self.waiters)))]
+        for loop, event in woken:
+            loop.call_soon_threadsafe(event.set)
+
+    # slow :: (str, int, float) -> bool
+    def slow(self, method, sent, latency):
+        """
+        the baseline follows the lowest latency and creeps up slowly, so that it
+        forgets a lucky fast request, a few milliseconds of jitter on a fast link
+        do not count, large bodies say more about bandwidth than about queueing
+        and are left out
+        """
+        if sent > SMALL_REQUEST:
+            return False
+        baseline = self.baseline.get(method, latency)
+        recent   = self.recent.get(method, latency)
+        self.baseline[method] = min(latency, baseline + (latency - baseline) / 100)
+        self.recent[method]   = recent + (latency - recent) / 8
+        queueing = self.recent[method] - self.baseline[method]
+        return self.recent[method] > self.tolerance * self.baseline[method] and queueing > QUEUEING
+
+    # release :: (float, str, int, Union[int, str]) -> None
+    def release(self, start, method, sent, status):
+        now = time.monotonic()
+        with self.condition:
+            self.in_flight -= 1
+            throttled = congested(status)
+            if throttled or self.slow(method, sent, now - start):
+                # requests started before the last cut were sent at the old limit
+                if start >= self.decreased:
+                    REGISTRY.inc('soss_congestion_total', reason='throttled' if throttled else 'latency')
+                    self.limit      = max(self.minimum, self.limit * self.backoff)
+                    self.decreased  = now
+                    self.slow_start = False
+            elif self.limit < self.maximum:
+                self.limit = float(min(self.maximum, self.limit + (1 if self.slow_start else 1 / self.limit)))
+            free = int(self.limit) - self.in_flight
+        if free > 0:
+            self.wake(free)
+
+class RateLimit:
+    """
+    token bucket shared by every thread and coroutine, a transfer waits until
+    the bytes before it have been paid for at `rate` bytes/s
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    # reserve :: int -> float
+    def reserve(self, size):
+        with self.lock:
+            now       = time.monotonic()
+            start     = max(self.next, now)
+            self.next = start + size / self.rate
+        return start - now
+
+    def consume(self, size):
+        time.sleep(self.reserve(size))
+
+    async def consume_async(self, size):
+        import asyncio
+        await asyncio.sleep(self.reserve(size))
+
+class Shaper:
+    """
+    the optional AdaptiveLimit and RateLimit every request to oss goes through,
+    through session.ShapedBucket for oss2 and AsyncBucket for the asyncio engine
+    """
+    def __init__(self, limit=None, rate=None):
+        self.limit = limit
+        self.rate  = rate
+
+    # acquire :: () -> float
+    def acquire(self):
+        return time.monotonic() if self.limit is None else self.limit.acquire()
+
+    # acquire_async :: () -> Awaitable[float]
+    async def acquire_async(self):
+        return time.monotonic() if self.limit is None else await self.limit.acquire_async()
+
+    # release :: (float, str, int, Union[int, str]) -> None
+    def release(self, start, method, sent, status):
+        if self.limit is not None:
+            self.limit.release(start, method, sent, status)
+
+    def pace(self, stream):
+        """
+        charge every read of a request or response body to the rate limit,
+        bodies whose read can not be replaced are charged up front
+        """
+        if self.rate is None or stream is None:
+            return
+        if not hasattr(stream, 'read'):
+            return self.rate.consume(body_size(stream))
+        read = stream.read
+        def paced_read(*args, **kwargs):
+            data = read(*args, **kwargs)
+            self.rate.consume(len(data))
+            return data
+        try:
+            stream.read = paced_read
+        except AttributeError:
+            self.rate.consume(body_size(stream))
+
+    def configure(self, limit, rate):
+        self.limit = limit
+        self.rate  = rate
+        if limit is not None:
+            REGISTRY.gauge('soss_concurrency_limit', lambda : int(limit.limit))
+
+# the shaper of every request to oss
+SHAPER = Shaper()
+
+# add_arguments :: (argparse.ArgumentParser, str) -> None
+# separator joins the words of the flags, '-' for soss_fp and '_' for soss_by_tiantian
+def add_arguments(parser, separator='-'):
+    parser.add_argument('--adaptive',      help='adapt the number of requests in flight to latency and throttling (AIMD), up to the number of workers', action='store_true')
+    parser.add_argument(f'--max{separator}bandwidth', help='cap on the bytes/s sent and received, e.g. 10M', type=parse_size, default=None)
+
+# configure :: (argparse.Namespace, int) -> Shaper
+def configure(args, maximum):
+    SHAPER.configure(
+        AdaptiveLimit(maximum=maximum) if args.adaptive else None,
+        RateLimit(args.max_bandwidth) if args.max_bandwidth else None,
+    )
+    return SHAPER
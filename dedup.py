@@ -0,0 +1,195 @@
+import re
+import base64
+import hashlib
+import threading
+import collections
+
+CHUNK_DIR     = 'soss-chunks/'
+RECIPE_FORMAT = 'recipe'
+WINDOW        = 48
+
+# nibble_class :: int -> bytes
+def nibble_class(nibble):
+    return b'[' + b''.join(re.escape(bytes([value])) for value in range(256) if value & 0x0F == nibble) + b']'
+
+# about one position in 256 is a candidate boundary
+CANDIDATE = re.compile(nibble_class(0x5) + nibble_class(0xA))
+
+# find_cut :: (bytes, int, int, int) -> int
+def find_cut(data, min_size, avg_size, max_size):
+    """
+    length of the first chunk of data, the regex engine proposes candidate boundaries
+    at C speed, a candidate is taken when the md5 of the window ending there has its
+    low bits clear, so boundaries only depend on nearby content and survive insertions
+    """
+    mask = (1 << max(avg_size.bit_length() - 1 - 8, 0)) - 1
+    end  = min(max_size, len(data))
+    pos  = min_size
+    while True:
+        match = CANDIDATE.search(data, pos, end)
+        if match is None:
+            return end
+        cut    = match.end()
+        window = hashlib.md5(data[max(cut - WINDOW, 0):cut]).digest()
+        if int.from_bytes(window[:4], 'little') & mask == 0:
+            return cut
+        pos = match.start() + 1
+
+# split_chunks :: (file-like, int) -> Iterator[bytes]
+def split_chunks(stream, avg_size=1024 * 1024):
+    """
+    content defined chunking of stream, chunks are between avg_size / 4 and avg_size * 4
+
+    >>> import io, random
+    >>> data   = random.Random(0).randbytes(1 << 20)
+    >>> chunks = list(split_chunks(io.BytesIO(data), avg_size=16 * 1024))
+    >>> b''.join(chunks) == data
+    True
+    >>> shifted = list(split_chunks(io.BytesIO(b'inserted' + data), avg_size=16 * 1024))
+    >>> len(set(chunks) - set(shifted))
+    1
+    >>> list(split_chunks(io.BytesIO(b'')))
+    []
+    """
+    min_size, max_size = avg_size // 4, avg_size * 4
+    buffer = bytearray()
+    eof    = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data    = stream.read(max_size)
+            eof     = not data
+            buffer += data
+        if not buffer:
+            return
+        cut = find_cut(buffer, min_size, avg_size, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+class ChunkStore:
+    """
+    content addressed chunks under soss-chunks/<sha256>, shared by every host,
+    a chunk already in the bucket is never uploaded again
+
+    recipe format, stored at the key of the file:
+        {"format": "recipe", "size": int, "md5": <base64 md5>, "encrypted": false,
+         "chunks": [[<sha256>, <length>], ...]}
+    """
+    def __init__(self, bucket, known=None):
+        self.bucket  = bucket
+        self.known   = known
+        self.stored  = set()
+        self.pending = {}
+        self.lock    = threading.Lock()
+
+    @classmethod
+    # load :: oss2.Bucket -> ChunkStore
+    def load(cls, bucket):
+        import oss2
+        return cls(bucket, {obj.key for obj in oss2.ObjectIterator(bucket, prefix=CHUNK_DIR, max_keys=1000)})
+
+    # has :: str -> bool
+    def has(self, key):
+        if self.known is not None:
+            return key in self.known
+        return self.bucket.object_exists(key)
+
+    # put :: (str, bytes) -> bool
+    def put(self, digest, data):
+        """
+        upload a chunk unless the bucket already has it, a chunk being uploaded
+        by another thread is waited for instead of uploaded twice
+        """
+        key = CHUNK_DIR + digest
+        with self.lock:
+            if key in self.stored:
+                return False
+            pending = self.pending.get(key)
+            if pending is None:
+                self.pending[key] = threading.Event()
+        if pending is not None:
+            pending.wait()
+            return self.put(digest, data)
+        try:
+            if self.has(key):
+                uploaded = False
+            else:
+                from oss2.utils import content_md5
+                self.bucket.put_object(key, data, headers={'Content-MD5' : content_md5(data)})
+                uploaded = True
+            with self.lock:
+                self.stored.add(key)
+            return uploaded
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    # store :: (file-like, int) -> Tuple[dict, int]
+    def store(self, stream, avg_size):
+        """
+        upload the missing chunks of stream, returns its recipe and the number of new chunks
+        """
+        md5      = hashlib.md5()
+        chunks   = []
+        uploaded = 0
+        for data in split_chunks(stream, avg_size):
+            md5.update(data)
+            digest    = hashlib.sha256(data).hexdigest()
+            uploaded += self.put(digest, data)
+            chunks.append([digest, len(data)])
+        recipe = {
+            'format'    : RECIPE_FORMAT,
+            'size'      : sum(length for _, length in chunks),
+            'md5'       : base64.b64encode(md5.digest()).decode(),
+            'encrypted' : False,
+            'chunks'    : chunks
+        }
+        return recipe, uploaded
+
+# is_recipe :: dict -> bool
+def is_recipe(headers):
+    return headers.get('x-oss-meta-soss-format') == RECIPE_FORMAT
+
+# fetch_chunk :: (oss2.Bucket, str) -> bytes
+def fetch_chunk(bucket, digest):
+    data = bucket.get_object(CHUNK_DIR + digest).read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'chunk {digest} is corrupted')
+    return data
+
+# restore :: (oss2.Bucket, dict, file-like, concurrent.futures.Executor, int) -> int
+def restore(bucket, recipe, out, pool, window=8):
+    """
+    rebuild a file from its recipe, up to `window` chunks are fetched in parallel
+    and written in order, returns the size written
+    """
+    pending = collections.deque()
+    size    = 0
+    for digest, _ in recipe['chunks']:
+        pending.append(pool.submit(fetch_chunk, bucket, digest))
+        if len(pending) >= window:
+            size += out.write(pending.popleft().result())
+    while pending:
+        size += out.write(pending.popleft().result())
+    return size
+
+# fetch_chunk_async :: (aio.AsyncBucket, str) -> Awaitable[bytes]
+async def fetch_chunk_async(abucket, digest):
+    async with abucket.get_object(CHUNK_DIR + digest) as response:
+        data = await response.read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'chunk {digest} is corrupted')
+    return data
+
+# restore_async :: (aio.AsyncBucket, dict, file-like, int) -> Awaitable[int]
+async def restore_async(abucket, recipe, out, window=8):
+    """
+    restore on the event loop, `window` chunks at a time
+    """
+    import asyncio
+    size   = 0
+    chunks = recipe['chunks']
+    for start in range(0, len(chunks), window):
+        batch = chunks[start:start + window]
+        for data in await asyncio.gather(*(fetch_chunk_async(abucket, digest) for digest, _ in batch)):
+            size += out.write(data)
+    return size
@@ -0,0 +1,337 @@
+import time
+import random
+import base64
+import hashlib
+import itertools
+import threading
+import email.utils
+import http.server
+import urllib.parse
+from   xml.sax.saxutils import escape
+
+class Throttle:
+    """
+    token bucket shared by every connection, limits the total bytes/s like a network link
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    # consume :: int -> None
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now       = time.monotonic()
+            self.next = max(self.next, now) + size / self.rate
+            delay     = self.next - now
+        time.sleep(delay)
+
+class FakeOss:
+    """
+    in-memory stand-in for one oss bucket, served over http with path style urls
+    (http://127.0.0.1:<port>/<bucket>/<key>), it understands the requests soss sends:
+    put/get/head/delete object, ranged get, listing with markers and delimiters,
+    and multipart uploads, every request waits `latency` seconds and bodies share
+    `bandwidth` bytes/s, requests beyond `capacity` in flight are answered 503 SlowDown
+    like a throttling oss, a `failure_rate` share of requests fail with 500 InternalError,
+    the requests served are counted per kind
+
+    >>> import oss2
+    >>> oss              = FakeOss()
+    >>> server, endpoint = oss.serve()
+    >>> bucket           = oss2.Bucket(oss2.Auth('id', 'secret'), endpoint, 'bucket')
+    >>> bucket.put_object('a/b', b'hello').status
+    200
+    >>> bucket.get_object('a/b', byte_range=(1, 3)).read()
+    b'ell'
+    >>> [obj.key for obj in oss2.ObjectIterator(bucket, prefix='a/')]
+    ['a/b']
+    >>> bucket.object_exists('a/c')
+    False
+    >>> oss.stats()['requests'] == {'put' : 1, 'get' : 1, 'list' : 1, 'head' : 1}
+    True
+    >>> server.shutdown()
+    """
+    def __init__(self, latency=0.0, bandwidth=None, capacity=None, failure_rate=0.0):
+        self.latency      = latency
+        self.capacity     = capacity
+        self.failure_rate = failure_rate
+        self.throttle  = Throttle(bandwidth)
+        self.lock      = threading.Lock()
+        self.objects   = {}
+        self.uploads   = {}
+        self.upload_id = itertools.count(1)
+        self.requests  = {}
+        self.in_flight = 0
+        self.peak      = 0
+
+    # count :: str -> bool
+    def count(self, kind):
+        """
+        False when the request is over capacity and is throttled
+        """
+        with self.lock:
+            if self.capacity is not None and self.in_flight >= self.capacity:
+                self.requests['throttled'] = self.requests.get('throttled', 0) + 1
+                return False
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.in_flight     += 1
+            self.peak           = max(self.peak, self.in_flight)
+            return True
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    # stats :: bool -> dict
+    def stats(self, reset=True):
+        with self.lock:
+            stats = {'requests' : dict(self.requests), 'peak_in_flight' : self.peak}
+            if reset:
+                self.requests = {}
+                self.peak     = 0
+        return stats
+
+    # serve :: (str, int) -> Tuple[http.server.ThreadingHTTPServer, str]
+    def serve(self, host='127.0.0.1', port=0):
+        """
+        serve in a background thread, returns the server and its endpoint
+        """
+        server = Server((host, port), make_handler(self))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f'http://{host}:{server.server_address[1]}'
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads     = True
+    request_queue_size = 1024
+
+class StoredObject:
+    def __init__(self, data, meta, multipart=False):
+        self.data      = data
+        self.meta      = meta
+        self.multipart = multipart
+        self.modified  = time.time()
+        self.crc       = None
+
+    @property
+    def crc64(self):
+        # cached for the data it was computed from, tests may replace the data
+        if self.crc is None or self.crc[0] is not self.data:
+            from oss2.utils import Crc64
+            crc = Crc64(0)
+            crc.update(self.data)
+            self.crc = (self.data, crc.crc)
+        return self.crc[1]
+
+    @property
+    def etag(self):
+        if self.multipart:
+            return hashlib.md5(self.data).hexdigest().upper() + '-1'
+        return hashlib.md5(self.data).hexdigest().upper()
+
+    def headers(self):
+        headers = {
+            'ETag'                 : f'"{self.etag}"',
+            'Last-Modified'        : email.utils.formatdate(self.modified, usegmt=True),
+            'Content-Length'       : str(len(self.data)),
+            'x-oss-hash-crc64ecma' : str(self.crc64),
+        }
+        if not self.multipart:
+            headers['Content-MD5'] = base64.b64encode(hashlib.md5(self.data).digest()).decode()
+        headers.update(self.meta)
+        return headers
+
+# error_body :: (str, str) -> bytes
+def error_body(code, message):
+    return f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code><Message>{message}</Message></Error>'.encode()
+
+def make_handler(oss):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def parse(self):
+            url           = urllib.parse.urlsplit(self.path)
+            _, _, key     = url.path.lstrip('/').partition('/')
+            self.key      = urllib.parse.unquote(key)
+            self.query    = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+
+        def body(self):
+            size = int(self.headers.get('Content-Length', 0))
+            oss.throttle.consume(size)
+            return self.rfile.read(size) if size else b''
+
+        def reply(self, status, body=b'', headers=None):
+            headers = dict(headers or {})
+            headers.setdefault('Content-Length', str(len(body)))
+            headers['x-oss-request-id'] = '0'
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD' and body:
+                oss.throttle.consume(len(body))
+                self.wfile.write(body)
+
+        def handle_request(self, kind, method):
+            self.parse()
+            if not oss.count(kind):
+                self.body()
+                return self.reply(503, error_body('SlowDown', 'Please reduce your request rate.'), {'Content-Type' : 'application/xml'})
+            try:
+                time.sleep(oss.latency)
+                if random.random() < oss.failure_rate:
+                    self.body()
+                    return self.reply(500, error_body('InternalError', 'We encountered an internal error.'), {'Content-Type' : 'application/xml'})
+                method()
+            finally:
+                oss.done()
+
+        def no_such_key(self):
+            self.reply(404, error_body('NoSuchKey', 'The specified key does not exist.'), {'Content-Type' : 'application/xml'})
+
+        def meta(self):
+            return {name : value for name, value in self.headers.items() if name.lower().startswith('x-oss-meta-')}
+
+        def do_PUT(self):
+            self.handle_request('put', self.put)
+
+        def put(self):
+            data = self.body()
+            md5  = self.headers.get('Content-MD5')
+            if md5 is not None and md5 != base64.b64encode(hashlib.md5(data).digest()).decode():
+                return self.reply(400, error_body('InvalidDigest', 'The Content-MD5 you specified was invalid.'))
+            if 'uploadId' in self.query:
+                oss.uploads[self.query['uploadId']][1][int(self.query['partNumber'])] = data
+                return self.reply(200, headers={'ETag' : '"%s"' % hashlib.md5(data).hexdigest().upper()})
+            if 'x-oss-copy-source' in self.headers:
+                return self.copy()
+            stored = StoredObject(data, self.meta())
+            with oss.lock:
+                oss.objects[self.key] = stored
+            self.reply(200, headers={'ETag' : f'"{stored.etag}"'})
+
+        def copy(self):
+            _, _, source = self.headers['x-oss-copy-source'].lstrip('/').partition('/')
+            with oss.lock:
+                original = oss.objects.get(urllib.parse.unquote(source))
+                if original is None:
+                    return self.no_such_key()
+                replace = self.headers.get('x-oss-metadata-directive', 'COPY').upper() == 'REPLACE'
+                stored  = StoredObject(original.data, self.meta() if replace else dict(original.meta), original.multipart)
+                oss.objects[self.key] = stored
+            body = f'<CopyObjectResult><ETag>"{stored.etag}"</ETag></CopyObjectResult>'.encode()
+            self.reply(200, body, {'ETag' : f'"{stored.etag}"', 'Content-Type' : 'application/xml'})
+
+        def do_POST(self):
+            self.handle_request('post', self.post)
+
+        def post(self):
+            self.body()
+            if 'uploads' in self.query:
+                with oss.lock:
+                    upload_id              = str(next(oss.upload_id))
+                    oss.uploads[upload_id] = (self.meta(), {})
+                return self.reply(200, (
+                    '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    f'<Bucket>bucket</Bucket><Key>{escape(self.key)}</Key><UploadId>{upload_id}</UploadId>'
+                    '</InitiateMultipartUploadResult>'
+                ).encode())
+            meta, parts = oss.uploads.pop(self.query['uploadId'])
+            stored      = StoredObject(b''.join(parts[number] for number in sorted(parts)), meta, multipart=True)
+            with oss.lock:
+                oss.objects[self.key] = stored
+            self.reply(200, (
+                '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                f'<Key>{escape(self.key)}</Key><ETag>"{stored.etag}"</ETag></CompleteMultipartUploadResult>'
+            ).encode())
+
+        def do_DELETE(self):
+            self.handle_request('delete', self.delete)
+
+        def delete(self):
+            with oss.lock:
+                if 'uploadId' in self.query:
+                    oss.uploads.pop(self.query['uploadId'], None)
+                else:
+                    oss.objects.pop(self.key, None)
+            self.reply(204)
+
+        def do_HEAD(self):
+            self.handle_request('head', self.head)
+
+        def head(self):
+            stored = oss.objects.get(self.key)
+            if stored is None:
+                return self.no_such_key()
+            self.reply(200, headers=stored.headers())
+
+        def do_GET(self):
+            self.handle_request('list' if not self.path.lstrip('/').partition('/')[2].partition('?')[0] else 'get', self.get)
+
+        def get(self):
+            if not self.key:
+                return self.list()
+            stored = oss.objects.get(self.key)
+            if stored is None:
+                return self.no_such_key()
+            headers = stored.headers()
+            data    = stored.data
+            status  = 200
+            if 'Range' in self.headers:
+                first, _, last = self.headers['Range'].partition('=')[2].partition('-')
+                first, last    = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+                headers['Content-Range'] = f'bytes {first}-{last}/{len(data)}'
+                data, status   = data[first:last + 1], 206
+            headers['Content-Length'] = str(len(data))
+            self.reply(status, data, headers)
+
+        def list(self):
+            prefix    = self.query.get('prefix', '')
+            marker    = self.query.get('marker', '')
+            delimiter = self.query.get('delimiter', '')
+            max_keys  = int(self.query.get('max-keys', '100'))
+            encode    = urllib.parse.quote if self.query.get('encoding-type') == 'url' else escape
+            with oss.lock:
+                keys = sorted(key for key in oss.objects if key.startswith(prefix) and key > marker)
+                objects = dict(oss.objects)
+            entries, prefixes = [], []
+            for key in keys:
+                rest = key[len(prefix):]
+                if delimiter and delimiter in rest:
+                    common = prefix + rest.split(delimiter, 1)[0] + delimiter
+                    if common in prefixes or common <= marker:
+                        continue
+                    prefixes.append(common)
+                    entries.append(common)
+                else:
+                    entries.append(key)
+                if len(entries) == max_keys:
+                    break
+            truncated = len(entries) == max_keys and entries[-1] < keys[-1]
+            xml = ['<?xml version="1.0" encoding="UTF-8"?><ListBucketResult><Name>bucket</Name>']
+            xml.append(f'<Prefix>{encode(prefix)}</Prefix><Marker>{encode(marker)}</Marker><MaxKeys>{max_keys}</MaxKeys>')
+            xml.append(f'<Delimiter>{encode(delimiter)}</Delimiter><IsTruncated>{str(truncated).lower()}</IsTruncated>')
+            if self.query.get('encoding-type') == 'url':
+                xml.append('<EncodingType>url</EncodingType>')
+            if truncated:
+                xml.append(f'<NextMarker>{encode(entries[-1])}</NextMarker>')
+            for key in entries:
+                if key in prefixes:
+                    continue
+                stored   = objects[key]
+                modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stored.modified))
+                xml.append(
+                    f'<Contents><Key>{encode(key)}</Key><LastModified>{modified}</LastModified>'
+                    f'<ETag>"{stored.etag}"</ETag><Type>{"Multipart" if stored.multipart else "Normal"}</Type>'
+                    f'<Size>{len(stored.data)}</Size><StorageClass>Standard</StorageClass></Contents>'
+                )
+            xml.extend(f'<CommonPrefixes><Prefix>{encode(common)}</Prefix></CommonPrefixes>' for common in prefixes)
+            xml.append('</ListBucketResult>')
+            self.reply(200, ''.join(xml).encode(), {'Content-Type' : 'application/xml'})
+
+    return Handler
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import threading
+
+class Journal:
+    """
+    append-only record of an upload job, one json line per change of a key:
+    started, completed or failed, the last line of a key wins, a line cut short
+    by a crash is ignored, a resumed job keeps appending to the same file
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     path    = os.path.join(directory, 'job.jsonl')
+    ...     journal = Journal(path)
+    ...     journal.record('host/a', 'started'); journal.record('host/a', 'completed')
+    ...     journal.record('host/b', 'started'); journal.close()
+    ...     with open(path, 'a') as f:
+    ...         _ = f.write('{"key": "host/c", "sta')
+    ...     resumed = Journal(path, resume=True)
+    ...     resumed.record('host/b', 'completed'); resumed.close()
+    ...     resumed.completed('host/a'), resumed.completed('host/b'), sorted(Journal.load(path))
+    (True, False, ['host/a', 'host/b'])
+    """
+    def __init__(self, path, resume=False):
+        self.path   = path
+        self.lock   = threading.Lock()
+        self.done   = self.load(path) if resume and os.path.exists(path) else set()
+        self.file   = open(path, 'a' if resume else 'w', buffering=1)
+        if self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                # end the line a crash cut short, or the next entry would be lost with it
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    @staticmethod
+    # load :: str -> Set[str]
+    def load(path):
+        """
+        the keys whose last state is completed
+        """
+        states = {}
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                states[entry['key']] = entry['state']
+        return {key for key, state in states.items() if state == 'completed'}
+
+    # completed :: str -> bool
+    def completed(self, key):
+        return key in self.done
+
+    # record :: (str, str, Optional[Exception]) -> None
+    def record(self, key, state, error=None):
+        entry = {'time' : round(time.time(), 3), 'key' : key, 'state' : state}
+        if error is not None:
+            entry['error'] = f'{type(error).__name__}: {error}'
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
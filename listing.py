@@ -0,0 +1,169 @@
+import sqlite3
+import threading
+
+from metrics import REGISTRY
+
+BATCH = 1000
+
+# prefix_end :: str -> Optional[str]
+def prefix_end(prefix):
+    """
+    the smallest string after every key starting with prefix, keys compare as utf-8
+    bytes in both oss and sqlite, which is the order of their code points, so
+    `prefix <= key < prefix_end(prefix)` is a range scan of the primary key
+
+    >>> prefix_end('host/a/'), prefix_end('a\\U0010ffff'), prefix_end('\\ud7ff') == '\\ue000', prefix_end('')
+    ('host/a0', 'b', True, None)
+    """
+    while prefix and prefix[-1] == '\U0010ffff':
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    # surrogates can not be encoded in utf-8
+    return prefix[:-1] + chr(0xe000 if 0xd800 <= last < 0xe000 else last)
+
+class ListingCache:
+    """
+    local copy of the listing of buckets: bucket, key -> (size, etag, modified), with
+    the last key listed under each refreshed prefix, a refresh lists only the keys
+    after it, so new keys sorting after everything seen so far are picked up with a
+    few requests, keys added before it, overwritten or deleted need a full refresh
+
+    >>> import oss2
+    >>> from fake_oss import FakeOss
+    >>> oss              = FakeOss()
+    >>> server, endpoint = oss.serve()
+    >>> bucket           = oss2.Bucket(oss2.Auth('id', 'secret'), endpoint, 'bucket')
+    >>> for key in ('a/1', 'a/2', 'b/1'):
+    ...     _ = bucket.put_object(key, key.encode())
+    >>> cache = ListingCache(':memory:')
+    >>> cache.refresh(bucket, 'a/'), cache.summary('bucket', 'a/')
+    (2, (2, 6))
+    >>> _ = bucket.put_object('a/3', b'a/3'); _ = bucket.delete_object('a/1')
+    >>> cache.refresh(bucket, 'a/'), [key for key, _, _, _ in cache.keys('bucket', 'a/')]
+    (1, ['a/1', 'a/2', 'a/3'])
+    >>> cache.refresh(bucket, 'a/', full=True), [key for key, _, _, _ in cache.keys('bucket', '')]
+    (2, ['a/2', 'a/3'])
+    >>> server.shutdown()
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS objects ('
+            '  bucket   TEXT,'
+            '  key      TEXT,'
+            '  size     INTEGER,'
+            '  etag     TEXT,'
+            '  modified INTEGER,'
+            '  seen     INTEGER,'
+            '  PRIMARY KEY (bucket, key)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS refreshes ('
+            '  bucket     TEXT,'
+            '  prefix     TEXT,'
+            '  marker     TEXT,'
+            '  generation INTEGER,'
+            '  PRIMARY KEY (bucket, prefix)'
+            ')'
+        )
+        self.conn.commit()
+
+    # where :: (str, str) -> Tuple[str, tuple]
+    @staticmethod
+    def where(bucket, prefix):
+        end = prefix_end(prefix)
+        if end is None:
+            return 'bucket = ? AND key >= ?', (bucket, prefix)
+        return 'bucket = ? AND key >= ? AND key < ?', (bucket, prefix, end)
+
+    # state :: (str, str) -> Tuple[str, int]
+    def state(self, bucket, prefix):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT marker, generation FROM refreshes WHERE bucket = ? AND prefix = ?', (bucket, prefix)
+            ).fetchone()
+        return row or ('', 0)
+
+    # store :: (str, str, List[oss2.models.SimplifiedObjectInfo], int) -> None
+    def store(self, bucket, prefix, objects, generation):
+        """
+        a page of the listing and the marker after it go in one transaction,
+        an interrupted refresh goes on from the last page stored
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+                [(bucket, obj.key, obj.size, obj.etag, obj.last_modified, generation) for obj in objects]
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)', (bucket, prefix, objects[-1].key, generation)
+            )
+
+    # refresh :: (oss2.Bucket, str, bool) -> int
+    @REGISTRY.timed('list')
+    def refresh(self, bucket, prefix='', full=False, max_keys=BATCH):
+        """
+        list the keys under prefix after the last one seen, or all of them again when
+        full, after which the keys that were not listed are dropped, returns the number
+        of keys listed
+        """
+        import oss2
+        name               = bucket.bucket_name
+        marker, generation = self.state(name, prefix)
+        if full:
+            # newer than every row, whichever prefix it was listed under
+            with self.lock:
+                generation = self.conn.execute('SELECT COALESCE(MAX(generation), 0) + 1 FROM refreshes').fetchone()[0]
+            marker = ''
+        listed, page = 0, []
+        for obj in oss2.ObjectIterator(bucket, prefix=prefix, marker=marker, max_keys=max_keys):
+            page.append(obj)
+            if len(page) == max_keys:
+                self.store(name, prefix, page, generation)
+                listed, marker, page = listed + len(page), page[-1].key, []
+        if page:
+            self.store(name, prefix, page, generation)
+            listed, marker = listed + len(page), page[-1].key
+        if full:
+            condition, parameters = self.where(name, prefix)
+            with self.lock, self.conn:
+                self.conn.execute(f'DELETE FROM objects WHERE {condition} AND seen < ?', parameters + (generation,))
+                self.conn.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?, ?)', (name, prefix, marker, generation))
+        return listed
+
+    # keys :: (str, str) -> Iterator[Tuple[str, int, str, int]]
+    def keys(self, bucket, prefix=''):
+        condition, parameters = self.where(bucket, prefix)
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT key, size, etag, modified FROM objects WHERE {condition} ORDER BY key', parameters
+            )
+        while True:
+            with self.lock:
+                batch = rows.fetchmany(BATCH)
+            if not batch:
+                return
+            yield from batch
+
+    # summary :: (str, str) -> Tuple[int, int]
+    def summary(self, bucket, prefix=''):
+        """
+        the number of objects under prefix and their total size
+        """
+        condition, parameters = self.where(bucket, prefix)
+        with self.lock:
+            count, size = self.conn.execute(
+                f'SELECT COUNT(*), TOTAL(size) FROM objects WHERE {condition}', parameters
+            ).fetchone()
+        return count, int(size)
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
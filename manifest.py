@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+
+class Manifest:
+    """
+    on-disk record of uploaded files: path -> (size, mtime, inode, md5, bucket, key),
+    a file whose stat still matches its record has not changed since the last upload
+    """
+    def __init__(self, path, commit_every=1000):
+        self.lock         = threading.Lock()
+        self.commit_every = commit_every
+        self.pending      = 0
+        self.conn         = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            '  path   TEXT PRIMARY KEY,'
+            '  size   INTEGER,'
+            '  mtime  INTEGER,'
+            '  inode  INTEGER,'
+            '  md5    TEXT,'
+            '  bucket TEXT,'
+            '  key    TEXT'
+            ')'
+        )
+        self.conn.commit()
+
+    # unchanged :: (str, os.stat_result, str, str) -> bool
+    def unchanged(self, path, st, bucket, key):
+        """
+        >>> import os, tempfile
+        >>> manifest = Manifest(':memory:')
+        >>> st = os.stat(tempfile.gettempdir())
+        >>> manifest.unchanged('/tmp', st, 'bucket', 'host/tmp')
+        False
+        >>> manifest.record('/tmp', st, 'md5', 'bucket', 'host/tmp')
+        >>> manifest.unchanged('/tmp', st, 'bucket', 'host/tmp')
+        True
+        >>> manifest.unchanged('/tmp', st, 'other-bucket', 'host/tmp')
+        False
+        """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, inode, bucket, key FROM files WHERE path = ?', (path,)
+            ).fetchone()
+        return row == (st.st_size, st.st_mtime_ns, st.st_ino, bucket, key)
+
+    # record :: (str, os.stat_result, Optional[str], str, str) -> None
+    def record(self, path, st, md5, bucket, key):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns, st.st_ino, md5, bucket, key)
+            )
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+class RestoreManifest:
+    """
+    on-disk record of restored objects: bucket, key -> (etag, size, modified) of the
+    object as listed and (path, size, mtime) of the file it was written to, an object
+    whose listing and file both still match their record was restored already, a file
+    changed or removed locally is restored again
+
+    >>> import os, tempfile
+    >>> with tempfile.TemporaryDirectory() as directory:
+    ...     path     = os.path.join(directory, 'restored')
+    ...     manifest = RestoreManifest(':memory:')
+    ...     with open(path, 'wb') as f:
+    ...         _ = f.write(b'data')
+    ...     manifest.record('bucket', 'host/a', 'etag', 4, 100, path)
+    ...     before   = manifest.unchanged('bucket', 'host/a', 'etag', 4, 100, path)
+    ...     changed  = manifest.unchanged('bucket', 'host/a', 'other', 4, 100, path)
+    ...     os.remove(path)
+    ...     before, changed, manifest.unchanged('bucket', 'host/a', 'etag', 4, 100, path)
+    (True, False, False)
+    """
+    def __init__(self, path, commit_every=1000):
+        self.lock         = threading.Lock()
+        self.commit_every = commit_every
+        self.pending      = 0
+        self.conn         = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS restored ('
+            '  bucket      TEXT,'
+            '  key         TEXT,'
+            '  etag        TEXT,'
+            '  size        INTEGER,'
+            '  modified    INTEGER,'
+            '  path        TEXT,'
+            '  local_size  INTEGER,'
+            '  local_mtime INTEGER,'
+            '  PRIMARY KEY (bucket, key)'
+            ')'
+        )
+        self.conn.commit()
+
+    # unchanged :: (str, str, str, int, int, str) -> bool
+    def unchanged(self, bucket, key, etag, size, modified, path):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, size, modified, path, local_size, local_mtime FROM restored WHERE bucket = ? AND key = ?', (bucket, key)
+            ).fetchone()
+        if row is None or row[:4] != (etag, size, modified, path):
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return row[4:] == (st.st_size, st.st_mtime_ns)
+
+    # record :: (str, str, str, int, int, str) -> None
+    def record(self, bucket, key, etag, size, modified, path):
+        st = os.stat(path)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO restored VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (bucket, key, etag, size, modified, path, st.st_size, st.st_mtime_ns)
+            )
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
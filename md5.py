@@ -1,37 +1,166 @@
+import os
+import mmap
 import hashlib
 import base64
+from   concurrent.futures import ProcessPoolExecutor
 
-from oss2.compat       import to_string
-from oss2.utils        import content_md5
+from metrics           import REGISTRY
+from multivalue        import MIterator
 
-from returns.io        import IOResultE, IOFailure, IOSuccess
+from returns.io        import IOResultE, IOFailure, IOSuccess, impure_safe
 from returns.pointfree import map_
 from returns.pipeline  import flow, pipe
 
-# calculate_md5 :: _io.BufferedReader -> IOResult[str]
+BUFFER_SIZE    = 8 * 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# md5_to_string :: hashlib.md5 -> str
+md5_to_string = pipe(lambda x : x.digest(), base64.b64encode, bytes.decode)
+
+# content_md5 :: bytes -> str
+def content_md5(data):
+    """
+    the Content-MD5 header of data, as oss2.utils.content_md5 without importing oss2
+
+    >>> content_md5(b'hello world')
+    'XrY7u+Ae7tCTyyK7j1rNww=='
+    """
+    return md5_to_string(hashlib.md5(data))
+
+# calculate_md5 :: _io.BufferedReader -> IOResultE[str]
 def calculate_md5(filehandler):
-    md5_to_string = pipe(lambda x : x.digest(), base64.b64encode, to_string)
+    """
+    >>> import io
+    >>> calculate_md5(io.BytesIO(b'hello world'))
+    <IOResult: <Success: XrY7u+Ae7tCTyyK7j1rNww==>>
+    """
     return flow(
         IOResultE.from_value(filehandler), # IOResultE[_io.BufferedReader]
         update_to_md5,                     # IOResultE[hashlib.md5]
         map_(md5_to_string)                # IOResultE[str]
     )
 
+@REGISTRY.timed('hash')
+# digest_file :: str -> hashlib.md5
+def digest_file(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        REGISTRY.inc('soss_hashed_bytes_total', size)
+        # a small file needs no more buffer than its own size
+        return update_file(f, hashlib.md5(), min(BUFFER_SIZE, size + 1))
+
+# read_md5 :: str -> IOResultE[hashlib.md5]
+read_md5 = impure_safe(digest_file)
+
+# file_md5 :: str -> IOResultE[str]
+def file_md5(path):
+    """
+    same as calculate_md5, but opens and closes the file itself
+    """
+    return read_md5(path).map(md5_to_string)
+
+class HashingReader:
+    """
+    file-like wrapper computing the md5 of everything read through it,
+    so a file can be hashed while it is being uploaded
+
+    >>> import io
+    >>> reader = HashingReader(io.BytesIO(b'hello world'), 11)
+    >>> reader.read(5) + reader.read()
+    b'hello world'
+    >>> reader.len, reader.md5()
+    (11, 'XrY7u+Ae7tCTyyK7j1rNww==')
+    """
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.hasher  = hashlib.md5()
+        self.len     = size
+
+    def read(self, amt=-1):
+        data = self.fileobj.read(amt)
+        self.hasher.update(data)
+        return data
+
+    # md5 :: () -> str
+    def md5(self):
+        return md5_to_string(self.hasher)
+
+# etag_to_md5 :: str -> Optional[str]
+def etag_to_md5(etag):
+    """
+    the ETag of an object uploaded by a single put is the hex md5 of its content,
+    turn it into the base64 form used by Content-Md5, multipart ETags give None
+
+    >>> etag_to_md5('"5EB63BBBE01EEED093CB22BB8F5ACDC3"')
+    'XrY7u+Ae7tCTyyK7j1rNww=='
+    >>> etag_to_md5('5EB63BBBE01EEED093CB22BB8F5ACDC3-2') is None
+    True
+    """
+    etag = etag.strip('"')
+    if len(etag) != 32:
+        return None
+    return base64.b64encode(bytes.fromhex(etag)).decode()
+
 # update_to_md5 :: IOResultE[_io.BufferedReader] -> IOResultE[hashlib.md5]
 def update_to_md5(io_buffer_reader):
-    def helper(io_buffer_reader, m):
-        return io_buffer_reader.bind(
-            lambda f : IOResultE.from_value(f.read(52428800)) # 50M
-        ).bind(
-            lambda buffer : IOSuccess(m.update(buffer)) if buffer else IOFailure("EOF")
-        ).bind(
-            lambda _ : helper(io_buffer_reader, m)
-        ).lash(
-            lambda err : IOResultE.from_value(m)
-        )
-    return helper(io_buffer_reader, hashlib.md5())
-
-class type():
-    def __init__(self, name):
-        self.name = name
-type(int)
+    return io_buffer_reader.bind(
+        impure_safe(lambda f : update_file(f, hashlib.md5()))
+    )
+
+# update_file :: (_io.BufferedReader, hashlib.md5) -> hashlib.md5
+def update_file(f, m, buffer_size=BUFFER_SIZE):
+    """
+    large regular files are hashed straight from an mmap, everything else
+    is read iteratively into one reused buffer
+
+    >>> import io
+    >>> md5_to_string(update_file(io.BytesIO(b'hello world'), hashlib.md5(), buffer_size=4))
+    'XrY7u+Ae7tCTyyK7j1rNww=='
+    """
+    try:
+        fileno = f.fileno()
+    except (AttributeError, OSError):
+        fileno = None
+    if fileno is not None and f.tell() == 0 and os.fstat(fileno).st_size >= MMAP_THRESHOLD:
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            m.update(mapped)
+        return m
+
+    buffer = bytearray(buffer_size)
+    view   = memoryview(buffer)
+    while True:
+        size = f.readinto(buffer)
+        if not size:
+            return m
+        m.update(view[:size])
+
+# hash_path :: str -> Tuple[str, Optional[str], Optional[Exception]]
+def hash_path(path):
+    try:
+        return path, md5_to_string(digest_file(path)), None
+    except Exception as err:
+        return path, None, err
+
+# calculate_md5_many :: (Iterable[str], Optional[int], int, bool) -> Iterator[Tuple[str, IOResultE[str]]]
+def calculate_md5_many(paths, processes=None, max_in_flight=None, ordered=True):
+    """
+    hash many files across a process pool, results come back in the order of paths,
+    or as soon as each is hashed when not ordered, so one large file does not hold
+    back the small ones after it, paths are consumed lazily with at most
+    max_in_flight files submitted at once
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b'hello world'); f.flush()
+    ...     list(calculate_md5_many([f.name, '/no/such/file'], processes=2))[0][1]
+    <IOResult: <Success: XrY7u+Ae7tCTyyK7j1rNww==>>
+    """
+    processes     = processes or os.cpu_count() or 1
+    max_in_flight = max_in_flight or processes * 4
+    with ProcessPoolExecutor(processes) as pool:
+        yield from MIterator(paths).par_map(hash_path, pool, max_in_flight, ordered).map(unpack_hash)
+
+# unpack_hash :: Tuple[str, Optional[str], Optional[Exception]] -> Tuple[str, IOResultE[str]]
+def unpack_hash(hashed):
+    path, md5, error = hashed
+    return path, IOFailure(error) if error is not None else IOSuccess(md5)
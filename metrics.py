@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import inspect
+import itertools
+import threading
+import contextlib
+import functools
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'soss_stage_seconds'      : 'time spent in each pipeline stage',
+    'soss_request_seconds'    : 'time from sending a request to oss until its response headers arrive',
+    'soss_requests_total'     : 'requests sent to oss',
+    'soss_bytes_total'        : 'bytes sent to and received from oss',
+    'soss_hashed_bytes_total' : 'bytes read to compute md5 digests',
+    'soss_retries_total'      : 'requests sent again after a failure',
+    'soss_tasks_total'        : 'finished tasks by outcome',
+    'soss_scan_errors_total'  : 'directories and entries skipped while scanning because they could not be read',
+    'soss_queue_depth'        : 'tasks waiting for a free worker',
+    'soss_concurrency_limit'  : 'requests allowed in flight by --adaptive',
+    'soss_congestion_total'   : 'cuts of the --adaptive limit by cause',
+}
+
+class Histogram:
+    """
+    >>> histogram = Histogram((0.1, 1))
+    >>> for value in (0.05, 0.5, 0.5, 3):
+    ...     histogram.observe(value)
+    >>> histogram.count, histogram.sum, histogram.cumulative()
+    (4, 4.05, [1, 3, 4])
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)
+        self.count   = 0
+        self.sum     = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum   += value
+
+    # cumulative :: () -> List[int]
+    def cumulative(self):
+        """
+        number of observations at most each bucket bound, the last one is +Inf
+        """
+        return list(itertools.accumulate(self.counts))
+
+# label_key :: dict -> Tuple[Tuple[str, str], ...]
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+# format_labels :: Tuple[Tuple[str, str], ...] -> str
+def format_labels(labels):
+    """
+    >>> format_labels((('method', 'GET'), ('status', '200')))
+    '{method="GET",status="200"}'
+    >>> format_labels(())
+    ''
+    """
+    if not labels:
+        return ''
+    escape = lambda value : value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+class Metrics:
+    """
+    thread safe registry of counters, gauges and latency histograms
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('soss_requests_total', method='HEAD')
+    >>> metrics.inc('soss_bytes_total', 512, direction='up')
+    >>> metrics.observe('soss_request_seconds', 0.02, method='HEAD')
+    >>> print(metrics.prometheus(), end='')  # doctest: +ELLIPSIS
+    # HELP soss_bytes_total bytes sent to and received from oss
+    # TYPE soss_bytes_total counter
+    soss_bytes_total{direction="up"} 512
+    # HELP soss_requests_total requests sent to oss
+    # TYPE soss_requests_total counter
+    soss_requests_total{method="HEAD"} 1
+    # HELP soss_request_seconds time from sending a request to oss until its response headers arrive
+    # TYPE soss_request_seconds histogram
+    soss_request_seconds_bucket{method="HEAD",le="0.001"} 0
+    ...
+    soss_request_seconds_bucket{method="HEAD",le="0.025"} 1
+    ...
+    soss_request_seconds_bucket{method="HEAD",le="+Inf"} 1
+    soss_request_seconds_sum{method="HEAD"} 0.02
+    soss_request_seconds_count{method="HEAD"} 1
+    """
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.counters   = {}
+        self.gauges     = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def gauge(self, name, function, **labels):
+        """
+        gauges are read when the metrics are written, function None removes the gauge
+        """
+        key = (name, label_key(labels))
+        with self.lock:
+            if function is None:
+                self.gauges.pop(key, None)
+            else:
+                self.gauges[key] = function
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # timed :: str -> Callable[[Callable], Callable]
+    def timed(self, stage):
+        """
+        decorator timing every call of a function as a pipeline stage,
+        for a coroutine function the time until the coroutine finishes
+        """
+        def decorator(function):
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def decorated_async(*args, **kwargs):
+                    with self.timer('soss_stage_seconds', stage=stage):
+                        return await function(*args, **kwargs)
+                return decorated_async
+
+            @functools.wraps(function)
+            def decorated(*args, **kwargs):
+                with self.timer('soss_stage_seconds', stage=stage):
+                    return function(*args, **kwargs)
+            return decorated
+        return decorator
+
+    # timed_iter :: (str, Iterable[a]) -> Iterator[a]
+    def timed_iter(self, stage, iterable):
+        """
+        time spent producing each item of a lazy iterable, e.g. walking a directory
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer('soss_stage_seconds', stage=stage):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def snapshot(self):
+        with self.lock:
+            counters   = dict(self.counters)
+            gauges     = dict(self.gauges)
+            histograms = {
+                key : (histogram.buckets, histogram.cumulative(), histogram.sum, histogram.count)
+                for key, histogram in self.histograms.items()
+            }
+        return counters, {key : function() for key, function in gauges.items()}, histograms
+
+    # prometheus :: () -> str
+    def prometheus(self):
+        """
+        prometheus text exposition format, as read by the node exporter textfile collector
+        """
+        counters, gauges, histograms = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for name, group in itertools.groupby(sorted(values), key=lambda key : key[0]):
+                header(name, kind)
+                lines.extend(f'{name}{format_labels(labels)} {values[(name, labels)]}' for _, labels in group)
+        for name, group in itertools.groupby(sorted(histograms), key=lambda key : key[0]):
+            header(name, 'histogram')
+            for _, labels in group:
+                buckets, cumulative, total, count = histograms[(name, labels)]
+                for bound, value in zip(buckets + ('+Inf',), cumulative):
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {value}')
+                lines.append(f'{name}_sum{format_labels(labels)} {round(total, 6)}')
+                lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    # json :: () -> str
+    def json(self):
+        counters, gauges, histograms = self.snapshot()
+        entries = lambda values, render : [
+            dict(render(values[key]), name=key[0], labels=dict(key[1])) for key in sorted(values)
+        ]
+        return json.dumps({
+            'timestamp'  : time.time(),
+            'counters'   : entries(counters, lambda value : {'value' : value}),
+            'gauges'     : entries(gauges,   lambda value : {'value' : value}),
+            'histograms' : entries(histograms, lambda value : {
+                'buckets' : dict(zip(map(str, value[0] + ('+Inf',)), value[1])),
+                'sum'     : round(value[2], 6),
+                'count'   : value[3],
+            }),
+        }, indent=2) + '\n'
+
+# the registry every module records into
+REGISTRY = Metrics()
+
+# body_size :: Any -> int
+def body_size(data):
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, bytearray, str)):
+        return len(data)
+    return getattr(data, 'len', 0) or 0
+
+class MetricsWriter:
+    """
+    write REGISTRY to path every `interval` seconds and once more at exit,
+    through a temporary file and a rename so a scraper never reads half a file
+    """
+    def __init__(self, path, format='prometheus', interval=10.0, metrics=REGISTRY):
+        self.path     = path
+        self.render   = metrics.json if format == 'json' else metrics.prometheus
+        self.interval = interval
+        self.stopped  = threading.Event()
+        self.thread   = threading.Thread(target=self.loop, daemon=True)
+
+    def write(self):
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.render())
+        os.replace(temporary, self.path)
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+# add_arguments :: (argparse.ArgumentParser, str) -> None
+# separator joins the words of the flags, '-' for soss_fp and '_' for soss_by_tiantian
+def add_arguments(parser, separator='-'):
+    parser.add_argument('--metrics', help='write per stage timings and counters to this file, e.g. soss.prom', default=None)
+    parser.add_argument(f'--metrics{separator}format', help='format of --metrics', choices=('prometheus', 'json'), default='prometheus')
+    parser.add_argument(f'--metrics{separator}interval', help='seconds between two writes of --metrics', type=float, default=10.0)
+
+# start_writer :: argparse.Namespace -> Optional[MetricsWriter]
+def start_writer(args):
+    if args.metrics is None:
+        return None
+    return MetricsWriter(args.metrics, args.metrics_format, args.metrics_interval).start()
@@ -0,0 +1,80 @@
+import itertools
+import threading
+from   concurrent.futures import ThreadPoolExecutor
+
+KB = 1024
+MB = 1024 * KB
+GB = 1024 * MB
+
+# largest object a single CopyObject request may copy, meta included
+COPY_LIMIT = GB
+
+# parse_size :: str -> int
+def parse_size(text):
+    """
+    >>> parse_size('100'), parse_size('64K'), parse_size('16m'), parse_size('1G')
+    (100, 65536, 16777216, 1073741824)
+    """
+    units = {'K' : KB, 'M' : MB, 'G' : GB}
+    text  = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# parse_range :: str -> Tuple[int, Optional[int]]
+def parse_range(text):
+    """
+    first and last byte of an inclusive range as in http, sizes may have units,
+    the last byte may be left out for the rest of the file
+
+    >>> parse_range('0-99'), parse_range('10M-20M'), parse_range('1G-')
+    ((0, 99), (10485760, 20971520), (1073741824, None))
+    """
+    first, dash, last = text.partition('-')
+    if not dash or not first.strip():
+        raise ValueError(f'invalid range {text!r}, expected start-end or start-')
+    start, end = parse_size(first), parse_size(last) if last.strip() else None
+    if end is not None and end < start:
+        raise ValueError(f'invalid range {text!r}, it ends before it starts')
+    return start, end
+
+# upload_multipart :: (oss2.Bucket, str, file-like, int, int, dict) -> oss2.models.PutObjectResult
+def upload_multipart(bucket, key, stream, part_size=16 * MB, workers=4, headers=None):
+    """
+    read stream sequentially in part_size pieces and upload the parts concurrently,
+    at most `workers` parts are held in memory at once, the upload is aborted on failure,
+    each part carries its Content-MD5 so oss rejects parts corrupted in transit
+    """
+    # oss2 is only imported by the commands that talk to oss, not by the parsers using parse_size
+    from oss2.models import PartInfo
+    from oss2.utils  import content_md5
+
+    upload_id = bucket.init_multipart_upload(key, headers=headers).upload_id
+    slots     = threading.BoundedSemaphore(workers)
+    failed    = threading.Event()
+
+    def upload_part(number, data):
+        try:
+            result = bucket.upload_part(key, upload_id, number, data, headers={'Content-MD5' : content_md5(data)})
+            return PartInfo(number, result.etag, size=len(data), part_crc=getattr(result, 'crc', None))
+        except BaseException:
+            failed.set()
+            raise
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            futures = []
+            for number in itertools.count(1):
+                slots.acquire()
+                data = b'' if failed.is_set() else stream.read(part_size)
+                if not data and number > 1:
+                    slots.release()
+                    break
+                futures.append(pool.submit(upload_part, number, data))
+            parts = [future.result() for future in futures]
+        return bucket.complete_multipart_upload(key, upload_id, parts)
+    except BaseException:
+        bucket.abort_multipart_upload(key, upload_id)
+        raise
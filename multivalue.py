@@ -1,4 +1,8 @@
-from typing import Callable, Tuple, TypeVar, final, Iterable, Iterator, Generator
+import queue
+import itertools
+import collections
+from concurrent.futures import Executor
+from typing import Callable, List, Tuple, TypeVar, final, Iterable, Iterator, Generator
 
 from returns.interfaces.bindable  import Bindable1
 from returns.interfaces.mappable  import Mappable1
@@ -38,8 +42,11 @@ class MIterator(
         >>> list(MIterator.from_value(1, 2, 3, 4, 5).map(lambda x : x + 1))
         [2, 3, 4, 5, 6]
 
+        stages are chained on the inner iterator with the builtin map and filter, so
+        a pipeline of maps and filters runs in C between the functions, without a
+        generator frame and a call of __next__ per stage and element
         """
-        return  MIterator((function(v) for v in self))
+        return  MIterator(map(function, self._inner_value))
 
     # 'BindableN' part:
     def bind(
@@ -57,11 +64,7 @@ class MIterator(
         [11, 12, 13, 21, 22, 23, 31, 32, 33]
 
         """
-        return MIterator(
-            it1
-            for it0 in self.map(function)
-            for it1 in it0
-        )
+        return MIterator(itertools.chain.from_iterable(map(function, self._inner_value)))
 
     def filter(
         self,
@@ -72,7 +75,48 @@ class MIterator(
         >>> list(MIterator(range(10)).filter(lambda x : x > 3))
         [4, 5, 6, 7, 8, 9]
         """
-        return MIterator(filter(function, self))
+        return MIterator(filter(function, self._inner_value))
+
+    def chunked(
+        self,
+        size: int
+    ) -> 'MIterator[List[_FirstType]]':
+        """
+        Group the values into lists of size values, the last one may be shorter
+        >>> list(MIterator(range(7)).chunked(3))
+        [[0, 1, 2], [3, 4, 5], [6]]
+        >>> list(MIterator.from_value().chunked(3))
+        []
+        """
+        if size < 1:
+            raise ValueError('chunk size must be at least one')
+        inner = self._inner_value
+        return MIterator(iter(lambda : list(itertools.islice(inner, size)), []))
+
+    def par_map(
+        self,
+        function: Callable[[_FirstType], _NewFirstType],
+        executor: Executor,
+        max_in_flight: int,
+        ordered: bool = False,
+    ) -> 'MIterator[_NewFirstType]':
+        """
+        Map the values on executor, at most max_in_flight calls are submitted ahead
+        of the consumer and values are only pulled when one of them is taken, the
+        results come in the order the calls finish, or in the order of the values if
+        ordered, calls not started yet are cancelled when the consumer stops early
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> import time
+        >>> with ThreadPoolExecutor(4) as pool:
+        ...     slow_first = lambda n : time.sleep(0.05 * (n == 0)) or n * n
+        ...     unordered  = list(MIterator(range(8)).par_map(slow_first, pool, 4))
+        ...     ordered    = list(MIterator(range(8)).par_map(slow_first, pool, 4, ordered=True))
+        >>> unordered[-1], sorted(unordered) == ordered == [n * n for n in range(8)]
+        (0, True)
+        """
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight must be at least one')
+        return MIterator(_par_map(function, self._inner_value, executor, max_in_flight, ordered))
 
     # iterator part:
     def __next__(self):
@@ -89,7 +133,7 @@ class MIterator(
         """
         return next(self._inner_value)
 
-    def __iter__(self) -> Kind1['MIterator', _FirstType]:
+    def __iter__(self) -> Iterator[_FirstType]:
         """imitate an iterator, produce values lazily
         >>> list(MIterator.from_value())
         []
@@ -97,7 +141,7 @@ class MIterator(
         >>> list(lst)
         [0, 1, 2, 3]
         """
-        return self
+        return self._inner_value
 
     @classmethod
     def from_value(
@@ -136,6 +180,32 @@ class MIterator(
 
 
 
+def _par_map(function, iterator, executor, max_in_flight, ordered):
+    # unordered calls report to a queue as they finish, waiting on the whole
+    # pending set would cost O(max_in_flight) for every value
+    pending  = collections.deque() if ordered else set()
+    finished = queue.SimpleQueue()
+    try:
+        while True:
+            for value in itertools.islice(iterator, max_in_flight - len(pending)):
+                future = executor.submit(function, value)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+                    future.add_done_callback(finished.put)
+            if not pending:
+                return
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                future = finished.get()
+                pending.discard(future)
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
 @final
 class MultiValue(
     Iterable,
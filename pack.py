@@ -0,0 +1,186 @@
+import json
+import time
+import base64
+import hashlib
+import threading
+import os.path
+import urllib.parse
+
+PACK_DIR = '.soss-packs/'
+
+# characters of the common directory kept in the name of an index
+SCOPE_LENGTH = 64
+
+# pack_prefix :: str -> str
+def pack_prefix(key):
+    """
+    packs live next to the objects of the same host, under <hostname>/.soss-packs/
+
+    >>> pack_prefix('myhost/home/user/data')
+    'myhost/.soss-packs/'
+    """
+    return key.split('/', 1)[0] + '/' + PACK_DIR
+
+# pack_prefixes :: (oss2.Bucket, str) -> List[str]
+def pack_prefixes(bucket, prefix):
+    """
+    pack prefixes of every host a key prefix may cover, a prefix without a '/'
+    may still be a partial hostname, so the matching hosts are listed
+    """
+    if '/' in prefix:
+        return [pack_prefix(prefix)]
+    import oss2
+    return [
+        obj.key + PACK_DIR
+        for obj in oss2.ObjectIterator(bucket, prefix=prefix, delimiter='/')
+        if obj.is_prefix()
+    ]
+
+# is_pack_key :: str -> bool
+def is_pack_key(key):
+    return '/' + PACK_DIR in key
+
+# index_key :: (str, Iterable[str]) -> str
+def index_key(name, keys):
+    """
+    the index of a pack is named after the directory common to all its files,
+    so that readers interested in another directory do not need to fetch it
+
+    >>> index_key('host/.soss-packs/0f', ['host/a/b/x', 'host/a/b/y', 'host/a/c'])
+    'host/.soss-packs/0f.host%2Fa%2F.json'
+    >>> index_key('host/.soss-packs/0f', ['host/a/b/x'])
+    'host/.soss-packs/0f.host%2Fa%2Fb%2F.json'
+    """
+    common = os.path.commonprefix(list(keys))
+    scope  = common[:common.rfind('/') + 1][:SCOPE_LENGTH]
+    return f'{name}.{urllib.parse.quote(scope, safe="")}.json'
+
+# index_scope :: str -> Optional[str]
+def index_scope(key):
+    """
+    the common directory an index was named after, None for indexes written before
+
+    >>> index_scope('host/.soss-packs/0f.host%2Fa%2F.json'), index_scope('host/.soss-packs/0f.json')
+    ('host/a/', None)
+    """
+    _, _, scope = key.rsplit('/', 1)[-1][:-len('.json')].partition('.')
+    return urllib.parse.unquote(scope) if scope else None
+
+# covers :: (Optional[str], str) -> bool
+def covers(scope, prefix):
+    """
+    whether an index of that scope may hold keys under prefix
+
+    >>> covers('host/a/', 'host/a/b/'), covers('host/a/b/', 'host/a/'), covers('host/a/', 'host/c/'), covers(None, 'host/c/')
+    (True, True, False, True)
+    """
+    return scope is None or scope.startswith(prefix) or prefix.startswith(scope)
+
+# read_indexes :: (oss2.Bucket, str, str) -> Iterator[dict]
+def read_indexes(bucket, pack_dir, prefix=''):
+    """
+    indexes under pack_dir that may hold keys under prefix, keeping only those keys
+    """
+    import oss2
+    for obj in oss2.ObjectIterator(bucket, prefix=pack_dir):
+        if obj.key.endswith('.json') and covers(index_scope(obj.key), prefix):
+            index = json.loads(bucket.get_object(obj.key).read())
+            index['files'] = {key : entry for key, entry in index['files'].items() if key.startswith(prefix)}
+            yield index
+
+class Packer:
+    """
+    group small files into pack objects, every pack is uploaded together with
+    an index object mapping each original key to its offset and length in the pack
+
+    index format:
+        {"pack": <pack key>, "created": <unix time>, "encrypted": false,
+         "files": {<key>: {"offset": int, "length": int, "md5": <base64 md5>}}}
+
+    a file is only done once its pack is, so the outcome of every packed file
+    (whatever its callback returns) is counted in outcomes
+    """
+    def __init__(self, bucket, prefix, pack_size=64 * 1024 * 1024, attempts=4):
+        self.bucket    = bucket
+        self.prefix    = prefix
+        self.pack_size = pack_size
+        self.attempts  = attempts
+        self.lock      = threading.Lock()
+        self.outcomes  = {}
+        self.reset()
+
+    def reset(self):
+        self.chunks    = []
+        self.entries   = {}
+        self.callbacks = []
+        self.size      = 0
+
+    # add :: (str, bytes, Callable[[str], str], Callable[[Exception], str]) -> str
+    def add(self, key, data, on_flush, on_failure):
+        """
+        queue data under key, on_flush is called with its md5 once the pack holding it is uploaded,
+        on_failure with the error if the pack could not be, both return the outcome of the file
+        """
+        md5 = base64.b64encode(hashlib.md5(data).digest()).decode()
+        with self.lock:
+            self.entries[key] = {'offset' : self.size, 'length' : len(data), 'md5' : md5}
+            self.chunks.append(data)
+            self.callbacks.append((lambda : on_flush(md5), on_failure))
+            self.size += len(data)
+            batch = self.take() if self.size >= self.pack_size else None
+        if batch is not None:
+            self.upload(*batch)
+        return md5
+
+    def take(self):
+        batch = (self.chunks, self.entries, self.callbacks)
+        self.reset()
+        return batch
+
+    def upload(self, chunks, entries, callbacks):
+        """
+        transient errors are retried, a pack failing for good fails every file in it
+        """
+        from returns.io     import impure_safe, IOSuccess
+        from returns.unsafe import unsafe_perform_io
+        from retry          import retry
+        stored = retry(lambda : impure_safe(self.put)(chunks, entries), self.attempts)
+        if isinstance(stored, IOSuccess):
+            for on_flush, _ in callbacks:
+                self.tally(on_flush())
+            return
+        error = unsafe_perform_io(stored.failure())
+        print(f'打包上传失败, {len(entries)} 个文件未上传: {error}')
+        for _, on_failure in callbacks:
+            self.tally(on_failure(error))
+
+    # put :: (List[bytes], dict) -> str
+    def put(self, chunks, entries):
+        import uuid
+        name     = self.prefix + uuid.uuid4().hex
+        pack_key = name + '.pack'
+        self.bucket.put_object(pack_key, b''.join(chunks))
+        self.bucket.put_object(index_key(name, entries), json.dumps({
+            'pack'      : pack_key,
+            'created'   : time.time(),
+            'encrypted' : False,
+            'files'     : entries
+        }))
+        print(f'{pack_key} 打包上传成功, 共 {len(entries)} 个文件')
+        return pack_key
+
+    # tally :: str -> None
+    def tally(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    # flush :: () -> dict
+    def flush(self):
+        """
+        upload the last, partial pack and return the outcomes of every packed file
+        """
+        with self.lock:
+            batch = self.take()
+        if batch[1]:
+            self.upload(*batch)
+        return dict(self.outcomes)
@@ -0,0 +1,58 @@
+from md5  import etag_to_md5
+from pack import read_indexes
+
+class RemoteIndex:
+    """
+    in-memory state of every object under a prefix, key -> (md5, size, modified),
+    loaded up front with one paginated listing instead of a HEAD per object
+    """
+    def __init__(self, entries):
+        self.entries = entries
+
+    @classmethod
+    # load :: (oss2.Bucket, str) -> RemoteIndex
+    def load(cls, bucket, prefix, max_keys=1000):
+        import oss2
+        return cls({
+            obj.key : (etag_to_md5(obj.etag), obj.size, obj.last_modified)
+            for obj in oss2.ObjectIterator(bucket, prefix=prefix, max_keys=max_keys)
+        })
+
+    # add_packs :: (oss2.Bucket, str, str) -> RemoteIndex
+    def add_packs(self, bucket, pack_dir, prefix=''):
+        """
+        files under prefix packed into pack objects count as existing, with the md5 and length
+        from the pack indexes, the most recently written copy of a key wins
+        """
+        for index in sorted(read_indexes(bucket, pack_dir, prefix), key=lambda index : index['created']):
+            for key, entry in index['files'].items():
+                if self.entries.get(key, (None, None, 0))[2] <= index['created']:
+                    self.entries[key] = (entry['md5'], entry['length'], index['created'])
+        return self
+
+    def __len__(self):
+        return len(self.entries)
+
+    # exists :: str -> bool
+    def exists(self, key):
+        """
+        >>> index = RemoteIndex({'host/a' : ('XrY7u+Ae7tCTyyK7j1rNww==', 11, 0), 'host/b' : (None, 10, 0)})
+        >>> index.exists('host/a'), index.exists('host/c')
+        (True, False)
+        """
+        return key in self.entries
+
+    # md5 :: str -> Optional[str]
+    def md5(self, key):
+        """
+        None for missing objects and for multipart objects, whose ETag is not an md5
+
+        >>> index = RemoteIndex({'host/a' : ('XrY7u+Ae7tCTyyK7j1rNww==', 11, 0), 'host/b' : (None, 10, 0)})
+        >>> index.md5('host/a'), index.md5('host/b'), index.md5('host/c')
+        ('XrY7u+Ae7tCTyyK7j1rNww==', None, None)
+        """
+        return self.entries.get(key, (None, None, None))[0]
+
+    # size :: str -> Optional[int]
+    def size(self, key):
+        return self.entries.get(key, (None, None, None))[1]
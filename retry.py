@@ -0,0 +1,88 @@
+import time
+import random
+
+from   returns.io      import IOFailure
+from   returns.future  import future_safe
+from   returns.unsafe  import unsafe_perform_io
+
+from   metrics         import REGISTRY
+
+ATTEMPTS = 4
+BASE     = 0.5
+CAP      = 30.0
+
+# retryable :: Any -> bool
+def retryable(error):
+    """
+    failures that may go away by themselves: lost connections, timeouts,
+    throttling and 5xx answers of oss, bodies corrupted in transit
+
+    >>> import oss2
+    >>> retryable(ConnectionResetError()), retryable(FileNotFoundError()), retryable('已存在')
+    (True, False, False)
+    >>> retryable(oss2.exceptions.ServerError(503, {}, b'', {})), retryable(oss2.exceptions.NoSuchKey(404, {}, b'', {}))
+    (True, False)
+    """
+    import oss2
+    if isinstance(error, (oss2.exceptions.RequestError, oss2.exceptions.InconsistentError)):
+        return True
+    if isinstance(error, oss2.exceptions.ServerError):
+        return error.status == 429 or error.status >= 500
+    import asyncio
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError, asyncio.IncompleteReadError))
+
+# backoff :: (int, float, float) -> float
+def backoff(attempt, base=BASE, cap=CAP):
+    """
+    exponential backoff with full jitter, so clients failing together do not retry together
+
+    >>> all(0 <= backoff(attempt) <= min(CAP, BASE * 2 ** attempt) for attempt in range(10))
+    True
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# retry_failure :: IOResultE[a] -> Optional[Exception]
+def retry_failure(ioresult):
+    if not isinstance(ioresult, IOFailure):
+        return None
+    error = unsafe_perform_io(ioresult.failure())
+    return error if retryable(error) else None
+
+# retry :: (Callable[[], IOResultE[a]], int) -> IOResultE[a]
+def retry(thunk, attempts=ATTEMPTS, sleep=time.sleep):
+    """
+    run thunk until it succeeds, fails for good, or `attempts` runs have failed
+
+    >>> from returns.io import IOSuccess
+    >>> results = [IOFailure(ConnectionResetError()), IOFailure(TimeoutError()), IOSuccess('ok')]
+    >>> retry(lambda : results.pop(0), sleep=lambda _ : None)
+    <IOResult: <Success: ok>>
+    >>> retry(lambda : IOFailure(ConnectionResetError('reset')), attempts=2, sleep=lambda _ : None)
+    <IOResult: <Failure: reset>>
+    """
+    for attempt in range(attempts):
+        result = thunk()
+        error  = retry_failure(result)
+        if error is None or attempt == attempts - 1:
+            return result
+        REGISTRY.inc('soss_retries_total', error=type(error).__name__)
+        sleep(backoff(attempt))
+    return result
+
+# retry_async :: (Callable[[], FutureResultE[a]], int) -> FutureResultE[a]
+def retry_async(thunk, attempts=ATTEMPTS):
+    """
+    retry for the asyncio engine, the backoff sleeps without blocking the event loop
+    """
+    import asyncio
+    @future_safe
+    async def attempts_of():
+        for attempt in range(attempts):
+            result = await thunk()
+            error  = retry_failure(result)
+            if error is None or attempt == attempts - 1:
+                return result
+            REGISTRY.inc('soss_retries_total', error=type(error).__name__)
+            await asyncio.sleep(backoff(attempt))
+        return result
+    return attempts_of().bind_ioresult(lambda ioresult : ioresult)
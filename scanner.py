@@ -0,0 +1,98 @@
+import os
+from   pathlib            import Path
+from   concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import REGISTRY
+
+WORKERS = 16
+BATCH   = 4096
+
+class ScannedPath(type(Path())):
+    """
+    a path found by scan, stat() returns the stat taken while scanning
+    instead of asking the filesystem again
+    """
+    def stat(self, *, follow_symlinks=True):
+        scanned = getattr(self, 'scanned_stat', None)
+        if scanned is None or not follow_symlinks:
+            return super().stat(follow_symlinks=follow_symlinks)
+        return scanned
+
+# scanned_path :: (str, os.stat_result) -> ScannedPath
+def scanned_path(path, st):
+    scanned              = ScannedPath(path)
+    scanned.scanned_stat = st
+    return scanned
+
+@REGISTRY.timed('walk')
+# list_directory :: Union[str, os.ScandirIterator] -> Tuple[List[Tuple[str, os.stat_result]], List[str], Optional[os.ScandirIterator]]
+def list_directory(directory, batch=BATCH):
+    """
+    read up to batch entries of a directory, a path or the rest of one already opened,
+    returns its regular files with their stat, its subdirectories, and the open
+    directory if there are more entries, the file type comes from the dirent so only
+    regular files and symlinks are stat'ed, symlinks to directories are not followed
+    and unreadable entries are skipped, like os.walk does
+    """
+    files, directories = [], []
+    try:
+        entries = os.scandir(directory) if isinstance(directory, str) else directory
+    except OSError:
+        REGISTRY.inc('soss_scan_errors_total')
+        return files, directories, None
+    try:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    files.append((entry.path, entry.stat()))
+            except OSError:
+                REGISTRY.inc('soss_scan_errors_total')
+            if len(files) + len(directories) >= batch:
+                return files, directories, entries
+    except OSError:
+        REGISTRY.inc('soss_scan_errors_total')
+    entries.close()
+    return files, directories, None
+
+# scan :: (str, int) -> Iterator[Tuple[str, os.stat_result]]
+def scan(root, workers=WORKERS):
+    """
+    every regular file under root with its stat, directories are listed by `workers`
+    threads at once and files are yielded as soon as their batch is read, in no
+    particular order, at most 2 * workers batches are read ahead of the consumer
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as root:
+    ...     for name in ('a', 'b/c', 'b/d/e'):
+    ...         os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+    ...         with open(os.path.join(root, name), 'w') as f:
+    ...             _ = f.write(name)
+    ...     os.symlink(os.path.join(root, 'b'), os.path.join(root, 'link'))
+    ...     sorted((os.path.relpath(path, root), st.st_size) for path, st in scan(root, workers=2))
+    [('a', 1), ('b/c', 3), ('b/d/e', 5)]
+    """
+    pending = [str(root)]
+    running = set()
+    with ThreadPoolExecutor(workers) as pool:
+        try:
+            while pending or running:
+                while pending and len(running) < 2 * workers:
+                    running.add(pool.submit(list_directory, pending.pop()))
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                batches       = [future.result() for future in done]
+                for _, directories, rest in batches:
+                    pending.extend(directories)
+                    if rest is not None:
+                        pending.append(rest)
+                for files, _, _ in batches:
+                    yield from files
+        finally:
+            # the consumer stopped early, close the directories left open
+            for future in running:
+                if not future.cancel() and future.result()[2] is not None:
+                    future.result()[2].close()
+            for directory in pending:
+                if not isinstance(directory, str):
+                    directory.close()
@@ -0,0 +1,128 @@
+import threading
+from   concurrent.futures import ThreadPoolExecutor
+
+from metrics    import REGISTRY
+from multivalue import MIterator
+
+_STOP = object()
+
+class Scheduler:
+    """
+    run thunks on a fixed pool of reusable worker threads, tasks are pulled
+    lazily from the iterable with at most queue_size of them waiting for a
+    thread, so the producer blocks instead of spinning when the workers are busy
+    """
+    def __init__(self, workers=32, queue_size=None, classify=lambda result : 'completed'):
+        self.workers    = workers
+        self.queue_size = queue_size or workers * 4
+        self.classify   = classify
+        self.lock       = threading.Lock()
+        self.stats      = {}
+        self.waiting    = 0
+
+    def record(self, outcome):
+        REGISTRY.inc('soss_tasks_total', outcome=outcome)
+        with self.lock:
+            self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    def queued(self, task):
+        with self.lock:
+            self.waiting += 1
+        return task
+
+    # attempt :: Callable[[], a] -> str
+    def attempt(self, task):
+        with self.lock:
+            self.waiting -= 1
+        try:
+            return self.classify(task())
+        except Exception as err:
+            print(err)
+            return 'failed'
+
+    # run :: Iterable[Callable[[], a]] -> dict
+    def run(self, iterable):
+        """
+        >>> Scheduler(workers=4).run((lambda : None) for _ in range(10))
+        {'completed': 10}
+        >>> Scheduler(workers=2, classify=lambda n : 'even' if n % 2 == 0 else 'odd').run(
+        ...     (lambda n=n : n) for n in range(5)
+        ... ) == {'even': 3, 'odd': 2}
+        True
+        """
+        self.stats, self.waiting = {}, 0
+        REGISTRY.gauge('soss_queue_depth', lambda : self.waiting)
+        pool = ThreadPoolExecutor(self.workers)
+        try:
+            outcomes = MIterator(iterable).map(self.queued).par_map(
+                self.attempt, pool, self.workers + self.queue_size
+            )
+            for outcome in outcomes:
+                self.record(outcome)
+        finally:
+            # on an interrupt the running tasks finish, the waiting ones are dropped
+            pool.shutdown(cancel_futures=True)
+            REGISTRY.gauge('soss_queue_depth', None)
+        return dict(self.stats)
+
+class AsyncScheduler(Scheduler):
+    """
+    the same contract as Scheduler for tasks returning awaitables, `workers`
+    coroutines on one event loop run the tasks, tasks may come from an async iterable
+    """
+    async def work_async(self, tasks):
+        while True:
+            task = await tasks.get()
+            if task is _STOP:
+                return
+            try:
+                outcome = self.classify(await task())
+            except Exception as err:
+                print(err)
+                outcome = 'failed'
+            self.record(outcome)
+
+    # run_async :: Union[Iterable, AsyncIterable][Callable[[], Awaitable[a]]] -> Awaitable[dict]
+    async def run_async(self, iterable):
+        import asyncio
+        self.stats = {}
+        tasks      = asyncio.Queue(self.queue_size)
+        workers    = [asyncio.create_task(self.work_async(tasks)) for _ in range(self.workers)]
+        REGISTRY.gauge('soss_queue_depth', tasks.qsize)
+        try:
+            if hasattr(iterable, '__aiter__'):
+                async for task in iterable:
+                    await tasks.put(task)
+            else:
+                # the iterable may block, e.g. on a directory walk, it is pulled from on
+                # a thread so that the requests in flight keep going meanwhile
+                loop     = asyncio.get_running_loop()
+                iterator = iter(iterable)
+                while (task := await loop.run_in_executor(None, next, iterator, _STOP)) is not _STOP:
+                    await tasks.put(task)
+            for _ in workers:
+                await tasks.put(_STOP)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            REGISTRY.gauge('soss_queue_depth', None)
+        return dict(self.stats)
+
+    # run :: Union[Iterable, AsyncIterable][Callable[[], Awaitable[a]]] -> dict
+    def run(self, iterable):
+        """
+        >>> import asyncio
+        >>> async def task(n):
+        ...     await asyncio.sleep(0.01)
+        ...     return n
+        >>> AsyncScheduler(workers=1000).run((lambda n=n : task(n)) for n in range(5000))
+        {'completed': 5000}
+        >>> AsyncScheduler(workers=2, classify=lambda n : 'even' if n % 2 == 0 else 'odd').run(
+        ...     (lambda n=n : task(n)) for n in range(5)
+        ... ) == {'even': 3, 'odd': 2}
+        True
+        """
+        # asyncio is only imported by the asyncio engine, it is slow to import
+        import asyncio
+        return asyncio.run(self.run_async(iterable))
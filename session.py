@@ -0,0 +1,48 @@
+import time
+
+import oss2
+
+from metrics    import REGISTRY, body_size
+from congestion import SHAPER
+
+class MeteredSession(oss2.Session):
+    """
+    oss2 session recording the latency, count and bytes of every request into REGISTRY
+    """
+    def do_request(self, req, timeout):
+        REGISTRY.inc('soss_bytes_total', body_size(req.data), direction='up')
+        start = time.perf_counter()
+        try:
+            resp = super().do_request(req, timeout)
+        except Exception:
+            REGISTRY.inc('soss_requests_total', method=req.method, status='error')
+            raise
+        finally:
+            REGISTRY.observe('soss_request_seconds', time.perf_counter() - start, method=req.method)
+        REGISTRY.inc('soss_requests_total', method=req.method, status=resp.status)
+        if req.method != 'HEAD':
+            REGISTRY.inc('soss_bytes_total', int(resp.headers.get('Content-Length', 0)), direction='down')
+        return resp
+
+class ShapedBucket(oss2.Bucket):
+    """
+    oss2 bucket whose requests wait for SHAPER before oss2 signs them, a Date signed
+    before a long wait could be rejected as RequestTimeTooSkewed; the slot is held
+    until the response headers arrive, bodies are paced as they are read
+    """
+    def _do(self, method, bucket_name, key, **kwargs):
+        data = kwargs.get('data')
+        SHAPER.pace(data)
+        start  = SHAPER.acquire()
+        status = 'error'
+        try:
+            resp   = super()._do(method, bucket_name, key, **kwargs)
+            status = resp.status
+        except oss2.exceptions.ServerError as err:
+            status = err.status
+            raise
+        finally:
+            SHAPER.release(start, method, body_size(data), status)
+        if method != 'HEAD':
+            SHAPER.pace(resp)
+        return resp
@@ -1,25 +1,47 @@
 import argparse
+import contextlib
 import hashlib
+import io
 import json
 import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import oss2
-from Crypto.Cipher    import AES
-from Crypto.Random    import get_random_bytes
-from oss2.credentials import EnvironmentVariableCredentialsProvider
+# oss2, Crypto, asyncio and sqlite3 take most of the startup time of a short run,
+# they are imported by the methods using them, so that e.g. list does not load
+# the cipher and --help loads none of them
+from compression      import CODECS, CompressingReader, DecompressingWriter, choose_codec, compress_body, compression_headers, stored_codec
+from multipart        import MB, parse_range, parse_size, upload_multipart
+from metrics          import REGISTRY, add_arguments as add_metrics_arguments, start_writer
+from congestion       import add_arguments as add_congestion_arguments, configure as configure_congestion
+from scanner          import scan, WORKERS as SCAN_WORKERS
+
+# sidecar of --incremental in the output directory
+RESTORE_MANIFEST = '.soss-restore.db'
 
 
 class OssClientBase:
     def auth(self):
+        import oss2
+        from oss2.credentials import EnvironmentVariableCredentialsProvider
         return oss2.ProviderAuth(EnvironmentVariableCredentialsProvider())
 
     def normalize_endpoint(self, endpoint):
+        if '://' in endpoint:
+            return endpoint
         if 'oss' not in endpoint:
             endpoint = 'oss-' + endpoint
         if '.' not in endpoint:
             endpoint += '.aliyuncs.com'
         return endpoint
 
+    def make_bucket(self, pool_size=None):
+        from session import MeteredSession, ShapedBucket
+        return ShapedBucket(self.auth(), self.endpoint, self.bucket, session=MeteredSession(pool_size=pool_size))
+
     def get_encrypt_key(self, key):
         if len(key) in (32, 64):
             try:
@@ -29,93 +51,361 @@ class OssClientBase:
         return hashlib.sha256(key.encode('utf-8')).digest()
 
 class Uploader(OssClientBase):
-    def __init__(self, endpoint, bucket, prefix, files, encrypt_key):
+    def __init__(self, endpoint, bucket, prefix, files, encrypt_key,
+                 multipart_threshold=64 * MB, part_size=16 * MB, part_workers=4, scan_workers=SCAN_WORKERS,
+                 compression=None, cipher='ctr', cipher_workers=os.cpu_count()):
         self.endpoint = self.normalize_endpoint(endpoint)
         self.bucket = bucket
         self.prefix = prefix
         self.files  = files
         self.encrypt_key = self.get_encrypt_key(encrypt_key)
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        self.scan_workers = scan_workers
+        self.compression = compression
+        self.cipher = cipher
+        self.cipher_workers = cipher_workers
 
     def collect_files(self, files):
-        ret = []
         for file in files:
             if not os.path.exists(file):
                 raise ValueError(f'File {file} does not exist')
+        return self.scan_files(files)
+
+    def scan_files(self, files):
+        # the first upload starts while the rest of the directories are still being scanned
+        for file in files:
             if os.path.isdir(file):
-                for root, _, filenames in os.walk(file):
-                    for filename in filenames:
-                        filepath = os.path.join(root, filename)
-                        key = os.path.relpath(filepath, file)
-                        ret.append((filepath, key))
+                for filepath, st in scan(file, self.scan_workers):
+                    yield filepath, os.path.relpath(filepath, file), st.st_size
             else:
-                ret.append((file, os.path.basename(file)))
-        return ret
+                yield file, os.path.basename(file), os.path.getsize(file)
 
     def upload(self):
         file_data = self.collect_files(self.files)
-        bucket    = oss2.Bucket(self.auth(), self.endpoint, self.bucket)
+        bucket    = self.make_bucket(pool_size=self.part_workers)
         choice    = None
 
-        for file, key in file_data:
-            key = self.prefix + key
-            if bucket.object_exists(key):
-                while choice != 'a':
-                    choice = input(f'File {key} already exists, select an action: [o]verwrite, [s]kip, [a]lways overwrite, [q]uit: ')
-                    if choice in ('o', 's', 'a', 'q'):
-                        break
-                if choice == 's':
-                    continue
-                if choice == 'q':
-                    return
+        with ThreadPoolExecutor(self.cipher_workers) as self.cipher_pool:
+            for file, key, size in file_data:
+                key = self.prefix + key
+                with REGISTRY.timer('soss_stage_seconds', stage='exists'):
+                    exists = bucket.object_exists(key)
+                if exists:
+                    while choice != 'a':
+                        choice = input(f'File {key} already exists, select an action: [o]verwrite, [s]kip, [a]lways overwrite, [q]uit: ')
+                        if choice in ('o', 's', 'a', 'q'):
+                            break
+                    if choice == 's':
+                        continue
+                    if choice == 'q':
+                        return
+                self.upload_one(bucket, file, key, size)
 
-            with open(file, 'rb') as f:
-                data = f.read()
-                print(f'Uploading {file} to {self.bucket}:{key} with {len(data)} bytes')
-                bucket.put_object(key, self.encrypt(data))
+    def encrypting_reader(self, source, size):
+        from cipher import EncryptingReader, SegmentEncryptingReader
+        if self.cipher == 'gcm':
+            return SegmentEncryptingReader(source, self.encrypt_key, size, pool=self.cipher_pool, in_flight=2 * self.cipher_workers)
+        return EncryptingReader(source, self.encrypt_key, size)
 
-    def encrypt(self, data):
-        nonce = get_random_bytes(8)
-        cipher = AES.new(self.encrypt_key, AES.MODE_CTR, nonce=nonce)
-        enc_data = cipher.encrypt(data)
-        return cipher.nonce + enc_data
+    @REGISTRY.timed('upload')
+    def upload_one(self, bucket, file, key, size):
+        from cipher import cipher_headers
+        with open(file, 'rb') as f:
+            # compressed before encryption, ciphertext does not compress
+            codec = choose_codec(self.compression, f)
+            headers = dict(compression_headers(codec), **cipher_headers(self.cipher))
+            if size >= self.multipart_threshold:
+                source = f if codec is None else CompressingReader(f, codec)
+                stream = self.encrypting_reader(source, size if codec is None else None)
+                print(f'Uploading {file} to {self.bucket}:{key} with {size} bytes in {self.part_size} byte parts')
+                upload_multipart(bucket, key, stream, self.part_size, self.part_workers, headers)
+            else:
+                source, length = f, size
+                if codec is not None:
+                    body, compressed = compress_body(f.read(), codec)
+                    source, length   = io.BytesIO(body), len(body)
+                    headers          = dict(compressed, **cipher_headers(self.cipher))
+                stream = self.encrypting_reader(source, length)
+                print(f'Uploading {file} to {self.bucket}:{key} with {size} bytes'
+                      + (f', {length} bytes compressed with {codec}' if length != size else ''))
+                bucket.put_object(key, stream, headers=headers)
 
 
 class Downloader(OssClientBase):
-    def __init__(self, endpoint, bucket, files, output_dir, encrypt_key):
+    def __init__(self, endpoint, bucket, files, output_dir, encrypt_key, workers=8,
+                 engine='threads', connections=256, cipher_workers=os.cpu_count(), byte_range=None, incremental=False):
         self.endpoint = self.normalize_endpoint(endpoint)
         self.bucket = bucket
         self.output_dir = output_dir
         self.files = files
         self.encrypt_key = self.get_encrypt_key(encrypt_key)
+        self.workers = workers
+        self.engine = engine
+        self.connections = connections
+        self.cipher_workers = cipher_workers
+        self.byte_range = byte_range
+        self.incremental = incremental
+        self.manifest = None
+        self.lock = threading.Lock()
+        self.dirs = set()
+        self.downloaded_bytes = 0
+        self.skipped = 0
 
-    def download(self):
-        bucket = oss2.Bucket(self.auth(), self.endpoint, self.bucket)
+    def make_dirs(self, path):
+        directory = os.path.dirname(path)
+        with self.lock:
+            if directory not in self.dirs:
+                os.makedirs(directory, exist_ok=True)
+                self.dirs.add(directory)
+
+    def restored(self, key, etag, size, modified):
+        # listed exactly as when it was restored, into a file nobody touched since
+        if self.manifest is None:
+            return False
+        if not self.manifest.unchanged(self.bucket, key, etag, size, modified, os.path.join(self.output_dir, key)):
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def remember(self, key, etag, size, modified):
+        if self.manifest is not None:
+            self.manifest.record(self.bucket, key, etag, size, modified, os.path.join(self.output_dir, key))
+
+    @REGISTRY.timed('download')
+    def download_one(self, bucket, obj):
+        from cipher import decrypt_segments, decrypt_stream, stored_cipher
+        from dedup import is_recipe, restore
+        path = os.path.join(self.output_dir, obj.key)
+        print(f'Downloading {obj.key} to {path}')
+        self.make_dirs(path)
+        data = bucket.get_object(obj.key)
+        with open(path, 'wb') as f:
+            if is_recipe(data.headers):
+                size = restore(bucket, json.loads(data.read()), f, self.chunk_pool)
+            else:
+                codec = stored_codec(data.headers)
+                out = f if codec is None else DecompressingWriter(f, codec)
+                if stored_cipher(data.headers) == 'gcm':
+                    decrypt_segments(data, self.encrypt_key, out, self.cipher_pool, 2 * self.cipher_workers)
+                else:
+                    decrypt_stream(data, self.encrypt_key, out)
+                out.flush()
+                # the bytes restored on disk, whether the object was compressed or not
+                size = f.tell()
+        self.remember(obj.key, obj.etag, obj.size, obj.last_modified)
+        with self.lock:
+            self.downloaded_bytes += size
+
+    @REGISTRY.timed('download')
+    async def download_one_async(self, abucket, obj):
+        from cipher import make_decryptor, stored_cipher
+        from dedup import is_recipe, restore_async
+        path = os.path.join(self.output_dir, obj.key)
+        print(f'Downloading {obj.key} to {path}')
+        self.make_dirs(path)
+        recipe = None
+        async with abucket.get_object(obj.key) as response:
+            if is_recipe(response.headers):
+                recipe = json.loads(await response.read())
+            else:
+                decryptor = make_decryptor(self.encrypt_key, stored_cipher(response.headers))
+                codec = stored_codec(response.headers)
+                with open(path, 'wb') as f:
+                    out = f if codec is None else DecompressingWriter(f, codec)
+                    async for data in response.iter_chunks():
+                        out.write(decryptor.update(data))
+                    out.write(decryptor.flush())
+                    out.flush()
+                    size = f.tell()
+        # chunks are fetched once the recipe request has given its connection back
+        if recipe is not None:
+            with open(path, 'wb') as f:
+                size = await restore_async(abucket, recipe, f)
+        self.remember(obj.key, obj.etag, obj.size, obj.last_modified)
+        with self.lock:
+            self.downloaded_bytes += size
+
+    @REGISTRY.timed('download')
+    def download_range_one(self, bucket, key):
+        from cipher import open_range
+        start, end = self.byte_range
+        path = os.path.join(self.output_dir, key)
+        print(f'Downloading bytes {start}-{"" if end is None else end} of {key} to {path}')
+        # the key, its format and the range are checked before any file is created,
+        # and the range is written aside, so a failure never leaves a file at path
+        write = open_range(bucket, key, self.encrypt_key, start, end)
+        self.make_dirs(path)
+        partial = path + '.part'
+        try:
+            with open(partial, 'wb') as f:
+                size = write(f, self.cipher_pool, 2 * self.cipher_workers)
+            os.replace(partial, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial)
+            raise
+        with self.lock:
+            self.downloaded_bytes += size
+
+    def packed_files(self, bucket, prefix):
+        from pack import pack_prefixes, read_indexes
+        packed = {}
+        indexes = [index for pack_dir in pack_prefixes(bucket, prefix) for index in read_indexes(bucket, pack_dir, prefix)]
+        for index in sorted(indexes, key=lambda index: index['created']):
+            for key, entry in index['files'].items():
+                packed[key] = (index, entry)
+        return packed
+
+    @REGISTRY.timed('extract')
+    def extract_one(self, bucket, key, index, entry):
+        from cipher import decrypt_stream
+        path = os.path.join(self.output_dir, key)
+        print(f'Extracting {key} from {index["pack"]} to {path}')
+        self.make_dirs(path)
+        with open(path, 'wb') as f:
+            if entry['length'] > 0:
+                offset = entry['offset']
+                data = bucket.get_object(index['pack'], byte_range=(offset, offset + entry['length'] - 1))
+                if index['encrypted']:
+                    decrypt_stream(data, self.encrypt_key, f)
+                else:
+                    shutil.copyfileobj(data, f)
+        self.remember(key, index['pack'], entry['length'], index['created'])
+        with self.lock:
+            self.downloaded_bytes += entry['length']
+
+    @REGISTRY.timed('extract')
+    async def extract_one_async(self, abucket, key, index, entry):
+        from cipher import Decryptor
+        path = os.path.join(self.output_dir, key)
+        print(f'Extracting {key} from {index["pack"]} to {path}')
+        self.make_dirs(path)
+        with open(path, 'wb') as f:
+            if entry['length'] > 0:
+                offset = entry['offset']
+                decryptor = Decryptor(self.encrypt_key) if index['encrypted'] else None
+                async with abucket.get_object(index['pack'], (offset, offset + entry['length'] - 1)) as response:
+                    async for data in response.iter_chunks():
+                        f.write(data if decryptor is None else decryptor.update(data))
+        self.remember(key, index['pack'], entry['length'], index['created'])
+        with self.lock:
+            self.downloaded_bytes += entry['length']
+
+    def wanted(self, obj, packed):
+        from pack import is_pack_key
+        from dedup import CHUNK_DIR
+        if is_pack_key(obj.key) or obj.key.startswith(CHUNK_DIR):
+            return False
+        # a packed copy written after the object replaces it
+        if obj.key in packed and packed[obj.key][0]['created'] > obj.last_modified:
+            return False
+        packed.pop(obj.key, None)
+        return True
+
+    def tasks(self, bucket):
+        import oss2
+        if self.byte_range is not None:
+            # the files are the keys of the objects to read the range of
+            for key in self.files:
+                yield lambda key=key: self.download_range_one(bucket, key)
+            return
         for file in self.files:
+            packed = self.packed_files(bucket, file)
             for obj in oss2.ObjectIterator(bucket, prefix=file):
-                data = bucket.get_object(obj.key)
-                path = os.path.join(self.output_dir, obj.key)
-                print(f'Downloading {obj.key} to {path}')
-                if not os.path.exists(path):
-                    os.makedirs(os.path.dirname(path), exist_ok=True)
-                with open(path, 'wb') as f:
-                    f.write(self.decrypt(data.read()))
+                if self.wanted(obj, packed) and not self.restored(obj.key, obj.etag, obj.size, obj.last_modified):
+                    yield lambda obj=obj: self.download_one(bucket, obj)
+            for key, (index, entry) in packed.items():
+                if self.restored(key, index['pack'], entry['length'], index['created']):
+                    continue
+                yield lambda key=key, index=index, entry=entry: self.extract_one(bucket, key, index, entry)
 
-    def decrypt(self, data):
-        nonce = data[:8]
-        cipher = AES.new(self.encrypt_key, AES.MODE_CTR, nonce=nonce)
-        return cipher.decrypt(data[8:])
+    async def tasks_async(self, bucket, abucket):
+        import asyncio
+        for file in self.files:
+            packed = await asyncio.to_thread(self.packed_files, bucket, file)
+            async for obj in abucket.iterate(file):
+                if self.wanted(obj, packed) and not self.restored(obj.key, obj.etag, obj.size, obj.last_modified):
+                    yield lambda obj=obj: self.download_one_async(abucket, obj)
+            for key, (index, entry) in packed.items():
+                if self.restored(key, index['pack'], entry['length'], index['created']):
+                    continue
+                yield lambda key=key, index=index, entry=entry: self.extract_one_async(abucket, key, index, entry)
+
+    def download(self):
+        from scheduler import Scheduler, AsyncScheduler
+        bucket = self.make_bucket(pool_size=self.workers)
+        start = time.monotonic()
+        if self.incremental and self.byte_range is None:
+            from manifest import RestoreManifest
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.manifest = RestoreManifest(os.path.join(self.output_dir, RESTORE_MANIFEST))
+        try:
+            if self.engine == 'asyncio' and self.byte_range is None:
+                from aio import AsyncBucket
+                stats = AsyncScheduler(self.workers).run(self.tasks_async(bucket, AsyncBucket(bucket, self.connections)))
+            else:
+                with ThreadPoolExecutor(self.workers) as self.chunk_pool, ThreadPoolExecutor(self.cipher_workers) as self.cipher_pool:
+                    stats = Scheduler(self.workers).run(self.tasks(bucket))
+        finally:
+            if self.manifest is not None:
+                self.manifest.close()
+        elapsed = max(time.monotonic() - start, 1e-6)
+        count = stats.get('completed', 0)
+        megabytes = self.downloaded_bytes / MB
+        print(f'Downloaded {count} objects ({megabytes:.1f} MB) in {elapsed:.1f}s, '
+              f'{count / elapsed:.1f} objects/s, {megabytes / elapsed:.1f} MB/s, '
+              f'{stats.get("failed", 0)} failed' + (f', {self.skipped} unchanged skipped' if self.incremental else ''))
 
 
 class Lister(OssClientBase):
-    def __init__(self, endpoint, bucket, prefix):
+    def __init__(self, endpoint, bucket, prefix, cache=None, refresh='incremental', summary=False):
         self.endpoint = self.normalize_endpoint(endpoint)
         self.bucket = bucket
         self.prefix = prefix
+        self.cache = cache
+        self.refresh = refresh
+        self.summary = summary
 
     def list(self):
-        bucket = oss2.Bucket(self.auth(), self.endpoint, self.bucket)
-        for obj in oss2.ObjectIterator(bucket, prefix=self.prefix):
-            print(obj.key)
+        if self.cache is None:
+            import oss2
+            bucket = self.make_bucket()
+            objects = REGISTRY.timed_iter('list', oss2.ObjectIterator(bucket, prefix=self.prefix, max_keys=1000))
+            if self.summary:
+                count, size = 0, 0
+                for obj in objects:
+                    count, size = count + 1, size + obj.size
+                print(f'{count} objects, {size} bytes')
+            else:
+                self.write_keys(obj.key for obj in objects)
+            return
+        from listing import ListingCache
+        cache = ListingCache(self.cache)
+        try:
+            if self.refresh != 'none':
+                listed = cache.refresh(self.make_bucket(), self.prefix, full=self.refresh == 'full')
+                print(f'Refreshed {self.cache} with {listed} keys listed from {self.bucket}:{self.prefix}', file=sys.stderr)
+            if self.summary:
+                count, size = cache.summary(self.bucket, self.prefix)
+                print(f'{count} objects, {size} bytes')
+            else:
+                self.write_keys(key for key, _, _, _ in cache.keys(self.bucket, self.prefix))
+        finally:
+            cache.close()
+
+    def write_keys(self, keys, batch=1000):
+        # one write per batch, millions of print calls take longer than the listing
+        lines = []
+        for key in keys:
+            lines.append(key)
+            if len(lines) == batch:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                lines = []
+        if lines:
+            sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def parse():
@@ -133,6 +423,13 @@ def parse():
     upload_parser.add_argument('--bucket', '-b', help='bucket to upload to', default=config.get('bucket'))
     upload_parser.add_argument('--prefix', help='prefix to add to the file name', default='')
     upload_parser.add_argument('--encrypt_key', '-k', help='encryption key', required=True)
+    upload_parser.add_argument('--multipart_threshold', help='files at least this large are uploaded in parts, e.g. 64M', type=parse_size, default=64 * MB)
+    upload_parser.add_argument('--part_size', help='size of each part of a multipart upload, e.g. 16M', type=parse_size, default=16 * MB)
+    upload_parser.add_argument('--part_workers', help='number of parts uploaded concurrently', type=int, default=4)
+    upload_parser.add_argument('--compress', help='compress compressible files with this codec before encrypting them', choices=sorted(CODECS), default=None)
+    upload_parser.add_argument('--cipher', help='ctr: one AES-CTR stream, gcm: segments encrypted and authenticated with AES-GCM in parallel, both are downloaded alike', choices=('ctr', 'gcm'), default='ctr')
+    upload_parser.add_argument('--cipher_workers', help='threads encrypting the segments of --cipher gcm', type=int, default=os.cpu_count())
+    upload_parser.add_argument('--scan_workers', help='directories listed concurrently while scanning', type=int, default=SCAN_WORKERS)
 
     download_parser = subparsers.add_parser('download')
     download_parser.add_argument('files', nargs='+', help='file to download')
@@ -140,25 +437,45 @@ def parse():
     download_parser.add_argument('--bucket', '-b', help='bucket to download from', default=config.get('bucket'))
     download_parser.add_argument('--output_dir', help='output directory', default='./downloads')
     download_parser.add_argument('--encrypt_key', '-k', help='encryption key', required=True)
+    download_parser.add_argument('--workers', '-w', help='number of objects downloaded concurrently', type=int, default=8)
+    download_parser.add_argument('--engine', help='download on worker threads or on one asyncio event loop', choices=('threads', 'asyncio'), default='threads')
+    download_parser.add_argument('--connections', help='size of the connection pool shared by --engine asyncio', type=int, default=256)
+    download_parser.add_argument('--range', help='only bytes START-END (inclusive, END may be left out) of each given key, e.g. 10M-20M, read with ranged gets', type=parse_range, default=None)
+    download_parser.add_argument('--incremental', help=f'record restored objects in {RESTORE_MANIFEST} in the output directory and skip those listed unchanged since', action='store_true')
+    download_parser.add_argument('--cipher_workers', help='threads decrypting the segments of objects uploaded with --cipher gcm', type=int, default=os.cpu_count())
 
     list_parser = subparsers.add_parser('list')
     list_parser.add_argument('--endpoint', '-e', help='endpoint to upload to', default=config.get('endpoint'))
     list_parser.add_argument('--bucket', '-b', help='bucket to list', default=config.get('bucket'))
     list_parser.add_argument('--prefix', help='object prefix to list', default='')
+    list_parser.add_argument('--cache', help='sqlite file keeping a local copy of the listing, answered from locally after a refresh', default=None)
+    list_parser.add_argument('--refresh', help='with --cache, list only the keys after the last one seen, everything again, or nothing', choices=('incremental', 'full', 'none'), default='incremental')
+    list_parser.add_argument('--summary', help='print the number and total size of the objects instead of their keys', action='store_true')
+
+    for subparser in (upload_parser, download_parser, list_parser):
+        add_metrics_arguments(subparser, '_')
+    for subparser in (upload_parser, download_parser):
+        add_congestion_arguments(subparser, '_')
 
     return parser.parse_args()
 
 
 def main():
     options = parse()
+    start_writer(options)
     if options.command == 'upload':
-        uploader = Uploader(options.endpoint, options.bucket, options.prefix, options.files, options.encrypt_key)
+        configure_congestion(options, options.part_workers)
+        uploader = Uploader(options.endpoint, options.bucket, options.prefix, options.files, options.encrypt_key,
+                            options.multipart_threshold, options.part_size, options.part_workers, options.scan_workers,
+                            options.compress, options.cipher, options.cipher_workers)
         uploader.upload()
     elif options.command == 'download':
-        downloader = Downloader(options.endpoint, options.bucket, options.files, options.output_dir, options.encrypt_key)
+        configure_congestion(options, min(options.workers, options.connections) if options.engine == 'asyncio' else options.workers)
+        downloader = Downloader(options.endpoint, options.bucket, options.files, options.output_dir, options.encrypt_key,
+                                options.workers, options.engine, options.connections, options.cipher_workers, options.range, options.incremental)
         downloader.download()
     elif options.command == 'list':
-        lister = Lister(options.endpoint, options.bucket, options.prefix)
+        lister = Lister(options.endpoint, options.bucket, options.prefix, options.cache, options.refresh, options.summary)
         lister.list()
     else:
         assert False, 'Unknown command'
@@ -2,32 +2,40 @@
 import os
 import stat
 import json
-import uuid
-import socket
+import atexit
+import getpass
 import argparse
-import threading
 from   pathlib   import Path, PurePath
-
-import oss2
-from   oss2.credentials import EnvironmentVariableCredentialsProvider
-from   oss2.utils       import content_md5
-from   oss2.compat      import to_bytes
+from   concurrent.futures import ThreadPoolExecutor
 
 import returns.pointfree  as     pointfree
 import returns.methods    as     methods
 from   returns.pointfree  import map_,      bind, lash
 from   returns.io         import IOResultE, impure,       impure_safe,   IOFailure,      IOSuccess, IOResult
+from   returns.future     import FutureResultE, future_safe
 from   returns.context    import Reader,    ReaderResult, ReaderResultE, ReaderIOResultE
-from   returns.result     import safe,      ResultE,      Failure,       Result
+from   returns.result     import safe,      ResultE,      Failure,       Result, Success
 from   returns.pipeline   import flow,      pipe
 from   returns.iterables  import Fold
 from   returns.curry      import curry
 from   returns.converters import flatten
+from   returns.unsafe     import unsafe_perform_io
 # from viztracer          import VizTracer
 
 from   ListHelper         import lmap,      lfilter,   concat, ljoin
 from   multivalue         import MIterator, MultiValue
-from   md5                import calculate_md5 as get_local_md5
+from   md5                import content_md5, etag_to_md5, HashingReader, file_md5, calculate_md5_many
+from   remote_index       import RemoteIndex
+from   multipart          import MB, COPY_LIMIT, parse_size, upload_multipart
+from   pack               import Packer, pack_prefix
+from   dedup              import ChunkStore, RECIPE_FORMAT
+from   scheduler          import Scheduler, AsyncScheduler
+from   journal            import Journal
+from   retry              import retry, retry_async
+from   scanner            import scan, scanned_path, WORKERS as SCAN_WORKERS
+from   metrics            import REGISTRY, add_arguments as add_metrics_arguments, start_writer
+from   congestion         import add_arguments as add_congestion_arguments, configure as configure_congestion
+from   compression        import CODECS as COMPRESSION_CODECS, CompressingReader, choose_codec, compress_body, compression_headers, stored_codec
 
 def ioresult_sequence(ioresult):
     if isinstance(ioresult, IOFailure):
@@ -70,6 +78,7 @@ def parse_json_ioresult(string):
 
 # str -> Reader[IOResultE[str], bucket]
 def key_exists(key):
+    @REGISTRY.timed('exists')
     @impure_safe
     # with_bucket bucket -> bool
     def with_bucket(bucket):
@@ -77,30 +86,55 @@ def key_exists(key):
         return bucket.object_exists(key)
     return Reader(with_bucket)
 
+# remote_exists :: str -> Reader[IOResultE[bool]]
+def remote_exists(key):
+    """
+    answer from the prefetched remote index if there is one, otherwise ask oss,
+    files packed into pack objects only exist in the pack indexes
+    """
+    def with_env(env):
+        if env['remote'] is not None:
+            return IOSuccess(env['remote'].exists(key))
+        if env['packed'] is not None and env['packed'].exists(key):
+            return IOSuccess(True)
+        return key_exists(key)(env['bucket'])
+    return Reader(with_env)
+
 @curry
-# upload_data :: (str, Union[str, byte]) -> Reader[IOResultE[Union[str, byte]]]
+# upload_data :: (str, Union[str, byte]) -> Reader[IOResultE[oss2.models.PutObjectResult]]
 def upload_data(key, data):
     @impure_safe
     def with_bucket(bucket):
         put_result = bucket.put_object(key, data)
         print(f'{key} 上传成功')
-        return f'{key} 上传成功'
+        return put_result
+    return Reader(with_bucket)
+
+# upload_body :: (str, bytes, dict) -> Reader[IOResultE[oss2.models.PutObjectResult]]
+def upload_body(key, body, headers):
+    @impure_safe
+    def with_bucket(bucket):
+        put_result = bucket.put_object(key, body, headers=dict(headers, **{'Content-MD5' : content_md5(body)}))
+        print(f'{key} 上传成功')
+        return put_result
     return Reader(with_bucket)
 
 @impure_safe
 # get_uuid :: () -> IOResultE[str]
 def get_uuid():
+    import uuid
     return str(uuid.UUID(int=uuid.getnode()))
 
 @impure_safe
 # get_hostname :: () -> IOResultE[str]
 def get_hostname():
+    import socket
     return socket.gethostname()
 
 @impure_safe
 # get_username :: () -> IOResultE[str]
 def get_username():
-    return os.getlogin()
+    return getpass.getuser()
 
 # get_identifier :: () -> IOResultE[dict]
 def get_identifier():
@@ -136,12 +170,104 @@ def nt_get_key(path):
         return identifier['hostname'] + '/' + validate_key(path)
     return Reader(with_identifier)
 
-# upload_one :: str -> Reader[IOResultE[str]]
-def upload_one(file_path):
+@curry
+# upload_parts :: (str, str, dict) -> Reader[IOResultE[oss2.models.PutObjectResult]]
+def upload_parts(key, file_path, headers):
+    @impure_safe
+    def with_env(env):
+        with open(file_path, 'rb') as f:
+            codec      = choose_codec(env['compression'], f)
+            stream     = f if codec is None else CompressingReader(f, codec)
+            put_result = upload_multipart(
+                env['bucket'], key, stream, env['multipart']['part_size'], env['multipart']['workers'],
+                dict(headers, **compression_headers(codec))
+            )
+        print(f'{key} 分片上传成功')
+        return put_result
+    return Reader(with_env)
+
+# upload_large :: str -> Reader[IOResultE[str]]
+def upload_large(file_path):
+    """
+    the ETag of a multipart object is not an md5, so the md5 is computed up front
+    and kept in the object meta for later integrity checks
+    """
+    # with_env :: dict -> IOResultE[str]
+    def with_env(env):
+        return IOResultE.do(
+            local_md5
+            for local_md5  in file_md5(file_path)
+            for put_result in upload_parts(env['key'], file_path, {'x-oss-meta-content-md5' : local_md5})(env)
+        )
+    return Reader(with_env)
+
+# headers kept when the meta of an object is replaced
+KEPT_HEADERS = ('content-type', 'content-encoding', 'content-disposition', 'content-language', 'cache-control', 'expires')
+
+# add_object_meta :: (oss2.Bucket, str, dict) -> oss2.models.PutObjectResult
+def add_object_meta(bucket, key, headers):
+    """
+    update_object_meta replaces the whole meta, so the headers already there are merged in
+    """
+    current = bucket.head_object(key).headers
+    merged  = {
+        name : value for name, value in current.items()
+        if name.lower() in KEPT_HEADERS or name.lower().startswith('x-oss-meta-')
+    }
+    return bucket.update_object_meta(key, dict(merged, **headers))
+
+# upload_hashing :: (str, os.stat_result) -> Reader[IOResultE[str]]
+def upload_hashing(file_path, st):
+    """
+    read the file only once, computing its md5 while it is uploaded,
+    a Content-Md5 header would need the md5 before the body is sent,
+    so a single put is verified against the md5 oss reports as its ETag instead,
+    a multipart object gets the md5 in its meta afterwards by copying it onto itself
+    """
+    @impure_safe
+    def with_env(env):
+        key = env['key']
+        with open(file_path, 'rb') as f:
+            stream = HashingReader(f, st.st_size)
+            if st.st_size >= env['multipart']['threshold']:
+                upload_multipart(env['bucket'], key, stream, env['multipart']['part_size'], env['multipart']['workers'])
+                add_object_meta(env['bucket'], key, {'x-oss-meta-content-md5' : stream.md5()})
+            elif etag_to_md5(env['bucket'].put_object(key, stream).etag) != stream.md5():
+                raise ValueError(f'{key} md5校验失败')
+        print(f'{key} 上传成功')
+        return stream.md5()
+    return Reader(with_env)
+
+# upload_compressed :: str -> Reader[IOResultE[str]]
+def upload_compressed(file_path):
+    """
+    a small file is compressed in memory, its ETag is then the md5 of the compressed
+    body, so the md5 of the file is returned from the meta
+    """
     # with_env :: dict -> IOResultE[str]
     def with_env(env):
+        return read_data(file_path).bind(
+            lambda data : upload_body(env['key'], *compress_body(data, env['compression']))(env['bucket']).map(
+                lambda _ : content_md5(data)
+            )
+        )
+    return Reader(with_env)
+
+# upload_one :: (str, os.stat_result) -> Reader[IOResultE[Optional[str]]]
+def upload_one(file_path, st):
+    # with_env :: dict -> IOResultE[Optional[str]]
+    def with_env(env):
+        # larger objects cannot be copied to update their meta, they are hashed up front
+        if env['single_pass'] and st.st_size < COPY_LIMIT:
+            return upload_hashing(file_path, st)(env)
+        if st.st_size >= env['multipart']['threshold']:
+            return upload_large(file_path)(env)
+        if env['compression'] is not None:
+            return upload_compressed(file_path)(env)
         return get_file_handler(file_path).bind(
             lambda data : upload_data(env['key'])(data)(env['bucket'])
+        ).map(
+            lambda put_result : etag_to_md5(put_result.etag)
         )
     return Reader(with_env)
 
@@ -150,30 +276,239 @@ def upload_one(file_path):
 def get_file_handler(filepath, mode='rb'):
     return open(filepath, mode)
 
-# get_remote_md5 :: str -> Reader[IOResultE(md5)]
+# md5_from_headers :: dict -> ResultE[Optional[str]]
+def md5_from_headers(headers):
+    return safe_get('x-oss-meta-content-md5')(headers).lash(
+        lambda _ : safe_get('Content-Md5')(headers)
+    ).lash(
+        lambda _ : Success(None)
+    )
+
+# get_remote_md5 :: str -> Reader[IOResultE[Optional[str]]]
 def get_remote_md5(key):
     # with_bucket :: bucket -> IO[ResultE[str]]
+    @REGISTRY.timed('head')
     def with_bucket(bucket):
-        header_result = bucket.head_object(key)
-        return IOResultE.from_result(safe_get('Content-Md5')(header_result.resp.headers))
+        headers = bucket.head_object(key).resp.headers
+        return IOResultE.from_result(md5_from_headers(headers))
     return Reader(pipe(with_bucket, IOResultE.from_ioresult))
 
-# check_md5_integrity :: str -> Reader[IOResultE[bool]]
+# original_md5 :: dict -> ResultE[Optional[str]]
+def original_md5(headers):
+    """
+    the md5 of the content of an object stored compressed, from its meta, None for any other object
+    """
+    return md5_from_headers(headers).map(
+        lambda md5 : md5 if stored_codec(headers) is not None else None
+    )
+
+# get_original_md5 :: str -> Reader[IOResultE[Optional[str]]]
+def get_original_md5(key):
+    @REGISTRY.timed('head')
+    @impure_safe
+    def with_bucket(bucket):
+        return bucket.head_object(key).resp.headers
+    return Reader(lambda bucket : with_bucket(bucket).bind_result(original_md5))
+
+# known_md5 :: str -> Reader[Optional[str]]
+def known_md5(key):
+    def with_env(env):
+        index = env['remote'] if env['remote'] is not None else env['packed']
+        return None if index is None else index.md5(key)
+    return Reader(with_env)
+
+# lookup_remote_md5 :: str -> Reader[IOResultE[str]]
+def lookup_remote_md5(key):
+    """
+    the prefetched remote index has no md5 for multipart objects, fall back to a HEAD
+    """
+    def with_env(env):
+        md5 = known_md5(key)(env)
+        if md5 is None:
+            return get_remote_md5(key)(env['bucket'])
+        return IOSuccess(md5)
+    return Reader(with_env)
+
+# confirm_mismatch :: (str, str, Optional[str]) -> Reader[IOResultE[Tuple[bool, str]]]
+def confirm_mismatch(key, local_md5, remote_md5):
+    """
+    the listed ETag of an object stored compressed is the md5 of the compressed body,
+    so a mismatch with the listing is confirmed with the meta, as verify_one does
+    """
+    def with_env(env):
+        if local_md5 == remote_md5 or env['remote'] is None:
+            return IOSuccess((local_md5 == remote_md5, local_md5))
+        return get_original_md5(key)(env['bucket']).map(
+            lambda original : (local_md5 == original, local_md5)
+        )
+    return Reader(with_env)
+
+# check_md5_integrity :: str -> Reader[IOResultE[Tuple[bool, str]]]
 def check_md5_integrity(filepath):
     def with_env(env):
         return IOResultE.do(
-            local_md5 == remote_md5
-            for fhandle    in get_file_handler(filepath)
-            for local_md5  in get_local_md5(fhandle)
-            for remote_md5 in get_remote_md5(env['key'])(env['bucket'])
+            verify
+            for local_md5  in file_md5(filepath)
+            for remote_md5 in lookup_remote_md5(env['key'])(env)
+            for verify     in confirm_mismatch(env['key'], local_md5, remote_md5)(env)
         )
     return Reader(with_env)
 
-# conditional_exit :: str -> Reader[IOResultE[str]]
-def conditional_exit(filepath):
-    return check_md5_integrity(filepath).map(
-        bind(lambda pass_md5_verify : IOFailure(f'{filepath} 在oss中已存在!') if pass_md5_verify else IOSuccess(f'Did not Pass md5 verification'))
-    )
+# skip_verified :: (str, os.stat_result, bool, str) -> Reader[IOResultE[str]]
+def skip_verified(filepath, st, verified, local_md5):
+    def with_env(env):
+        if not verified:
+            return IOSuccess('Did not Pass md5 verification')
+        return remember(filepath, st, local_md5)(env).bind(
+            lambda _ : IOFailure(f'{filepath} 在oss中已存在!')
+        )
+    return Reader(with_env)
+
+# size_changed :: os.stat_result -> Reader[bool]
+def size_changed(st):
+    def with_env(env):
+        return env['remote'] is not None and env['remote'].size(env['key']) not in (None, st.st_size)
+    return Reader(with_env)
+
+@impure_safe
+# get_stat :: Path -> IOResultE[os.stat_result]
+def get_stat(filepath):
+    """
+    paths from collect_files answer from the stat taken while scanning
+    """
+    return filepath.stat()
+
+# remember :: (str, os.stat_result, Optional[str]) -> Reader[IOResultE[Optional[str]]]
+def remember(filepath, st, md5):
+    """
+    record the uploaded state of filepath in the manifest and the journal, if there are
+    """
+    @impure_safe
+    def with_env(env):
+        if env['manifest'] is not None:
+            env['manifest'].record(str(filepath), st, md5, env['bucket'].bucket_name, env['key'])
+        if env['journal'] is not None:
+            env['journal'].record(env['key'], 'completed')
+        return md5
+    return Reader(with_env)
+
+# resumed_exit :: str -> Reader[IOResultE[str]]
+def resumed_exit(filepath):
+    """
+    skip keys completed by the job being resumed, without looking at the file or at oss
+    """
+    def with_env(env):
+        journal = env['journal']
+        if journal is None:
+            return IOSuccess('No journal')
+        if journal.completed(env['key']):
+            return IOFailure(f'{filepath} 已在上次运行中完成!')
+        journal.record(env['key'], 'started')
+        return IOSuccess('Started')
+    return Reader(with_env)
+
+# journal_failure :: Any -> Reader[IOResultE[Any]]
+def journal_failure(error):
+    """
+    errors, not skipped files, are recorded as failed, so that --resume tries them again
+    """
+    def with_env(env):
+        if env['journal'] is not None and isinstance(error, Exception):
+            env['journal'].record(env['key'], 'failed', error)
+        return IOFailure(error)
+    return Reader(with_env)
+
+# unchanged_exit :: (str, os.stat_result) -> Reader[IOResultE[str]]
+def unchanged_exit(filepath, st):
+    @REGISTRY.timed('manifest')
+    def with_env(env):
+        manifest = env['manifest']
+        # the prefetched listing knows the object was deleted since, whatever the manifest says
+        missing  = env['remote'] is not None and not env['remote'].exists(env['key'])
+        if manifest is not None and not missing and manifest.unchanged(str(filepath), st, env['bucket'].bucket_name, env['key']):
+            return IOFailure(f'{filepath} 自上次上传后未修改!')
+        return IOSuccess('Not Recorded in manifest')
+    return Reader(with_env)
+
+# conditional_exit :: (str, os.stat_result) -> Reader[IOResultE[str]]
+def conditional_exit(filepath, st):
+    def with_env(env):
+        if deduplicates(st)(env) or env['compression'] is not None:
+            # the listing only knows the size and md5 of the recipe or of the compressed
+            # body, ask for the meta instead
+            env = dict(env, remote=None)
+        if env['single_pass']:
+            return IOSuccess('Verified while uploading')
+        if size_changed(st)(env):
+            # unless the object is stored compressed, and listed with the compressed size
+            return get_original_md5(env['key'])(env['bucket']).bind(
+                lambda original : IOSuccess('Size changed') if original is None else file_md5(filepath).bind(
+                    lambda local_md5 : skip_verified(filepath, st, local_md5 == original, local_md5)(env)
+                )
+            )
+        return check_md5_integrity(filepath)(env).bind(
+            lambda verify : skip_verified(filepath, st, *verify)(env)
+        )
+    return Reader(with_env)
+
+# pack_one :: (str, os.stat_result) -> Reader[IOResultE[str]]
+def pack_one(filepath, st):
+    """
+    queue a small file into the current pack, it is remembered in the manifest
+    only once the pack holding it has been uploaded, and counted by the packer then
+    """
+    def with_env(env):
+        on_flush   = lambda md5 : task_outcome(
+            remember(filepath, st, md5)(env).lash(lambda error : journal_failure(error)(env)).lash(fail_callback)
+        )
+        on_failure = lambda error : task_outcome(journal_failure(error)(env).lash(fail_callback))
+        return read_data(filepath).map(
+            lambda data : env['packer'].add(env['key'], data, on_flush, on_failure)
+        ).map(
+            lambda _ : Packed(f'{env["key"]} 已加入打包')
+        )
+    return Reader(with_env)
+
+# deduplicates :: os.stat_result -> Reader[bool]
+def deduplicates(st):
+    def with_env(env):
+        return env['chunks'] is not None and st.st_size >= env['chunk_size']
+    return Reader(with_env)
+
+# dedup_one :: str -> Reader[IOResultE[str]]
+def dedup_one(filepath):
+    """
+    split the file into content defined chunks, upload the chunks the bucket
+    does not have yet, and store a recipe listing them at the key of the file
+    """
+    @impure_safe
+    def with_env(env):
+        with open(filepath, 'rb') as f:
+            recipe, uploaded = env['chunks'].store(f, env['chunk_size'])
+        headers = {'x-oss-meta-soss-format' : RECIPE_FORMAT, 'x-oss-meta-content-md5' : recipe['md5']}
+        env['bucket'].put_object(env['key'], json.dumps(recipe), headers=headers)
+        print(f'{env["key"]} 去重上传成功, {len(recipe["chunks"])} 个分块中 {uploaded} 个为新分块')
+        return recipe['md5']
+    return Reader(with_env)
+
+# store_one :: (str, os.stat_result) -> Reader[IOResultE[str]]
+def store_one(filepath, st):
+    @REGISTRY.timed('upload')
+    def with_env(env):
+        if env['packer'] is not None and st.st_size < env['pack_threshold']:
+            return pack_one(filepath, st)(env)
+        if deduplicates(st)(env):
+            return dedup_one(filepath)(env).bind(
+                lambda md5 : remember(filepath, st, md5)(env)
+            ).map(
+                lambda _ : f'{env["key"]} 上传成功'
+            )
+        return upload_one(filepath, st)(env).bind(
+            lambda md5 : remember(filepath, st, md5)(env)
+        ).map(
+            lambda _ : f'{env["key"]} 上传成功'
+        )
+    return Reader(with_env)
 
 # conditional_upload :: str -> Reader[IOResultE[str]]
 def conditional_upload(filepath):
@@ -182,59 +517,238 @@ def conditional_upload(filepath):
         # env.update({'key' : get_key(filepath)(env['identifier'])})
         items   = list(env.items()) + [('key', get_key(filepath)(env['identifier']))]
         new_env = dict(items)
-        return key_exists(new_env['key'])(env['bucket']).bind(
-            lambda exists : conditional_exit(filepath)(new_env) if exists else IOSuccess("File Not Exists")
-        ).bind(
-            lambda _ : upload_one(filepath)(new_env)
+        # attempt :: () -> IOResultE[str]
+        attempt = lambda : get_stat(filepath).bind(
+            lambda st : unchanged_exit(filepath, st)(new_env).bind(
+                lambda _ : remote_exists(new_env['key'])(new_env)
+            ).bind(
+                lambda exists : conditional_exit(filepath, st)(new_env) if exists else IOSuccess("File Not Exists")
+            ).bind(
+                lambda _ : store_one(filepath, st)(new_env)
+            )
+        )
+        return resumed_exit(filepath)(new_env).bind(
+            lambda _ : retry(attempt, new_env['attempts'])
+        ).lash(
+            lambda error : journal_failure(error)(new_env)
         )
     return Reader(with_env)
 
-# is_normal_file :: Path -> IOResultE[Path]
-def is_normal_file(path):
-    return IOSuccess(path.is_file())
+async def run_blocking(executor, thunk):
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(executor, thunk)
 
-# truey_value :: IOResultE[any] -> bool
-def truey_value(ior_value):
-    return ior_value == IOSuccess(True)
+# in_executor :: (Executor, Callable[[], IOResultE[a]]) -> FutureResultE[a]
+def in_executor(executor, thunk):
+    """
+    run a blocking step (disk io, hashing) on one of the few threads of executor,
+    so it does not stall the event loop
+    """
+    return future_safe(run_blocking)(executor, thunk).bind_ioresult(lambda ioresult : ioresult)
 
-# str -> IOResultE[MIterator[Path]]
-def collect_files(directory_path):
+# remote_exists_async :: str -> Reader[FutureResultE[bool]]
+def remote_exists_async(key):
+    def with_env(env):
+        if env['remote'] is not None:
+            return FutureResultE.from_value(env['remote'].exists(key))
+        if env['packed'] is not None and env['packed'].exists(key):
+            return FutureResultE.from_value(True)
+        return future_safe(env['abucket'].object_exists)(key)
+    return Reader(with_env)
 
-    # Tuple[str, str, List[str]] -> MIterator[str]
-    def tu0_plus_tu2(tu):
-        current_dir = Path(tu[0])
-        return flow(
-            MIterator(tu[2]),
-            map_(current_dir.joinpath)
+# lookup_remote_md5_async :: str -> Reader[FutureResultE[Optional[str]]]
+def lookup_remote_md5_async(key):
+    def with_env(env):
+        md5 = known_md5(key)(env)
+        if md5 is None:
+            return future_safe(env['abucket'].head_object)(key).bind_result(md5_from_headers)
+        return FutureResultE.from_value(md5)
+    return Reader(with_env)
+
+# get_original_md5_async :: str -> Reader[FutureResultE[Optional[str]]]
+def get_original_md5_async(key):
+    def with_env(env):
+        return future_safe(env['abucket'].head_object)(key).bind_result(original_md5)
+    return Reader(with_env)
+
+# confirm_mismatch_async :: (str, str, Optional[str]) -> Reader[FutureResultE[Tuple[bool, str]]]
+def confirm_mismatch_async(key, local_md5, remote_md5):
+    def with_env(env):
+        if local_md5 == remote_md5 or env['remote'] is None:
+            return FutureResultE.from_value((local_md5 == remote_md5, local_md5))
+        return get_original_md5_async(key)(env).map(
+            lambda original : (local_md5 == original, local_md5)
         )
+    return Reader(with_env)
+
+# conditional_exit_async :: (str, os.stat_result) -> Reader[FutureResultE[str]]
+def conditional_exit_async(filepath, st):
+    def with_env(env):
+        if deduplicates(st)(env) or env['compression'] is not None:
+            env = dict(env, remote=None)
+        if env['single_pass']:
+            return FutureResultE.from_value('Verified while uploading')
+        if size_changed(st)(env):
+            return get_original_md5_async(env['key'])(env).bind(
+                lambda original : FutureResultE.from_value('Size changed') if original is None else in_executor(env['disk'], lambda : file_md5(filepath)).bind_ioresult(
+                    lambda local_md5 : skip_verified(filepath, st, local_md5 == original, local_md5)(env)
+                )
+            )
+        return in_executor(env['disk'], lambda : file_md5(filepath)).bind(
+            lambda local_md5 : lookup_remote_md5_async(env['key'])(env).bind(
+                lambda remote_md5 : confirm_mismatch_async(env['key'], local_md5, remote_md5)(env)
+            )
+        ).bind_ioresult(
+            lambda verify : skip_verified(filepath, st, *verify)(env)
+        )
+    return Reader(with_env)
+
+# upload_data_async :: (str, bytes) -> Reader[FutureResultE[str]]
+def upload_data_async(key, data):
+    """
+    the data is in memory anyway, so it is sent with its Content-Md5 and oss verifies it,
+    with compression the compressed body is, and the md5 of the data is returned
+    """
+    def with_env(env):
+        md5 = content_md5(data)
+        compressed = FutureResultE.from_value((data, {})) if env['compression'] is None else in_executor(
+            env['disk'], lambda : IOSuccess(compress_body(data, env['compression']))
+        )
+        return compressed.bind(
+            lambda compressed : future_safe(env['abucket'].put_object)(
+                key, compressed[0], dict(compressed[1], **{'Content-MD5' : content_md5(compressed[0])})
+            )
+        ).map(
+            lambda _ : print(f'{key} 上传成功') or md5
+        )
+    return Reader(with_env)
 
-    normal_file = pipe(is_normal_file, truey_value)
+# store_one_async :: (str, os.stat_result) -> Reader[FutureResultE[str]]
+def store_one_async(filepath, st):
+    """
+    packed, deduplicated and multipart files are bound by bandwidth rather than
+    by requests, they keep the threaded path on the disk executor
+    """
+    def with_env(env):
+        threaded = (
+            (env['packer'] is not None and st.st_size < env['pack_threshold'])
+            or deduplicates(st)(env)
+            or st.st_size >= env['multipart']['threshold']
+        )
+        if threaded:
+            return in_executor(env['disk'], lambda : store_one(filepath, st)(env))
+        # the file is read whole, the files read at once are bounded by their total size
+        async def buffered():
+            async with env['abucket'].buffered.hold(st.st_size):
+                return await in_executor(env['disk'], lambda : read_data(filepath)).bind(
+                    lambda data : upload_data_async(env['key'], data)(env)
+                )
+        return future_safe(buffered)().bind_ioresult(
+            lambda ioresult : ioresult
+        ).bind_ioresult(
+            lambda md5 : remember(filepath, st, md5)(env)
+        ).map(
+            lambda _ : f'{env["key"]} 上传成功'
+        )
+    return Reader(with_env)
+
+# conditional_upload_async :: str -> Reader[FutureResultE[str]]
+def conditional_upload_async(filepath):
+    """
+    conditional_upload on the event loop, the same decisions in the same order,
+    requests to oss go through env['abucket'] and blocking steps through env['disk']
+    """
+    # with_env :: dict -> FutureResultE[str]
+    def with_env(env):
+        new_env = dict(env, key=get_key(filepath)(env['identifier']))
+        # attempt :: () -> FutureResultE[str]
+        attempt = lambda : FutureResultE.from_ioresult(get_stat(filepath)).bind(
+            lambda st : FutureResultE.from_ioresult(unchanged_exit(filepath, st)(new_env)).bind(
+                lambda _ : remote_exists_async(new_env['key'])(new_env)
+            ).bind(
+                lambda exists : conditional_exit_async(filepath, st)(new_env) if exists else FutureResultE.from_value("File Not Exists")
+            ).bind(
+                lambda _ : store_one_async(filepath, st)(new_env)
+            )
+        )
+        return FutureResultE.from_ioresult(resumed_exit(filepath)(new_env)).bind(
+            lambda _ : retry_async(attempt, new_env['attempts'])
+        ).lash(
+            lambda error : FutureResultE.from_ioresult(journal_failure(error)(new_env))
+        )
+    return Reader(with_env)
 
+# (Path, int) -> IOResultE[MIterator[ScannedPath]]
+def collect_files(directory_path, scan_workers=SCAN_WORKERS):
+    """
+    the regular files under directory_path, streamed while the tree is still being
+    scanned, each carrying the stat read during the scan
+    """
     return flow(
         IOSuccess(directory_path),
-        bind(impure_safe(Path.absolute)),                             # IOResultE[Str]
-        bind(impure_safe(Path.resolve)),                              # IOResultE[Str]
-        bind(impure_safe(pipe(Path.walk, MIterator))),                # IOResultE[MIterator[Tuple[Str]]]
-        map_(bind(tu0_plus_tu2)),                                     # IOResultE(MIterator[str])
-        map_(lambda iterator : iterator.filter(normal_file)),              # IOResultE[MIterator[str]]
+        bind(impure_safe(Path.absolute)),                                       # IOResultE[Path]
+        bind(impure_safe(Path.resolve)),                                        # IOResultE[Path]
+        map_(lambda root : MIterator(scan(root, scan_workers))),               # IOResultE[MIterator[Tuple[str, os.stat_result]]]
+        map_(map_(lambda scanned : scanned_path(*scanned))),                    # IOResultE[MIterator[ScannedPath]]
     )
 
-# upload_dir :: str -> IOResultE[MIterator[ReaderIOResultE[str]]]
-def upload_dir(directory):
+# find_files :: (str, int) -> IOResultE[MIterator[Path]]
+def find_files(directory, scan_workers=SCAN_WORKERS):
     return IOSuccess(directory).map(
         pipe(os.path.normcase, os.path.normpath, Path)
     ).bind(
         lambda path : IOSuccess(path) if path.is_dir() else IOFailure(f'"{path}" is not exists, thus can not be collected') 
     ).bind(
-        collect_files                                                                   # IOResultE[MIterator[Path]]
-    ).map(
-        map_(conditional_upload)                                                        # IOResultE[MIterator[Reader[IOResultE[str]]]]
+        lambda path : collect_files(path, scan_workers)                                 # IOResultE[MIterator[Path]]
     )
 
-# oss_login :: dict -> IOResultE[oss2.Bucket]
-def oss_login(env):
+# upload_dir :: (str, Callable[[Path], Reader], int) -> IOResultE[MIterator[ReaderIOResultE[str]]]
+def upload_dir(directory, upload_file=conditional_upload, scan_workers=SCAN_WORKERS):
+    return find_files(directory, scan_workers).map(
+        map_(upload_file)                                                               # IOResultE[MIterator[Reader[IOResultE[str]]]]
+    )
+
+# verify_one :: (Path, IOResultE[str]) -> Reader[str]
+def verify_one(filepath, local_md5):
+    def with_env(env):
+        key = get_key(filepath)(env['identifier'])
+        if not env['remote'].exists(key):
+            print(f'{filepath} 在oss中不存在')
+            return 'missing'
+        verified = IOResultE.do(
+            local == remote
+            for local  in local_md5
+            for remote in lookup_remote_md5(key)(env)
+        )
+        if verified == IOSuccess(False):
+            # the ETag of a compressed object is the md5 of the compressed body, the meta has the original
+            verified = IOResultE.do(
+                local == remote
+                for local  in local_md5
+                for remote in get_remote_md5(key)(env['bucket'])
+            )
+        if verified == IOSuccess(True):
+            return 'matched'
+        if verified == IOSuccess(False):
+            print(f'{filepath} 与oss中的内容不一致')
+            return 'mismatched'
+        fail_callback(unsafe_perform_io(verified.failure()))
+        return 'failed'
+    return Reader(with_env)
+
+# make_bucket :: (Optional[int], oss2.Auth, str, str) -> oss2.Bucket
+def make_bucket(pool_size, auth, endpoint, bucket_name):
+    """
+    the connection pool of oss2 keeps 10 connections by default, with more
+    workers than that every extra request opens a new connection and drops it
+    """
+    from session import MeteredSession, ShapedBucket
+    return ShapedBucket(auth, endpoint, bucket_name, session=MeteredSession(pool_size=pool_size))
+
+# oss_login :: (dict, Optional[int]) -> IOResultE[oss2.Bucket]
+def oss_login(env, pool_size=None):
     return flow(
-        IOSuccess(curry(oss2.Bucket)),
+        IOSuccess(curry(make_bucket)(pool_size)),
         IOResultE.from_ioresult(make_auth()).apply,
         IOSuccess(env['endpoint']).apply,
         IOSuccess(env['bucket']).apply
@@ -251,8 +765,90 @@ def read_config(config_path):
 @impure_safe
 # make_auth :: () -> IOResultE[oss2.Auth]
 def make_auth():
+    import oss2
+    from oss2.credentials import EnvironmentVariableCredentialsProvider
     return oss2.ProviderAuth(EnvironmentVariableCredentialsProvider())
 
+@impure_safe
+# open_manifest :: Optional[str] -> IOResultE[Optional[Manifest]]
+def open_manifest(manifest_path):
+    if manifest_path is None:
+        return None
+    from manifest import Manifest
+    manifest = Manifest(manifest_path)
+    atexit.register(manifest.close)
+    return manifest
+
+@impure_safe
+# load_remote :: (bool, str, oss2.Bucket, dict) -> IOResultE[Optional[RemoteIndex]]
+def load_remote(prefetch, directory, bucket, identifier):
+    if not prefetch:
+        return None
+    prefix = directory_prefix(directory, identifier)
+    remote = RemoteIndex.load(bucket, prefix).add_packs(bucket, pack_prefix(prefix), prefix)
+    print(f'已从 {prefix} 预取 {len(remote)} 个对象的状态')
+    return remote
+
+@impure_safe
+# load_packed :: (Optional[int], bool, str, oss2.Bucket, dict) -> IOResultE[Optional[RemoteIndex]]
+def load_packed(pack_threshold, prefetch, directory, bucket, identifier):
+    """
+    without --prefetch a HEAD of the key can not see the files packed by earlier runs,
+    the indexes of the packs under the directory are read up front instead
+    """
+    if pack_threshold is None or prefetch:
+        return None
+    prefix = directory_prefix(directory, identifier)
+    return RemoteIndex({}).add_packs(bucket, pack_prefix(prefix), prefix)
+
+# directory_prefix :: (str, dict) -> str
+def directory_prefix(directory, identifier):
+    path = Path(os.path.normpath(os.path.normcase(directory))).absolute().resolve()
+    return get_key(path)(identifier).rstrip('/') + '/'
+
+@impure_safe
+# open_journal :: (Optional[str], bool) -> IOResultE[Optional[Journal]]
+def open_journal(journal_path, resume):
+    if journal_path is None:
+        return None
+    journal = Journal(journal_path, resume)
+    atexit.register(journal.close)
+    return journal
+
+@impure_safe
+# open_chunks :: (bool, bool, oss2.Bucket) -> IOResultE[Optional[ChunkStore]]
+def open_chunks(dedup, prefetch, bucket):
+    if not dedup:
+        return None
+    if prefetch:
+        return ChunkStore.load(bucket)
+    return ChunkStore(bucket)
+
+@impure_safe
+# open_async_bucket :: (bool, oss2.Bucket, int, int) -> IOResultE[Optional[AsyncBucket]]
+def open_async_bucket(asynchronous, bucket, connections, buffer_limit):
+    if not asynchronous:
+        return None
+    # the asyncio engine and its http client are only imported when used
+    from aio import AsyncBucket
+    return AsyncBucket(bucket, connections, buffer_limit)
+
+@impure_safe
+# open_disk_pool :: (bool, int) -> IOResultE[Optional[ThreadPoolExecutor]]
+def open_disk_pool(asynchronous, threads):
+    if not asynchronous:
+        return None
+    pool = ThreadPoolExecutor(threads)
+    atexit.register(pool.shutdown)
+    return pool
+
+@impure_safe
+# open_packer :: (Optional[int], int, oss2.Bucket, dict, int) -> IOResultE[Optional[Packer]]
+def open_packer(pack_threshold, pack_size, bucket, identifier, attempts):
+    if pack_threshold is None:
+        return None
+    return Packer(bucket, pack_prefix(identifier['hostname'] + '/'), pack_size, attempts)
+
 # make_env :: args -> IOResultE[dict]
 def make_env(args):
     return IOResultE.do(
@@ -264,37 +860,125 @@ def make_env(args):
         for identifier in get_identifier()
     )
 
-# win_callback :: MIterator[IOResultE[str]]
-def win_callback(iter_reader_ioresult):
-    threads = []
-    for task in iter_reader_ioresult:
-        t = threading.Thread(target=task)
-        t.start()
-        threads.append(t)
-        while len(threads) > 300:
-            threads = [th for th in threads if not th.is_alive()]
-    return IOSuccess(0)
-
-# fail_callback :: Exception -> IOResultE[None]
+class Packed(str):
+    """
+    message of a file queued into a pack, its outcome is only known once the pack is uploaded
+    """
+
+# task_outcome :: IOResultE[str] -> str
+def task_outcome(ioresult):
+    """
+    IOSuccess means uploaded, an Exception inside IOFailure means the upload failed,
+    any other IOFailure (e.g. the file already exists in oss) means skipped,
+    packed files are counted by the packer instead
+    """
+    if isinstance(ioresult, IOSuccess):
+        return 'packed' if isinstance(unsafe_perform_io(ioresult.unwrap()), Packed) else 'completed'
+    if isinstance(unsafe_perform_io(ioresult.failure()), Exception):
+        return 'failed'
+    return 'skipped'
+
+@curry
+# win_callback :: (int, int, str, (MIterator[Callable[[], IOResultE[str]]], Optional[Packer])) -> IOResultE[dict]
+def win_callback(workers, queue_size, engine, job):
+    """
+    the last pack is flushed here rather than at exit, while the manifest and the journal
+    its files are recorded in are still open, and before the files are counted
+    """
+    iter_task, packer = job
+    scheduler = AsyncScheduler if engine == 'asyncio' else Scheduler
+    stats     = scheduler(workers, queue_size, task_outcome).run(iter_task)
+    stats.pop('packed', None)
+    if packer is not None:
+        for outcome, count in packer.flush().items():
+            stats[outcome] = stats.get(outcome, 0) + count
+    print(
+        f'上传完成: {stats.get("completed", 0)} 个成功, '
+        f'{stats.get("skipped", 0)} 个跳过, '
+        f'{stats.get("failed", 0)} 个失败'
+    )
+    return IOSuccess(stats)
+
+# fail_callback :: Exception -> IOResultE[Exception]
 def fail_callback(error):
-    return  IOFailure(print(error))
+    print(error)
+    return IOFailure(error)
 
-# upload :: args -> IOResultE[MIterator[Callable[[], IOResultE[str]]]]
+# upload :: args -> IOResultE[(MIterator[Callable[[], IOResultE[str]]], Optional[Packer])]
 def upload(args):
     # return upload_dir(args.directory)
-    new_env = lambda env, bucket : {
-        'bucket'     : bucket,
-        'identifier' : env['identifier']
+    asynchronous = args.engine == 'asyncio'
+    upload_file  = conditional_upload_async if asynchronous else conditional_upload
+    on_failure   = pipe(fail_callback, FutureResultE.from_ioresult) if asynchronous else fail_callback
+    new_env = lambda env, bucket, manifest, remote, packed, packer, chunks, abucket, disk, journal : {
+        'bucket'         : bucket,
+        'identifier'     : env['identifier'],
+        'manifest'       : manifest,
+        'remote'         : remote,
+        'packed'         : packed,
+        'single_pass'    : args.single_pass,
+        'packer'         : packer,
+        'pack_threshold' : args.pack_threshold,
+        'chunks'         : chunks,
+        'chunk_size'     : args.chunk_size,
+        'abucket'        : abucket,
+        'disk'           : disk,
+        'journal'        : journal,
+        'attempts'       : args.retries + 1,
+        'compression'    : args.compress,
+        'multipart'      : {
+            'threshold' : args.multipart_threshold,
+            'part_size' : args.part_size,
+            'workers'   : args.part_workers
+        }
     }
     return IOResultE.do(
-        iter_reader_ioresult.map(
-            map_(lash(fail_callback))
-        ).map(
-            lambda reader : lambda : reader(new_env(env, bucket))
+        (
+            iter_reader_ioresult.map(
+                map_(lash(on_failure))
+            ).map(
+                lambda reader : lambda : reader(new_env(env, bucket, manifest, remote, packed, packer, chunks, abucket, disk, journal))
+            ),
+            packer
         )
-        for iter_reader_ioresult in upload_dir(args.directory)
+        for iter_reader_ioresult in upload_dir(args.directory, upload_file, args.scan_workers)
         for env                  in make_env(args)
-        for bucket               in oss_login(env['config'])
+        for bucket               in oss_login(env['config'], args.workers)
+        for manifest             in open_manifest(args.manifest)
+        for remote               in load_remote(args.prefetch, args.directory, bucket, env['identifier'])
+        for packed               in load_packed(args.pack_threshold, args.prefetch, args.directory, bucket, env['identifier'])
+        for packer               in open_packer(args.pack_threshold, args.pack_size, bucket, env['identifier'], args.retries + 1)
+        for chunks               in open_chunks(args.dedup, args.prefetch, bucket)
+        for abucket              in open_async_bucket(asynchronous, bucket, args.connections, args.buffer_limit)
+        for disk                 in open_disk_pool(asynchronous, args.disk_threads)
+        for journal              in open_journal(args.journal, args.resume)
+    )
+
+# verify :: args -> IOResultE[dict]
+def verify(args):
+    """
+    hash every file of the directory across a process pool and compare with oss
+    """
+    # verify_all :: (MIterator[Path], dict) -> dict
+    def verify_all(files, env):
+        stats = {}
+        for filepath, local_md5 in calculate_md5_many(files, args.processes, ordered=False):
+            outcome        = verify_one(filepath, local_md5)(env)
+            stats[outcome] = stats.get(outcome, 0) + 1
+        print(
+            f'校验完成: {stats.get("matched", 0)} 个一致, '
+            f'{stats.get("mismatched", 0)} 个不一致, '
+            f'{stats.get("missing", 0)} 个不存在, '
+            f'{stats.get("failed", 0)} 个失败'
+        )
+        return stats
+
+    return IOResultE.do(
+        verify_all(files, {'bucket' : bucket, 'identifier' : env['identifier'], 'remote' : remote, 'packed' : None})
+        for files  in find_files(args.directory, args.scan_workers)
+        for env    in make_env(args)
+        for bucket in oss_login(env['config'])
+        for remote in load_remote(True, args.directory, bucket, env['identifier'])
     )
 
 # () -> IOResultE[argparse.NameSpace]
@@ -304,14 +988,56 @@ def main():
     upload_parser = subparsers.add_parser('upload')
     upload_parser.add_argument('directory', help='directory to upload')
     upload_parser.add_argument('--config',  '-c', help='directory to upload', default='./config.json', required=True)
+    upload_parser.add_argument('--workers', '-w', help='number of upload threads, or of concurrent uploads with --engine asyncio', type=int, default=32)
+    upload_parser.add_argument('--queue-size',    help='number of files waiting for a free upload thread', type=int, default=None)
+    upload_parser.add_argument('--manifest', '-m', help='local manifest file, files unchanged since the last upload are skipped', default=None)
+    upload_parser.add_argument('--prefetch', '-p', help='list the remote objects once up front instead of checking each file', action='store_true')
+    upload_parser.add_argument('--multipart-threshold', help='files at least this large are uploaded in parts, e.g. 64M', type=parse_size, default=64 * MB)
+    upload_parser.add_argument('--part-size',           help='size of each part of a multipart upload, e.g. 16M', type=parse_size, default=16 * MB)
+    upload_parser.add_argument('--part-workers',        help='number of parts of one file uploaded concurrently', type=int, default=4)
+    upload_parser.add_argument('--single-pass', help='hash changed files while uploading them instead of reading them twice, requires --manifest', action='store_true')
+    upload_parser.add_argument('--pack-threshold',      help='pack files smaller than this into shared pack objects, e.g. 64K', type=parse_size, default=None)
+    upload_parser.add_argument('--pack-size',           help='size of each pack object, e.g. 64M', type=parse_size, default=64 * MB)
+    upload_parser.add_argument('--dedup',               help='store files as content defined chunks shared across hosts', action='store_true')
+    upload_parser.add_argument('--chunk-size',          help='average chunk size of --dedup, files smaller than this are uploaded whole, e.g. 1M', type=parse_size, default=MB)
+    upload_parser.add_argument('--engine',              help='run uploads on worker threads or on one asyncio event loop', choices=('threads', 'asyncio'), default='threads')
+    upload_parser.add_argument('--connections',         help='size of the connection pool shared by --engine asyncio', type=int, default=256)
+    upload_parser.add_argument('--buffer-limit',        help='total size of the files --engine asyncio holds in memory at once, e.g. 256M', type=parse_size, default=256 * MB)
+    upload_parser.add_argument('--disk-threads',        help='threads reading and hashing files for --engine asyncio', type=int, default=os.cpu_count())
+    upload_parser.add_argument('--journal',             help='append the state of every key to this job journal', default=None)
+    upload_parser.add_argument('--resume',              help='skip the keys completed in --journal by an interrupted run', action='store_true')
+    upload_parser.add_argument('--retries',             help='times a file is uploaded again after a transient error, with exponential backoff', type=int, default=3)
+    upload_parser.add_argument('--scan-workers',        help='directories listed concurrently while scanning, raise it on network filesystems', type=int, default=SCAN_WORKERS)
+    upload_parser.add_argument('--compress',            help='compress files that look compressible with this codec before uploading them', choices=sorted(COMPRESSION_CODECS), default=None)
+
+    add_metrics_arguments(upload_parser)
+    add_congestion_arguments(upload_parser)
+
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument('directory', help='directory to verify against oss')
+    verify_parser.add_argument('--config',  '-c', help='directory to upload', default='./config.json', required=True)
+    verify_parser.add_argument('--processes', '-j', help='number of hashing processes, defaults to the number of cores', type=int, default=None)
+    verify_parser.add_argument('--scan-workers',    help='directories listed concurrently while scanning', type=int, default=SCAN_WORKERS)
+    add_metrics_arguments(verify_parser)
 
     update_meta_marser = subparsers.add_parser('update-meta')
     update_meta_marser.add_argument('--config',  '-c', help='directory to upload', default='./config.json', required=True)
 
 
     args = parser.parse_args()
+    if args.command == 'upload' and args.single_pass and args.manifest is None:
+        parser.error('--single-pass requires --manifest to skip unchanged files')
+    if args.command == 'upload' and args.single_pass and args.compress is not None:
+        parser.error('--single-pass verifies the ETag of the uploaded body, it can not be combined with --compress')
+    if args.command == 'upload' and args.resume and args.journal is None:
+        parser.error('--resume requires --journal to know what is done')
     if args.command == 'upload':
-        return upload(args)
+        start_writer(args)
+        configure_congestion(args, min(args.workers, args.connections) if args.engine == 'asyncio' else args.workers)
+        return upload(args).bind(win_callback(args.workers, args.queue_size, args.engine))
+    elif args.command == 'verify':
+        start_writer(args)
+        return verify(args)
     else:
         return IOFailure('未指定的的命令')
 
@@ -323,6 +1049,6 @@ if __name__ == '__main__':
         get_key = posix_get_key
 
     try:
-        main().lash(fail_callback).bind(win_callback)
+        main().lash(fail_callback)
     except KeyboardInterrupt:
         print('\nSoss Exit\n')